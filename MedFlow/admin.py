@@ -1,3 +1,66 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import (
+    ProcessingJob, TranscriptionSession, TranscriptionChunk, AudioTranscript, LLMUsage,
+    PipelineRun, PipelineCheckpoint, Patient, Visit
+)
+
+
+@admin.register(ProcessingJob)
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ('job_id', 'status', 'audio_file', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('job_id', 'created_at', 'started_at', 'finished_at')
+
+
+class TranscriptionChunkInline(admin.TabularInline):
+    model = TranscriptionChunk
+    extra = 0
+    readonly_fields = ('sequence', 'status', 'audio_file', 'text', 'error', 'seconds', 'created_at')
+
+
+@admin.register(TranscriptionSession)
+class TranscriptionSessionAdmin(admin.ModelAdmin):
+    list_display = ('session_id', 'status', 'created_at', 'finalized_at')
+    list_filter = ('status',)
+    readonly_fields = ('session_id', 'created_at', 'updated_at', 'finalized_at')
+    inlines = [TranscriptionChunkInline]
+
+
+@admin.register(AudioTranscript)
+class AudioTranscriptAdmin(admin.ModelAdmin):
+    list_display = ('content_hash', 'audio_file', 'model', 'hits', 'created_at', 'last_used_at')
+    readonly_fields = ('content_hash', 'created_at', 'last_used_at')
+
+
+@admin.register(LLMUsage)
+class LLMUsageAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'category', 'model', 'cached', 'total_tokens', 'cost_usd', 'seconds', 'visit_id')
+    list_filter = ('category', 'model', 'cached')
+    readonly_fields = ('created_at',)
+
+
+class PipelineCheckpointInline(admin.TabularInline):
+    model = PipelineCheckpoint
+    extra = 0
+    readonly_fields = ('stage', 'output', 'created_at')
+
+
+@admin.register(PipelineRun)
+class PipelineRunAdmin(admin.ModelAdmin):
+    list_display = ('run_id', 'status', 'mode', 'attempts', 'failed_stage', 'created_at', 'updated_at')
+    list_filter = ('status', 'mode')
+    readonly_fields = ('run_id', 'created_at', 'updated_at')
+    inlines = [PipelineCheckpointInline]
+
+
+@admin.register(Patient)
+class PatientAdmin(admin.ModelAdmin):
+    list_display = ('name', 'mrn', 'visit_count', 'first_visit', 'last_visit')
+    search_fields = ('name', 'mrn')
+
+
+@admin.register(Visit)
+class VisitAdmin(admin.ModelAdmin):
+    list_display = ('visit_id', 'patient', 'timestamp')
+    search_fields = ('visit_id', 'patient__name')
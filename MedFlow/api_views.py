@@ -1,8 +1,9 @@
 """
 API views for React frontend integration
 """
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from rest_framework.decorators import api_view, permission_classes
@@ -10,18 +11,30 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 import json
-import os
 import sys
+import uuid
+import hashlib
 from pathlib import Path
-from openai import OpenAI
+from asgiref.sync import sync_to_async
 from datetime import datetime
 from .patient_storage import patient_storage
+from .visit_updates import VisitChanged
+from .listing import patient_query, visit_query, fields_query, project
+from .processing import run_consultation_pipeline, arun_consultation_pipeline, recompute_visit, PipelineIncomplete
+from .pipeline_runs import PipelineRunNotFound
+from .jobs import job_queue, JobQueueFull
+from .models import TranscriptionSession, TranscriptionChunk
 
 # Add the src directory to the path
 src_path = Path(__file__).parent / 'src'
 sys.path.insert(0, str(src_path))
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from transcriber import transcriber
+from metrics import metrics
+from llm_client import record_usage
+from .transcription_sessions import transcription_sessions, SessionClosed
+from .transcript_cache import transcript_cache
+from .usage import usage_ledger
 
 
 @api_view(['POST'])
@@ -78,6 +91,67 @@ def api_current_user(request):
     })
 
 
+AUDIO_DIR = Path(__file__).parent / 'audio_recordings'
+
+
+def _save_uploaded_audio(audio_file):
+    """
+    Save an uploaded recording under audio_recordings/, preserving its extension.
+    The SHA-256 of the audio is computed while it is written; a recording that is
+    already stored is not kept twice, the existing file is returned instead.
+    """
+    # Create audio directory if it doesn't exist
+    audio_dir = AUDIO_DIR
+    audio_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Generate filename with timestamp, preserving original extension
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    
+    # Get original file extension
+    original_filename = audio_file.name
+    if '.' in original_filename:
+        original_extension = original_filename.rsplit('.', 1)[1].lower()
+    else:
+        original_extension = 'webm'  # default for recordings
+    
+    audio_filename = f'recording_{timestamp}.{original_extension}'
+    audio_path = audio_dir / audio_filename
+    
+    # Write to a temporary name first, hashing as the chunks go by
+    digest = hashlib.sha256()
+    temp_path = audio_dir / f'.upload_{uuid.uuid4().hex}.part'
+    with open(temp_path, 'wb') as f:
+        for chunk in audio_file.chunks():
+            digest.update(chunk)
+            f.write(chunk)
+    content_hash = digest.hexdigest()
+    
+    existing = transcript_cache.find(content_hash)
+    if existing is not None and (audio_dir / existing.audio_file).exists():
+        temp_path.unlink()
+        existing_extension = existing.audio_file.rsplit('.', 1)[-1]
+        print(f"\n✓ Audio already stored: {existing.audio_file} (sha256 {content_hash[:12]})")
+        return existing.audio_file, audio_dir / existing.audio_file, existing_extension, content_hash
+    
+    if audio_path.exists():
+        # Two different uploads in the same second
+        audio_filename = f'recording_{timestamp}_{content_hash[:8]}.{original_extension}'
+        audio_path = audio_dir / audio_filename
+    temp_path.replace(audio_path)
+    if existing is not None:
+        # Same audio, but its stored file was deleted: the transcript still holds, for this copy
+        transcript_cache.relink(content_hash, audio_filename)
+    
+    print(f"\n✓ Audio file saved: {audio_path}")
+    print(f"  - Original filename: {original_filename}")
+    print(f"  - Extension: {original_extension}")
+    print(f"  - File size: {audio_path.stat().st_size} bytes")
+    print(f"  - MIME type: {audio_file.content_type}")
+    print(f"  - SHA-256: {content_hash}")
+    
+    return audio_filename, audio_path, original_extension, content_hash
+
+
 @api_view(['POST'])
 @csrf_exempt
 @permission_classes([AllowAny])
@@ -88,52 +162,32 @@ def api_transcribe_audio(request):
         if not audio_file:
             return Response({'error': 'No audio file provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Create audio directory if it doesn't exist
-        audio_dir = Path(__file__).parent / 'audio_recordings'
-        audio_dir.mkdir(exist_ok=True)
-        
-        # Generate filename with timestamp, preserving original extension
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        
-        # Get original file extension
-        original_filename = audio_file.name
-        if '.' in original_filename:
-            original_extension = original_filename.rsplit('.', 1)[1].lower()
-        else:
-            original_extension = 'webm'  # default for recordings
-        
-        audio_filename = f'recording_{timestamp}.{original_extension}'
-        audio_path = audio_dir / audio_filename
-        
-        # Save the audio file permanently
-        with open(audio_path, 'wb') as f:
-            for chunk in audio_file.chunks():
-                f.write(chunk)
+        audio_filename, audio_path, original_extension, content_hash = _save_uploaded_audio(audio_file)
         
-        print(f"\n✓ Audio file saved: {audio_path}")
-        print(f"  - Original filename: {original_filename}")
-        print(f"  - Extension: {original_extension}")
-        print(f"  - File size: {audio_path.stat().st_size} bytes")
-        print(f"  - MIME type: {audio_file.content_type}")
+        cached = transcript_cache.lookup(content_hash)
+        if cached is not None:
+            return Response({
+                'success': True,
+                'transcription': cached.transcription,
+                'audio_file': cached.audio_file,
+                'segments': cached.segments,
+                'cached': True
+            })
         
         try:
-            # Open the file and send to OpenAI
-            with open(audio_path, 'rb') as audio_data:
-                print(f"  - Sending to OpenAI Whisper API...")
-                # Pass the file with a tuple (filename, file_object) for proper format detection
-                transcription = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=(audio_filename, audio_data, f'audio/{original_extension}')
-                )
+            # Long WAV recordings are split at silences and transcribed in parallel
+            transcription = transcriber.transcribe(audio_path, audio_filename, original_extension)
+            transcript_cache.store(content_hash, audio_filename, transcription, audio_path.stat().st_size)
             
-            transcription_text = transcription.text
-            print(f"✓ Transcription successful")
+            transcription_text = transcription['text']
+            print(f"✓ Transcription successful ({transcription['segments']} segment(s), {transcription['seconds']}s)")
             print(f"  Length: {len(transcription_text)} characters\n")
             
             return Response({
                 'success': True,
                 'transcription': transcription_text,
-                'audio_file': audio_filename
+                'audio_file': audio_filename,
+                'segments': transcription['segments']
             })
             
         except Exception as e:
@@ -149,125 +203,374 @@ def api_transcribe_audio(request):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _chunk_sequence(request):
+    sequence = request.POST.get('sequence')
+    return int(sequence) if sequence not in (None, '') else None
+
+
+@api_view(['POST'])
+@csrf_exempt
+@permission_classes([AllowAny])
+def api_open_transcription_session(request):
+    """Open a live transcription session for a recording in progress"""
+    try:
+        session = transcription_sessions.open()
+        return Response({
+            'success': True,
+            'session_id': session.session_id,
+            'chunks_url': f'/api/transcribe/sessions/{session.session_id}/chunks/',
+            'finalize_url': f'/api/transcribe/sessions/{session.session_id}/finalize/'
+        }, status=status.HTTP_201_CREATED)
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def api_get_transcription_session(request, session_id):
+    """Running transcript and chunk status of a transcription session"""
+    try:
+        session = transcription_sessions.get(session_id)
+        if session is None:
+            return Response({
+                'error': 'Session not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response({
+            'success': True,
+            'session': session.to_dict()
+        })
+    except Exception as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+@csrf_exempt
+@permission_classes([AllowAny])
+def api_add_transcription_chunk(request, session_id):
+    """Transcribe one audio chunk and append it to the session transcript"""
+    try:
+        session = transcription_sessions.get(session_id)
+        if session is None:
+            return Response({
+                'error': 'Session not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        audio_file = request.FILES.get('audio')
+        if not audio_file:
+            return Response({'error': 'No audio file provided'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            chunk = transcription_sessions.add_chunk(session, audio_file, _chunk_sequence(request))
+        except SessionClosed as e:
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_409_CONFLICT)
+        
+        return Response({
+            'success': chunk.status == chunk.STATUS_DONE,
+            'chunk': chunk.to_dict(),
+            'text': chunk.text,
+            'transcript': session.transcript
+        })
+        
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+@csrf_exempt
+@permission_classes([AllowAny])
+def api_finalize_transcription_session(request, session_id):
+    """
+    Close a session, optionally with its last chunk, and return the full
+    transcript. While other requests are still transcribing chunks the answer
+    is 202 with the session finalizing and the chunks it waits for; post
+    finalize again (without audio) for the transcript.
+    """
+    try:
+        session = transcription_sessions.get(session_id)
+        if session is None:
+            return Response({
+                'error': 'Session not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        session = transcription_sessions.finalize(
+            session,
+            request.FILES.get('audio'),
+            _chunk_sequence(request)
+        )
+        if session.status == TranscriptionSession.STATUS_FINALIZING:
+            return Response({
+                'success': True,
+                'status': session.status,
+                'pending_chunks': transcription_sessions.pending_sequences(session),
+                'finalize_url': f'/api/transcribe/sessions/{session.session_id}/finalize/'
+            }, status=status.HTTP_202_ACCEPTED)
+        
+        failed = list(session.chunks.filter(
+            status=TranscriptionChunk.STATUS_FAILED
+        ).values_list('sequence', flat=True))
+        if failed:
+            print(f"⚠️  Session {session_id} finalized without chunks {failed}")
+        
+        print("✓ Transcription successful")
+        print(f"  Length: {len(session.transcript)} characters\n")
+        
+        # Same shape as /api/transcribe/, so the result goes straight to /api/process/
+        return Response({
+            'success': True,
+            'transcription': session.transcript,
+            'audio_file': f'sessions/{session.session_id}',
+            'failed_chunks': failed
+        })
+        
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(['POST'])
 @csrf_exempt
 @permission_classes([AllowAny])
 def api_process_transcription(request):
-    """Process transcription through all agents - API version"""
+    """
+    Process transcription through all agents - API version.
+    Posting the ``run_id`` of an incomplete run retries only its missing stages.
+    """
     try:
         data = json.loads(request.body)
         transcription = data.get('transcription', '')
         audio_filename = data.get('audio_file', '')
+        run_id = data.get('run_id') or None
         
-        if not transcription:
+        if not transcription and not run_id:
             return Response({'error': 'No transcription provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        print("\n" + "="*80)
-        print("PROCESSING TRANSCRIPTION THROUGH AGENTS")
-        print("="*80)
-        print(f"Audio file: {audio_filename}")
+        return Response(run_consultation_pipeline(transcription, audio_filename, run_id, create=False))
+        
+    except PipelineIncomplete as e:
+        # Partial success: the completed stages are kept and returned, retry with run_id
+        return Response(e.payload, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except PipelineRunNotFound as e:
+        return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _sse_event(event, data):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@api_view(['POST'])
+@csrf_exempt
+@permission_classes([AllowAny])
+def api_stream_soap_note(request):
+    """Stream SOAP note generation to the client as Server-Sent Events"""
+    try:
+        data = json.loads(request.body)
+        transcription = data.get('transcription', '')
+        
+        if not transcription:
+            return Response({'error': 'No transcription provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Import agents
         from soap_generator_agent import SOAPNoteGenerator
-        from data_extractor_agent import SOAPDataExtractor
-        from patient_agent import PatientDataExtractor
-        from lab_request_agent import LabRequestGenerator
-        from pharmacy_request_agent import PharmacyRequestGenerator
-        
-        # Extract Patient Data
-        print("[1/5] Extracting patient data...")
-        patient_extractor = PatientDataExtractor()
-        patient_data = patient_extractor.extract_patient_data(transcription)
-        
-        # Generate SOAP Note
-        print("[2/5] Generating SOAP note...")
         soap_generator = SOAPNoteGenerator()
-        soap_note = soap_generator.generate_soap_note(transcription)
-        
-        # Extract Clinical Data
-        print("[3/5] Extracting clinical data...")
-        data_extractor = SOAPDataExtractor()
-        clinical_data = data_extractor.extract_data(soap_note)
-        
-        # Generate Lab Request
-        print("[4/5] Generating lab requisition...")
-        lab_generator = LabRequestGenerator()
-        lab_requisition = lab_generator.generate_lab_request(soap_note, patient_data)
-        
-        # Generate Pharmacy Request
-        print("[5/5] Generating pharmacy requisition...")
-        pharmacy_generator = PharmacyRequestGenerator()
-        pharmacy_requisition = pharmacy_generator.generate_pharmacy_request(soap_note, patient_data)
-        
-        print("✓ All agents completed successfully\n")
-        
-        # Save complete record to file
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_dir = Path(__file__).parent / 'src' / 'output'
-        output_dir.mkdir(exist_ok=True)
-        
-        complete_record = {
-            "metadata": {
-                "generated_at": datetime.now().isoformat(),
-                "audio_file": audio_filename,
-                "timestamp": timestamp
-            },
-            "transcription": transcription,
-            "patient_demographics": patient_data,
-            "soap_note": soap_note,
-            "clinical_data": clinical_data,
-            "lab_requisition": lab_requisition,
-            "pharmacy_requisition": pharmacy_requisition
-        }
-        
-        output_file = output_dir / f'complete_record_{timestamp}.json'
-        with open(output_file, 'w') as f:
-            json.dump(complete_record, f, indent=2)
-        
-        print(f"✓ Complete record saved: {output_file}\n")
-        
-        # Save patient visit to storage
-        patient_name = patient_data.get('personal_info', {}).get('full_name', 'Unknown')
-        if patient_name != 'Unknown':
-            visit_data = {
-                'patient_name': patient_name,
-                'patient_mrn': f"{patient_name[:3].upper()}-{datetime.now().year}-{datetime.now().strftime('%m%d%H%M')}",
-                'transcription': transcription,
-                'patient_data': patient_data,
-                'soap_note': soap_note,
-                'clinical_data': clinical_data,
-                'lab_requisition': lab_requisition,
-                'pharmacy_requisition': pharmacy_requisition,
-                'audio_file': audio_filename,
-            }
-            visit_id = patient_storage.save_patient_visit(visit_data)
-            print(f"✓ Patient visit saved: {visit_id}\n")
         
-        # Return all data
+        def event_stream():
+            # Comment line so proxies and the browser see the stream open immediately
+            yield ": stream opened\n\n"
+            with record_usage() as usage:
+                try:
+                    for event in soap_generator.stream_soap_note(transcription):
+                        name = event.pop('event')
+                        yield _sse_event(name, event)
+                    yield _sse_event('done', {'success': True})
+                except Exception as e:
+                    print(f"❌ SOAP stream failed: {str(e)}")
+                    yield _sse_event('error', {'error': str(e)})
+            usage_ledger.record(usage.calls)
+        
+        response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # disable nginx buffering
+        return response
+        
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+@csrf_exempt
+@permission_classes([AllowAny])
+def api_submit_processing_job(request):
+    """Queue a transcription for background processing and return its job ID"""
+    try:
+        data = json.loads(request.body)
+        transcription = data.get('transcription', '')
+        audio_filename = data.get('audio_file', '')
+        
+        if not transcription:
+            return Response({'error': 'No transcription provided'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            job = job_queue.submit(transcription, audio_filename)
+        except JobQueueFull as e:
+            return Response({
+                'error': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        
+        print(f"✓ Job queued: {job.job_id}")
         return Response({
             'success': True,
-            'transcription': transcription,
-            'patient_data': patient_data,
-            'soap_note': soap_note,
-            'clinical_data': clinical_data,
-            'lab_requisition': lab_requisition,
-            'pharmacy_requisition': pharmacy_requisition,
-            'metadata': {
-                'generated_at': datetime.now().isoformat(),
-                'audio_file': audio_filename,
-                'timestamp': timestamp
-            }
+            'job_id': job.job_id,
+            'status': job.status,
+            'status_url': f'/api/process/jobs/{job.job_id}/'
+        }, status=status.HTTP_202_ACCEPTED)
+        
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def api_get_processing_job(request, job_id):
+    """Status of a background processing job, with its result once finished"""
+    try:
+        job = job_queue.get(job_id)
+        if job is None:
+            return Response({
+                'error': 'Job not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response({
+            'success': True,
+            'job': job.to_dict()
         })
+    except Exception as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# Async endpoints - served natively when running under ASGI (MedFlowApp/asgi.py),
+# so a slow Whisper or gpt-4o call does not hold a worker thread.
+# DRF function views cannot be coroutines, so these are plain Django views.
+
+async def api_transcribe_audio_async(request):
+    """Transcribe audio file - async API version"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    
+    try:
+        audio_file = request.FILES.get('audio')
+        if not audio_file:
+            return JsonResponse({'error': 'No audio file provided'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        audio_filename, audio_path, original_extension, content_hash = await sync_to_async(_save_uploaded_audio)(audio_file)
+        
+        cached = await sync_to_async(transcript_cache.lookup)(content_hash)
+        if cached is not None:
+            return JsonResponse({
+                'success': True,
+                'transcription': cached.transcription,
+                'audio_file': cached.audio_file,
+                'segments': cached.segments,
+                'cached': True
+            })
+        
+        try:
+            transcription = await transcriber.atranscribe(audio_path, audio_filename, original_extension)
+            await sync_to_async(transcript_cache.store)(
+                content_hash, audio_filename, transcription, audio_path.stat().st_size
+            )
+            
+            transcription_text = transcription['text']
+            print(f"✓ Transcription successful ({transcription['segments']} segment(s), {transcription['seconds']}s)")
+            print(f"  Length: {len(transcription_text)} characters\n")
+            
+            return JsonResponse({
+                'success': True,
+                'transcription': transcription_text,
+                'audio_file': audio_filename,
+                'segments': transcription['segments']
+            })
+            
+        except Exception as e:
+            print(f"❌ Transcription failed: {str(e)}")
+            return JsonResponse({
+                'error': f'Transcription failed: {str(e)}'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        return JsonResponse({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+async def api_process_transcription_async(request):
+    """Process transcription through all agents - async API version"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    
+    try:
+        data = json.loads(request.body)
+        transcription = data.get('transcription', '')
+        audio_filename = data.get('audio_file', '')
+        run_id = data.get('run_id') or None
+        
+        if not transcription and not run_id:
+            return JsonResponse({'error': 'No transcription provided'}, status=status.HTTP_400_BAD_REQUEST)
         
+        payload = await arun_consultation_pipeline(transcription, audio_filename, run_id, create=False)
+        return JsonResponse(payload)
+        
+    except PipelineIncomplete as e:
+        return JsonResponse(e.payload, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except PipelineRunNotFound as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         print(f"❌ Error: {str(e)}")
         import traceback
         traceback.print_exc()
-        return Response({
+        return JsonResponse({
             'error': str(e)
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+# csrf_exempt() wraps views in a sync function on Django 3.2, which would hide
+# the coroutine from the handler, so the flag is set directly instead
+api_transcribe_audio_async.csrf_exempt = True
+api_process_transcription_async.csrf_exempt = True
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def api_health_check(request):
@@ -279,17 +582,124 @@ def api_health_check(request):
     })
 
 
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def api_llm_cache_stats(request):
+    """Hit/miss counters and size of the shared LLM response cache"""
+    try:
+        from llm_cache import llm_cache
+        return Response({
+            'success': True,
+            'cache': llm_cache.stats()
+        })
+    except Exception as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def api_llm_policy_stats(request):
+    """Retry, hedge, fallback and deadline rates per prompt category, and the rate limit budgets"""
+    try:
+        from llm_policy import llm_policies
+        from rate_limiter import rate_limiter
+        return Response({
+            'success': True,
+            'policy': llm_policies.stats(),
+            'rate_limits': rate_limiter.stats()
+        })
+    except Exception as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def api_order_prefilter_stats(request):
+    """How often the lab and pharmacy agents were skipped, and how often a sampled skip was wrong"""
+    try:
+        from order_prefilter import order_prefilter
+        return Response({
+            'success': True,
+            'prefilter': order_prefilter.stats()
+        })
+    except Exception as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def api_transcript_cache_stats(request):
+    """Hit/miss counters of the audio transcript cache"""
+    try:
+        return Response({
+            'success': True,
+            'cache': transcript_cache.stats()
+        })
+    except Exception as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def api_usage_report(request):
+    """Token usage and cost totals by prompt category, model and day (or visit)"""
+    try:
+        start = request.GET.get('start')
+        end = request.GET.get('end')
+        group_by = request.GET.get('group_by', 'category,model,day')
+        report = usage_ledger.report(
+            start=datetime.strptime(start, '%Y-%m-%d').date() if start else None,
+            end=datetime.strptime(end, '%Y-%m-%d').date() if end else None,
+            group_by=[g.strip() for g in group_by.split(',') if g.strip()]
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    return Response({
+        'success': True,
+        'report': report
+    })
+
+
+@require_GET
+def api_metrics(request):
+    """Request, agent, Whisper and storage timings of every worker, in Prometheus text format"""
+    # A plain Django view: DRF content negotiation would turn away Prometheus' Accept header
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def api_get_all_patients(request):
-    """Get all patients"""
+    """
+    Get patients, one page at a time with ``limit`` (the next page with the
+    returned ``next_cursor``), sorted with ``sort``/``order`` and filtered on
+    the last visit with ``since``/``until``. Without ``limit`` every patient is returned.
+    """
     try:
-        patients = patient_storage.get_all_patients()
+        patients, next_cursor = patient_storage.list_patients(**patient_query(request.query_params))
         return Response({
             'success': True,
             'patients': patients,
-            'count': len(patients)
+            'count': len(patients),
+            'next_cursor': next_cursor
         })
+    except ValueError as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({
             'error': str(e)
@@ -320,25 +730,55 @@ def api_get_patient(request, patient_name):
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def api_get_patient_visits(request, patient_name):
-    """Get all visits for a patient"""
+    """
+    Get a patient's visits, newest first unless ``order=asc``, paged like the
+    patient list and filtered with ``since``/``until``, ``has_lab_orders`` and
+    ``has_prescriptions``
+    """
     try:
-        visits = patient_storage.get_patient_visits(patient_name)
+        visits, next_cursor = patient_storage.list_patient_visits(patient_name, **visit_query(request.query_params))
         return Response({
             'success': True,
             'visits': visits,
-            'count': len(visits)
+            'count': len(visits),
+            'next_cursor': next_cursor
         })
+    except ValueError as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({
             'error': str(e)
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@api_view(['PUT'])
+@api_view(['GET', 'PUT'])
 @permission_classes([AllowAny])
-def api_update_patient_visit(request, patient_name, visit_id):
-    """Update a patient visit record"""
+def api_patient_visit(request, patient_name, visit_id):
+    """
+    GET a full visit record (``fields`` projects it like the visit listing),
+    or PUT an update of it. With ``?recompute=true`` the agents whose inputs
+    the edit changed are rerun and their outputs saved with it.
+    """
     try:
+        if request.method == 'GET':
+            try:
+                fields = fields_query(request.query_params)
+            except ValueError as e:
+                return Response({
+                    'error': str(e)
+                }, status=status.HTTP_400_BAD_REQUEST)
+            visit = patient_storage.get_patient_visit(patient_name, visit_id)
+            if visit is None:
+                return Response({
+                    'error': 'Visit not found'
+                }, status=status.HTTP_404_NOT_FOUND)
+            return Response({
+                'success': True,
+                'visit': project(visit, fields)
+            })
+        
         updated_data = request.data
         
         # Validate that we have data to update
@@ -347,6 +787,23 @@ def api_update_patient_visit(request, patient_name, visit_id):
                 'error': 'No data provided for update'
             }, status=status.HTTP_400_BAD_REQUEST)
         
+        if request.query_params.get('recompute', '').lower() in ('1', 'true', 'yes'):
+            try:
+                recomputed = recompute_visit(patient_name, visit_id, dict(updated_data))
+            except VisitChanged as e:
+                return Response({
+                    'error': str(e)
+                }, status=status.HTTP_409_CONFLICT)
+            if recomputed is None:
+                return Response({
+                    'error': 'Visit not found'
+                }, status=status.HTTP_404_NOT_FOUND)
+            return Response({
+                'success': True,
+                'message': 'Visit updated successfully',
+                **recomputed
+            })
+        
         # Update the visit
         success = patient_storage.update_patient_visit(patient_name, visit_id, updated_data)
         
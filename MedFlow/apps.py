@@ -1,6 +1,59 @@
+import os
+import sys
+from pathlib import Path
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+# Programs that run management commands, of which only runserver serves requests
+MANAGEMENT_PROGRAMS = ('manage.py', 'django-admin', 'django-admin.py', '__main__.py')
+
+
+def enable_sqlite_wal(sender, connection, **kwargs):
+    """Let requests read while another worker writes, instead of waiting for its lock"""
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+
+
+def serving_requests() -> bool:
+    """
+    Whether this process is about to serve requests: run by a WSGI/ASGI
+    server, or runserver's serving process (not its autoreloader, nor any
+    other management command)
+    """
+    if os.path.basename(sys.argv[0] if sys.argv else '') not in MANAGEMENT_PROGRAMS:
+        return True
+    if sys.argv[1:2] != ['runserver']:
+        return False
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
 
 
 class MedflowConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'MedFlow'
+
+    def ready(self):
+        # Agents live in src/ and import each other as top-level modules
+        src_path = str(Path(__file__).parent / 'src')
+        if src_path not in sys.path:
+            sys.path.insert(0, src_path)
+
+        connection_created.connect(enable_sqlite_wal, dispatch_uid='medflow_sqlite_wal')
+
+        # Jobs queued before a restart are picked up without waiting for a request
+        if settings.MEDFLOW_JOB_AUTOSTART and serving_requests():
+            from .jobs import job_queue
+            try:
+                job_queue.start()
+            except Exception as e:
+                # E.g. before the first migrate; submitting a job starts the pool later
+                print(f"⚠️  Job queue not started: {str(e)}")
+
+        # Build the shared OpenAI client now rather than on the first request.
+        # Management commands that never call the API work without a key.
+        if os.getenv('OPENAI_API_KEY'):
+            from llm_client import llm_clients
+            llm_clients.warm()
@@ -0,0 +1,182 @@
+"""
+Background processing queue for /api/process/ jobs
+
+Jobs are rows in the existing SQLite database, so they survive restarts and are
+visible to every worker process. Each process runs a small pool of threads that
+claim queued jobs atomically and run them through the same code path as the
+synchronous endpoint, so finished results land in patient_storage as before.
+"""
+import os
+import socket
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import ProcessingJob
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting"""
+
+
+class JobQueue:
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, workers: int = None, max_depth: int = None, poll_interval: float = None):
+        self.workers = workers or getattr(settings, 'MEDFLOW_JOB_WORKERS', 2)
+        self.max_depth = max_depth or getattr(settings, 'MEDFLOW_JOB_QUEUE_DEPTH', 100)
+        self.poll_interval = poll_interval or getattr(settings, 'MEDFLOW_JOB_POLL_INTERVAL', 1.0)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._pid = None
+
+    @property
+    def worker_id(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        """Start this process's worker threads (idempotent, and fork-aware)"""
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._requeue_orphans()
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker_loop,
+                    name=f'medflow-job-worker-{i}',
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            print(f"✓ Job queue started: {self.workers} workers ({self.worker_id})")
+
+    def submit(self, transcription: str, audio_file: str = '') -> ProcessingJob:
+        # Also covers server processes forked after startup (e.g. gunicorn --preload)
+        if getattr(settings, 'MEDFLOW_JOB_AUTOSTART', True):
+            self.start()
+
+        depth = ProcessingJob.objects.filter(status=ProcessingJob.STATUS_QUEUED).count()
+        if depth >= self.max_depth:
+            raise JobQueueFull(f"Job queue is full ({depth} jobs waiting)")
+
+        job = ProcessingJob.objects.create(
+            transcription=transcription,
+            audio_file=audio_file or ''
+        )
+        self._wakeup.set()
+        return job
+
+    def get(self, job_id: str):
+        return ProcessingJob.objects.filter(job_id=job_id).first()
+
+    def stats(self):
+        counts = {choice: 0 for choice, _ in ProcessingJob.STATUS_CHOICES}
+        for row in ProcessingJob.objects.values('status').annotate(count=Count('job_id')):
+            counts[row['status']] = row['count']
+        return {
+            'workers': self.workers,
+            'max_depth': self.max_depth,
+            'running_locally': self._pid == os.getpid() and bool(self._threads),
+            'jobs': counts,
+        }
+
+    def _worker_loop(self):
+        while True:
+            try:
+                job = self._claim_next()
+            except Exception as e:
+                print(f"❌ Job queue error: {str(e)}")
+                job = None
+            finally:
+                close_old_connections()
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self._execute(job)
+
+    def _claim_next(self):
+        candidates = ProcessingJob.objects.filter(
+            status=ProcessingJob.STATUS_QUEUED
+        ).order_by('created_at').values_list('job_id', flat=True)[:10]
+
+        for job_id in candidates:
+            # Only one worker anywhere wins the conditional update
+            claimed = ProcessingJob.objects.filter(
+                job_id=job_id,
+                status=ProcessingJob.STATUS_QUEUED
+            ).update(
+                status=ProcessingJob.STATUS_RUNNING,
+                worker=self.worker_id,
+                started_at=timezone.now(),
+                attempts=F('attempts') + 1
+            )
+            if claimed:
+                return ProcessingJob.objects.get(job_id=job_id)
+        return None
+
+    def _execute(self, job: ProcessingJob):
+        from .processing import run_consultation_pipeline
+
+        print(f"\n▶ Job {job.job_id} started (attempt {job.attempts})")
+        try:
+            # The job ID doubles as the run ID, so a requeued job resumes from its checkpoints
+            job.result = run_consultation_pipeline(job.transcription, job.audio_file, run_id=job.job_id)
+            job.status = ProcessingJob.STATUS_SUCCEEDED
+            print(f"✓ Job {job.job_id} succeeded")
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = ProcessingJob.STATUS_FAILED
+            print(f"❌ Job {job.job_id} failed: {str(e)}")
+        finally:
+            job.finished_at = timezone.now()
+            try:
+                job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+            finally:
+                close_old_connections()
+
+    def _requeue_orphans(self):
+        """Put back jobs whose worker process on this host died mid-run"""
+        hostname = socket.gethostname()
+        running = ProcessingJob.objects.filter(
+            status=ProcessingJob.STATUS_RUNNING,
+            worker__startswith=f"{hostname}:"
+        )
+        for job in running:
+            pid = int(job.worker.rsplit(':', 1)[1])
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+
+            if job.attempts >= self.MAX_ATTEMPTS:
+                job.status = ProcessingJob.STATUS_FAILED
+                job.error = f"Worker died {job.attempts} times while running this job"
+                job.finished_at = timezone.now()
+            else:
+                job.status = ProcessingJob.STATUS_QUEUED
+                job.worker = ''
+            job.save(update_fields=['status', 'worker', 'error', 'finished_at'])
+            print(f"↺ Job {job.job_id} recovered as {job.status}")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Singleton instance
+job_queue = JobQueue()
@@ -0,0 +1,189 @@
+"""
+Pagination, sorting and filtering of patient and visit listings
+
+Both storage backends page with keyset cursors: a cursor holds the sort value
+and key of the last item returned, so the next page starts right after it
+whatever was saved in between, and a page costs the same at any depth.
+Cursors are opaque to clients and only valid with the sort they came from.
+"""
+import json
+import base64
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+# Sort fields of the patient listing and their default order
+PATIENT_SORTS = {'last_visit': 'desc', 'name': 'asc', 'visit_count': 'desc'}
+# What a cursor holds after its sort: the sort value and the patient key, or the visit ID
+PATIENT_CURSOR_TYPES = {'last_visit': (str, str), 'name': (str, str), 'visit_count': (int, str)}
+VISIT_CURSOR_TYPES = (str,)
+ORDERS = ('asc', 'desc')
+MAX_LIMIT = 500
+
+# What a visit listing returns with ``view=headers``; stored apart from the visits
+HEADER_FIELDS = ('visit_id', 'timestamp', 'patient_mrn', 'assessment_snippet', 'has_lab_orders', 'has_prescriptions')
+# Fields of a full visit that its header holds too, so projections onto them need no visit file
+HEADER_RECORD_FIELDS = ('visit_id', 'timestamp', 'patient_mrn')
+SNIPPET_LENGTH = 160
+
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, *expected, types: Tuple[type, ...]) -> list:
+    """
+    The values of ``cursor``, which must start with ``expected`` (the sort it
+    was made for) followed by one value of each of ``types``
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) <= len(expected) or values[:len(expected)] != list(expected):
+        raise ValueError('Cursor does not match the requested sort')
+    values = values[len(expected):]
+    # Compared with the stored keys, which a value of another type would break (True is an int too)
+    if len(values) != len(types) or not all(
+        isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(values, types)
+    ):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def visit_has_lab_orders(visit: Dict[str, Any]) -> bool:
+    requisition = visit.get('lab_requisition')
+    return bool(requisition) and requisition.get('request_type') != 'none'
+
+
+def visit_has_prescriptions(visit: Dict[str, Any]) -> bool:
+    requisition = visit.get('pharmacy_requisition')
+    return bool(requisition) and requisition.get('request_type') != 'none'
+
+
+def visit_header(visit: Dict[str, Any]) -> Dict[str, Any]:
+    """The header of a visit: when it was, whose it was, a glimpse of the assessment and what it ordered"""
+    soap_note = visit.get('soap_note')
+    assessment = soap_note.get('assessment') if isinstance(soap_note, dict) else None
+    snippet = ' '.join(str(assessment or '').split())
+    if len(snippet) > SNIPPET_LENGTH:
+        snippet = snippet[:SNIPPET_LENGTH].rsplit(' ', 1)[0] + '…'
+    return {
+        'visit_id': visit.get('visit_id', ''),
+        'timestamp': visit.get('timestamp', ''),
+        'patient_mrn': visit.get('patient_mrn', ''),
+        'assessment_snippet': snippet,
+        'has_lab_orders': visit_has_lab_orders(visit),
+        'has_prescriptions': visit_has_prescriptions(visit),
+    }
+
+
+def project(record: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """
+    ``record`` cut down to ``fields``, dotted paths keeping the nesting
+    (``soap_note.assessment`` gives ``{"soap_note": {"assessment": ...}}``).
+    Missing fields are left out; the visit ID is always kept.
+    """
+    if not fields:
+        return record
+    projected = {'visit_id': record['visit_id']} if 'visit_id' in record else {}
+    for field in fields:
+        source = record
+        *parents, name = field.split('.')
+        for parent in parents:
+            source = source.get(parent) if isinstance(source, dict) else None
+        if not isinstance(source, dict) or name not in source:
+            continue
+        target = projected
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[name] = source[name]
+    return projected
+
+
+def until_bound(until: str) -> str:
+    """Exclusive upper bound for ISO timestamps up to ``until``: a date includes the whole day"""
+    return until + '\uffff'
+
+
+def in_range(timestamp: str, since: Optional[str], until: Optional[str]) -> bool:
+    return (since is None or timestamp >= since) and (until is None or timestamp < until_bound(until))
+
+
+def patient_query(params) -> Dict[str, Any]:
+    """Keyword arguments of ``list_patients`` from request query parameters"""
+    sort = params.get('sort', 'last_visit')
+    if sort not in PATIENT_SORTS:
+        raise ValueError(f"sort must be one of {', '.join(PATIENT_SORTS)}")
+    query = _common_query(params, PATIENT_SORTS[sort])
+    query['sort'] = sort
+    return query
+
+
+def visit_query(params) -> Dict[str, Any]:
+    """Keyword arguments of ``list_patient_visits`` from request query parameters"""
+    query = _common_query(params, 'desc')
+    for name in ('has_lab_orders', 'has_prescriptions'):
+        query[name] = _boolean(params, name)
+    view = params.get('view', 'full')
+    if view not in ('full', 'headers'):
+        raise ValueError("view must be 'full' or 'headers'")
+    query['headers'] = view == 'headers'
+    query['fields'] = fields_query(params)
+    return query
+
+
+def fields_query(params) -> Optional[List[str]]:
+    """The ``fields`` projection of a request (comma-separated, dotted for nested fields), or None"""
+    value = params.get('fields')
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    if any(not all(field.split('.')) for field in fields):
+        raise ValueError('fields must be comma-separated field names, e.g. timestamp,soap_note.assessment')
+    return fields
+
+
+def _common_query(params, default_order: str) -> Dict[str, Any]:
+    order = params.get('order', default_order)
+    if order not in ORDERS:
+        raise ValueError("order must be 'asc' or 'desc'")
+
+    limit = params.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError('limit must be an integer')
+        if limit < 1:
+            raise ValueError('limit must be at least 1')
+        limit = min(limit, MAX_LIMIT)
+
+    return {
+        'order': order,
+        'limit': limit,
+        'cursor': params.get('cursor') or None,
+        'since': _date(params, 'since'),
+        'until': _date(params, 'until'),
+    }
+
+
+def _date(params, name: str) -> Optional[str]:
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO date or datetime, e.g. 2025-01-31")
+    return value
+
+
+def _boolean(params, name: str) -> Optional[bool]:
+    value = params.get(name)
+    if value is None or value == '':
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f"{name} must be true or false")
@@ -0,0 +1,120 @@
+import json
+import time
+import statistics
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from llm_cache import llm_cache
+from llm_client import record_usage
+from pipeline import PIPELINE_MODES, build_pipeline_stages, pipeline_executor
+
+
+SAMPLE_TRANSCRIPTION = """
+Doctor: Good morning! Your full name?
+Patient: Jennifer Martinez. Date of birth April 8th, 1985.
+Doctor: Any allergies? Current medications?
+Patient: Penicillin. Lisinopril 10mg daily.
+Doctor: Blood pressure 145 over 92, heart rate 82. What brings you in?
+Patient: Headaches for about a week, mostly afternoons, and I'm tired all the time.
+Doctor: Neurological exam normal. Your headaches are related to elevated blood pressure.
+I'm increasing your Lisinopril to 20mg daily and adding Amlodipine 5mg once daily.
+I'm ordering a basic metabolic panel and complete blood count. Come back in two weeks.
+"""
+
+
+class Command(BaseCommand):
+    help = "Compare latency and token usage of the multi-call and fused pipeline modes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', default=','.join(PIPELINE_MODES),
+                            help='Comma-separated modes to run (default: multi,fused)')
+        parser.add_argument('--runs', type=int, default=3,
+                            help='Runs per mode and transcription (default: 3)')
+        parser.add_argument('--transcription-file', action='append', default=[],
+                            help='Transcription text file, may be repeated (default: built-in sample)')
+        parser.add_argument('--use-cache', action='store_true',
+                            help='Keep the LLM response cache on (cached runs make no API calls)')
+        parser.add_argument('--output', help='Write the raw runs and summary to this JSON file')
+
+    def handle(self, *args, **options):
+        modes = [m.strip() for m in options['modes'].split(',') if m.strip()]
+        for mode in modes:
+            if mode not in PIPELINE_MODES:
+                raise CommandError(f"Unknown mode '{mode}', expected one of {', '.join(PIPELINE_MODES)}")
+
+        transcriptions = [Path(p).read_text() for p in options['transcription_file']] or [SAMPLE_TRANSCRIPTION]
+
+        if not options['use_cache']:
+            # Otherwise every run after the first measures a cache lookup
+            llm_cache.enabled = False
+
+        runs = []
+        for index, transcription in enumerate(transcriptions):
+            for mode in modes:
+                for run in range(options['runs']):
+                    runs.append(self._run_once(mode, index, run, transcription))
+
+        summary = {mode: self._summarize([r for r in runs if r['mode'] == mode]) for mode in modes}
+        self._print_summary(summary)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'summary': summary, 'runs': runs}, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def _run_once(self, mode, index, run, transcription):
+        record = {'mode': mode, 'transcription': index, 'run': run}
+        with record_usage() as usage:
+            started = time.perf_counter()
+            try:
+                result = pipeline_executor.run(build_pipeline_stages(mode), {'transcription': transcription})
+                record['stages'] = result.timing_summary()['stages']
+                record['error'] = None
+            except Exception as e:
+                record['error'] = str(e)
+            record['seconds'] = round(time.perf_counter() - started, 3)
+        record.update(usage.totals())
+
+        status = 'error: ' + record['error'] if record['error'] else f"{record['total_tokens']} tokens"
+        self.stdout.write(f"  {mode:<6} transcription {index} run {run}: {record['seconds']:.2f}s, {status}")
+        return record
+
+    def _summarize(self, runs):
+        ok = [r for r in runs if not r['error']]
+        if not ok:
+            return {'runs': len(runs), 'errors': len(runs)}
+
+        latencies = sorted(r['seconds'] for r in ok)
+        return {
+            'runs': len(runs),
+            'errors': len(runs) - len(ok),
+            'latency_mean': round(statistics.mean(latencies), 3),
+            'latency_p50': round(statistics.median(latencies), 3),
+            'latency_min': latencies[0],
+            'latency_max': latencies[-1],
+            'calls_mean': round(statistics.mean(r['calls'] for r in ok), 2),
+            'prompt_tokens_mean': round(statistics.mean(r['prompt_tokens'] for r in ok), 1),
+            'completion_tokens_mean': round(statistics.mean(r['completion_tokens'] for r in ok), 1),
+            'total_tokens_mean': round(statistics.mean(r['total_tokens'] for r in ok), 1),
+        }
+
+    def _print_summary(self, summary):
+        self.stdout.write("")
+        self.stdout.write(f"{'mode':<8}{'runs':>6}{'errors':>8}{'mean s':>9}{'p50 s':>9}{'calls':>7}{'prompt':>9}{'compl.':>9}{'total':>9}")
+        for mode, s in summary.items():
+            if 'latency_mean' not in s:
+                self.stdout.write(f"{mode:<8}{s['runs']:>6}{s['errors']:>8}")
+                continue
+            self.stdout.write(
+                f"{mode:<8}{s['runs']:>6}{s['errors']:>8}{s['latency_mean']:>9.2f}{s['latency_p50']:>9.2f}"
+                f"{s['calls_mean']:>7.1f}{s['prompt_tokens_mean']:>9.0f}{s['completion_tokens_mean']:>9.0f}{s['total_tokens_mean']:>9.0f}"
+            )
+
+        multi, fused = summary.get('multi', {}), summary.get('fused', {})
+        if 'latency_mean' in multi and 'latency_mean' in fused:
+            latency = (fused['latency_mean'] - multi['latency_mean']) / multi['latency_mean'] * 100
+            tokens = (fused['total_tokens_mean'] - multi['total_tokens_mean']) / (multi['total_tokens_mean'] or 1) * 100
+            self.stdout.write(self.style.SUCCESS(
+                f"\nFused vs multi: latency {latency:+.1f}%, total tokens {tokens:+.1f}%"
+            ))
@@ -0,0 +1,307 @@
+import gc
+import json
+import random
+import shutil
+import socket
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from MedFlow.patient_storage import PatientStorage
+from MedFlow.patient_db_storage import DatabasePatientStorage
+
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David',
+               'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez',
+              'Martinez', 'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore']
+COMPLAINTS = ['headaches for about a week', 'persistent cough', 'lower back pain', 'fatigue and dizziness',
+              'chest tightness on exertion', 'recurring heartburn', 'joint pain in both knees']
+MEDICATIONS = [('Lisinopril', '20mg'), ('Amlodipine', '5mg'), ('Metformin', '500mg'), ('Atorvastatin', '40mg'),
+               ('Omeprazole', '20mg'), ('Ibuprofen', '400mg')]
+LAB_TESTS = ['Basic Metabolic Panel', 'Complete Blood Count', 'Lipid Panel', 'Hemoglobin A1c', 'TSH']
+
+OPERATIONS = ['save', 'list_all', 'get_summary', 'get_visits', 'update']
+
+
+def make_storage(backend: str, directory: Path):
+    """Storage backends the benchmark can drive, all behind the PatientStorage API"""
+    if backend == 'json':
+        return PatientStorage(directory)
+    if backend == 'database':
+        # A scratch SQLite file per scale, never the application's database
+        directory.mkdir(parents=True, exist_ok=True)
+        alias = f'benchmark_{directory.name}'
+        connections.databases[alias] = {
+            **connections.databases['default'],
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': str(directory / 'benchmark.sqlite3'),
+        }
+        call_command('migrate', 'MedFlow', database=alias, verbosity=0)
+        return DatabasePatientStorage(using=alias)
+    raise CommandError(f"Unknown storage backend '{backend}'")
+
+
+def synthetic_visit(rng: random.Random, patient_name: str, mrn: str) -> dict:
+    """A visit shaped like the ones /api/process/ saves, with realistic text sizes"""
+    medication, strength = rng.choice(MEDICATIONS)
+    complaint = rng.choice(COMPLAINTS)
+    tests = rng.sample(LAB_TESTS, 2)
+    systolic, diastolic = rng.randint(110, 160), rng.randint(70, 100)
+    age = rng.randint(18, 90)
+
+    transcription = (
+        f"Doctor: Good morning, what brings you in today? Patient: I've had {complaint}. "
+        f"Doctor: Blood pressure {systolic} over {diastolic}. I'm starting {medication} {strength} daily "
+        f"and ordering a {tests[0]} and {tests[1]}. Come back in two weeks. "
+    ) * 6
+
+    return {
+        'patient_name': patient_name,
+        'patient_mrn': mrn,
+        'transcription': transcription,
+        'patient_data': {
+            'personal_info': {'full_name': patient_name, 'age': age, 'gender': rng.choice(['female', 'male'])},
+            'identifiers': {'patient_id': mrn},
+        },
+        'soap_note': {
+            'subjective': f"Patient reports {complaint}. " * 4,
+            'objective': f"BP {systolic}/{diastolic} mmHg, HR {rng.randint(55, 100)} bpm. Exam unremarkable.",
+            'assessment': f"Symptoms consistent with {rng.choice(['hypertension', 'GERD', 'osteoarthritis'])}.",
+            'plan': f"Start {medication} {strength} daily. Order {tests[0]} and {tests[1]}. Follow up in 2 weeks.",
+        },
+        'clinical_data': {
+            'vital_signs': {'blood_pressure': {'value': f"{systolic}/{diastolic}", 'unit': 'mmHg'}},
+            'medications': [{'name': medication, 'dosage': strength, 'frequency': 'once daily'}],
+            'diagnoses': ['hypertension'],
+        },
+        'lab_requisition': {
+            'requisition_type': 'laboratory_test_request',
+            'test_details': {'tests_requested': [{'test_name': t} for t in tests]},
+        },
+        'pharmacy_requisition': {
+            'requisition_type': 'pharmacy_prescription_request',
+            'prescription_details': {
+                'prescriptions': [{'medication_name': medication, 'strength': strength, 'frequency': 'once daily'}]
+            },
+        },
+        'audio_file': '',
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = "Benchmark patient storage latency and memory at configurable scale"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='10000',
+                            help='Comma-separated patient counts (e.g. 10000,50000,100000)')
+        parser.add_argument('--visits', type=int, default=3, help='Visits per synthetic patient (default: 3)')
+        parser.add_argument('--samples', type=int, default=200,
+                            help='Timed calls per operation, list-all excepted (default: 200)')
+        parser.add_argument('--list-runs', type=int, default=5, help='Timed list-all calls (default: 5)')
+        parser.add_argument('--backend', default='json', choices=['json', 'database'],
+                            help='Storage backend to benchmark (default: json)')
+        parser.add_argument('--data-dir', help='Where to generate data (default: a temporary directory)')
+        parser.add_argument('--keep-data', action='store_true', help='Do not delete the generated data')
+        parser.add_argument('--seed', type=int, default=1234)
+        parser.add_argument('--output', default='storage_benchmark.json', help='Results file (JSON)')
+        parser.add_argument('--compare', help='Earlier results file to compare against')
+
+    def handle(self, *args, **options):
+        scales = [int(s) for s in options['scales'].split(',') if s.strip()]
+        results = {
+            'meta': self._meta(options, scales),
+            'scales': {},
+        }
+
+        for scale in scales:
+            base = Path(options['data_dir']) if options['data_dir'] else Path(tempfile.mkdtemp(prefix='medflow-bench-'))
+            directory = base / f"{options['backend']}_{scale}"
+            if directory.exists():
+                shutil.rmtree(directory)
+            try:
+                results['scales'][str(scale)] = self._run_scale(scale, directory, options)
+            finally:
+                if not options['keep_data']:
+                    shutil.rmtree(directory, ignore_errors=True)
+                    if not options['data_dir']:
+                        shutil.rmtree(base, ignore_errors=True)
+
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"\nResults written to {options['output']}"))
+
+        if options['compare']:
+            self._compare(options['compare'], results)
+
+    def _meta(self, options, scales):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, cwd=Path(__file__).resolve().parent
+            ).stdout.strip()
+        except OSError:
+            commit = ''
+        return {
+            'backend': options['backend'],
+            'commit': commit,
+            'generated_at': datetime.now().isoformat(),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scales': scales,
+            'visits_per_patient': options['visits'],
+            'samples': options['samples'],
+            'list_runs': options['list_runs'],
+            'seed': options['seed'],
+        }
+
+    def _run_scale(self, scale, directory, options):
+        rng = random.Random(options['seed'])
+        storage = make_storage(options['backend'], directory)
+        patients = [
+            (f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i:06d}", f"MRN-{i:06d}")
+            for i in range(scale)
+        ]
+
+        self.stdout.write(f"\n[{scale} patients] Generating {scale * options['visits']} visits in {directory}...")
+        started = time.perf_counter()
+        save_samples = self._seed(storage, patients, options['visits'], rng)
+        seed_seconds = time.perf_counter() - started
+        self.stdout.write(f"  generated in {seed_seconds:.1f}s")
+
+        sample_patients = rng.sample(patients, min(options['samples'], scale))
+        visit_ids = {}
+        for name, _ in sample_patients:
+            visits = storage.get_patient_visits(name)
+            visit_ids[name] = visits[0]['visit_id'] if visits else None
+
+        calls = {
+            'save': None,
+            'list_all': [lambda: storage.get_all_patients()] * options['list_runs'],
+            'get_summary': [lambda n=name: storage.get_patient_summary(n) for name, _ in sample_patients],
+            'get_visits': [lambda n=name: storage.get_patient_visits(n) for name, _ in sample_patients],
+            'update': [
+                lambda n=name: storage.update_patient_visit(n, visit_ids[n], {'notes': 'benchmark update'})
+                for name, _ in sample_patients if visit_ids[name]
+            ],
+        }
+
+        operations = {'save': self._stats(save_samples[-options['samples']:])}
+        for operation in OPERATIONS[1:]:
+            operations[operation] = self._measure(calls[operation])
+
+        # Memory is measured in a separate pass, tracemalloc slows every allocation
+        memory_calls = {
+            'save': [lambda: storage.save_patient_visit(synthetic_visit(rng, *patients[0]))],
+            'list_all': calls['list_all'][:1],
+            'get_summary': calls['get_summary'][:1],
+            'get_visits': calls['get_visits'][:1],
+            'update': calls['update'][:1],
+        }
+        for operation, memory_call in memory_calls.items():
+            operations[operation]['peak_memory_kb'] = self._peak_memory(memory_call)
+
+        result = {
+            'patients': scale,
+            'visits': scale * options['visits'],
+            'seed_seconds': round(seed_seconds, 2),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'operations': operations,
+        }
+        self._print_scale(result)
+        return result
+
+    def _seed(self, storage, patients, visits_per_patient, rng):
+        """Save every visit through the storage API, returning each save's latency"""
+        latencies = []
+        for _ in range(visits_per_patient):
+            for name, mrn in patients:
+                record = synthetic_visit(rng, name, mrn)
+                started = time.perf_counter()
+                storage.save_patient_visit(record)
+                latencies.append(time.perf_counter() - started)
+        return latencies
+
+    def _measure(self, calls):
+        latencies = []
+        for call in calls:
+            started = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - started)
+        return self._stats(latencies)
+
+    def _stats(self, latencies):
+        values = sorted(seconds * 1000 for seconds in latencies)
+        if not values:
+            return {'count': 0}
+        return {
+            'count': len(values),
+            'mean_ms': round(sum(values) / len(values), 3),
+            'p50_ms': round(percentile(values, 0.50), 3),
+            'p95_ms': round(percentile(values, 0.95), 3),
+            'p99_ms': round(percentile(values, 0.99), 3),
+            'max_ms': round(values[-1], 3),
+        }
+
+    def _peak_memory(self, calls):
+        if not calls:
+            return None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            for call in calls:
+                call()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return round(peak / 1024, 1)
+
+    def _print_scale(self, result):
+        self.stdout.write(f"  {'operation':<12}{'count':>7}{'mean ms':>11}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'peak KB':>11}")
+        for operation in OPERATIONS:
+            s = result['operations'][operation]
+            if not s.get('count'):
+                continue
+            self.stdout.write(
+                f"  {operation:<12}{s['count']:>7}{s['mean_ms']:>11.2f}{s['p50_ms']:>11.2f}"
+                f"{s['p95_ms']:>11.2f}{s['p99_ms']:>11.2f}{(s.get('peak_memory_kb') or 0):>11.1f}"
+            )
+        self.stdout.write(f"  max RSS: {result['max_rss_mb']} MB")
+
+    def _compare(self, baseline_file, results):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+
+        self.stdout.write(f"\nCompared with {baseline_file} ({baseline['meta'].get('backend')} @ {baseline['meta'].get('commit')}):")
+        for scale, current in results['scales'].items():
+            previous = baseline.get('scales', {}).get(scale)
+            if not previous:
+                continue
+            self.stdout.write(f"  [{scale} patients]")
+            for operation in OPERATIONS:
+                now = current['operations'].get(operation, {})
+                before = previous['operations'].get(operation, {})
+                if not now.get('count') or not before.get('count'):
+                    continue
+                change = (now['p50_ms'] - before['p50_ms']) / (before['p50_ms'] or 1) * 100
+                line = f"    {operation:<12} p50 {before['p50_ms']:.2f} -> {now['p50_ms']:.2f} ms ({change:+.1f}%)"
+                if change > 20:
+                    line = self.style.WARNING(line)
+                self.stdout.write(line)
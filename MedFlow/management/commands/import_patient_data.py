@@ -0,0 +1,99 @@
+import json
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from MedFlow.listing import visit_header
+from MedFlow.models import Patient, Visit
+
+
+class Command(BaseCommand):
+    help = "Copy a JSON patient_data/ tree into the database storage backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=str(Path(__file__).resolve().parents[2] / 'patient_data'),
+                            help='patient_data directory to import (default: MedFlow/patient_data)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Patients written per transaction (default: 500)')
+        parser.add_argument('--database', default='default', help='Database alias to import into')
+
+    def handle(self, *args, **options):
+        source = Path(options['source'])
+        if not source.is_dir():
+            raise CommandError(f"{source} is not a directory")
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        using = options['database']
+
+        patient_dirs = sorted(d for d in source.iterdir() if d.is_dir())
+        # A rerun after an interruption picks up where the last committed batch ended
+        existing = set(Patient.objects.using(using).values_list('key', flat=True))
+        pending = [d for d in patient_dirs if d.name not in existing]
+        self.stdout.write(f"{len(patient_dirs)} patients in {source}, "
+                          f"{len(patient_dirs) - len(pending)} already imported")
+
+        started = time.perf_counter()
+        imported_patients = imported_visits = 0
+        for i in range(0, len(pending), options['batch_size']):
+            batch = [self._read_patient(d) for d in pending[i:i + options['batch_size']]]
+            batch = [patient for patient in batch if patient is not None]
+            with transaction.atomic(using=using):
+                patients = Patient.objects.using(using).bulk_create([patient for patient, _ in batch])
+                # SQLite does not return the primary keys of bulk-created rows
+                ids = dict(Patient.objects.using(using)
+                           .filter(key__in=[p.key for p in patients]).values_list('key', 'id'))
+                visits = [
+                    Visit(patient_id=ids[patient.key], visit_id=record['visit_id'], record=record,
+                          **Visit.header_columns(visit_header(record)))
+                    for patient, records in batch
+                    for record in records
+                ]
+                Visit.objects.using(using).bulk_create(visits, batch_size=options['batch_size'])
+            imported_patients += len(patients)
+            imported_visits += len(visits)
+            self.stdout.write(f"  {imported_patients}/{len(pending)} patients, {imported_visits} visits")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {imported_patients} patients and {imported_visits} visits "
+            f"in {time.perf_counter() - started:.1f}s"
+        ))
+
+    def _read_patient(self, patient_dir: Path):
+        """The Patient row and visit records of one patient directory, or None when it has no visits"""
+        records = []
+        for visit_file in sorted(patient_dir.glob('visit_*.json')):
+            try:
+                with open(visit_file) as f:
+                    record = json.load(f)
+            except (OSError, ValueError) as e:
+                self.stdout.write(self.style.WARNING(f"  ⚠️  Skipping {visit_file}: {e}"))
+                continue
+            record.setdefault('visit_id', visit_file.stem)
+            records.append(record)
+        if not records:
+            return None
+
+        summary = {}
+        summary_file = patient_dir / 'patient_summary.json'
+        if summary_file.exists():
+            with open(summary_file) as f:
+                summary = json.load(f)
+
+        # Missing summary fields are rebuilt from the visits, as saving them would have
+        demographics = next(
+            (r['patient_data']['personal_info'] for r in reversed(records)
+             if 'personal_info' in (r.get('patient_data') or {})),
+            None
+        )
+        patient = Patient(
+            key=patient_dir.name,
+            name=summary.get('patient_name') or records[0].get('patient_name', patient_dir.name),
+            mrn=summary.get('mrn', records[0].get('patient_mrn', '')),
+            first_visit=summary.get('first_visit', records[0].get('timestamp', '')),
+            last_visit=summary.get('last_visit', records[-1].get('timestamp', '')),
+            visit_count=len(records),
+            demographics=summary.get('demographics', demographics),
+        )
+        return patient, records
@@ -0,0 +1,327 @@
+import io
+import os
+import json
+import math
+import time
+import random
+import struct
+import tempfile
+import threading
+import wave
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+
+from MedFlow.mock_openai import LatencyProfile, MockOpenAIServer, SAMPLE_TRANSCRIPT
+
+
+ENDPOINTS = {
+    'transcribe': '/api/transcribe/',
+    'process': '/api/process/',
+    'async-transcribe': '/api/async/transcribe/',
+    'async-process': '/api/async/process/',
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def latency_summary(values):
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for p in PERCENTILES:
+        value = percentile(values, p)
+        summary[f'p{p}'] = round(value, 3) if value is not None else None
+    return summary
+
+
+def noise_wav(seconds: float = 1.0, rate: int = 16000) -> bytes:
+    """A short WAV of random noise, different on every call so the transcript cache never hits"""
+    samples = [random.randint(-3000, 3000) for _ in range(int(seconds * rate))]
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(struct.pack(f'<{len(samples)}h', *samples))
+    return buffer.getvalue()
+
+
+class Command(BaseCommand):
+    help = "Drive the API at increasing concurrency against a local mock OpenAI server and report latency, errors and throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,2,4,8,16',
+                            help='Comma-separated concurrent client counts to sweep (default: 1,2,4,8,16)')
+        parser.add_argument('--duration', type=float, default=20,
+                            help='Seconds of load per concurrency level (default: 20)')
+        parser.add_argument('--endpoints', default='transcribe,process',
+                            help=f"Comma-separated endpoints, requests alternate between them ({', '.join(ENDPOINTS)})")
+        parser.add_argument('--target',
+                            help='Base URL of an already running server (default: serve the app in-process)')
+        parser.add_argument('--chat-latency', type=float, default=1.5,
+                            help='Median mock chat completion latency in seconds (default: 1.5)')
+        parser.add_argument('--chat-sigma', type=float, default=0.4,
+                            help='Log-normal spread of the chat latency (default: 0.4)')
+        parser.add_argument('--chat-error-rate', type=float, default=0.0,
+                            help='Fraction of mock chat completions answered with HTTP 500 (default: 0)')
+        parser.add_argument('--whisper-latency', type=float, default=2.0,
+                            help='Median mock transcription latency in seconds (default: 2.0)')
+        parser.add_argument('--whisper-sigma', type=float, default=0.4,
+                            help='Log-normal spread of the transcription latency (default: 0.4)')
+        parser.add_argument('--whisper-error-rate', type=float, default=0.0,
+                            help='Fraction of mock transcriptions answered with HTTP 500 (default: 0)')
+        parser.add_argument('--mock-port', type=int, default=0,
+                            help='Port for the mock OpenAI server (default: any free port)')
+        parser.add_argument('--saturation-gain', type=float, default=0.1,
+                            help='Throughput gain below which a level counts as saturated (default: 0.1)')
+        parser.add_argument('--seed', type=int, help='Seed for the mock latency and error draws')
+        parser.add_argument('--output', help='Write the per-level results to this JSON file')
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(c) for c in options['concurrency'].split(',') if c.strip()]
+        except ValueError:
+            raise CommandError("--concurrency must be a comma-separated list of integers")
+        if not levels or min(levels) < 1:
+            raise CommandError("--concurrency needs at least one level of 1 or more")
+
+        endpoints = [e.strip() for e in options['endpoints'].split(',') if e.strip()]
+        for endpoint in endpoints:
+            if endpoint not in ENDPOINTS:
+                raise CommandError(f"Unknown endpoint '{endpoint}', expected one of {', '.join(ENDPOINTS)}")
+
+        mock = MockOpenAIServer(
+            chat=LatencyProfile(options['chat_latency'], options['chat_sigma'], options['chat_error_rate']),
+            transcription=LatencyProfile(options['whisper_latency'], options['whisper_sigma'], options['whisper_error_rate']),
+            port=options['mock_port'],
+            seed=options['seed'],
+        ).start()
+        self.stdout.write(f"Mock OpenAI server on {mock.base_url}")
+
+        server = None
+        workdir = None
+        try:
+            if options['target']:
+                base_url = options['target'].rstrip('/')
+                self.stdout.write(
+                    f"Driving {base_url}; it must run with OPENAI_BASE_URL={mock.base_url} "
+                    f"MEDFLOW_LLM_CACHE=0 MEDFLOW_TRANSCRIPT_CACHE=0"
+                )
+            else:
+                workdir = tempfile.TemporaryDirectory(prefix='medflow-loadtest-')
+                server = self._serve_in_process(mock.base_url, Path(workdir.name))
+                base_url = f"http://127.0.0.1:{server.server_address[1]}"
+                self.stdout.write(f"Serving the app in-process on {base_url}")
+
+            results = []
+            for concurrency in levels:
+                self.stdout.write(f"\nConcurrency {concurrency} for {options['duration']:.0f}s...")
+                results.append(self._run_level(base_url, endpoints, concurrency, options['duration']))
+                self._print_level(results[-1])
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            mock.stop()
+            if workdir is not None:
+                workdir.cleanup()
+
+        saturation = self._find_saturation(results, options['saturation_gain'])
+        self._print_summary(results, saturation)
+        self.stdout.write(
+            f"Mock upstream calls: {mock.counts['chat']} chat, {mock.counts['transcription']} transcription, "
+            f"{mock.counts['errors']} failed"
+        )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'config': {
+                        'endpoints': endpoints,
+                        'duration': options['duration'],
+                        'chat': mock.profiles['chat'].to_dict(),
+                        'transcription': mock.profiles['transcription'].to_dict(),
+                        'target': options['target'] or 'in-process',
+                    },
+                    'levels': results,
+                    'saturation': saturation,
+                    'mock_calls': mock.counts,
+                }, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def _serve_in_process(self, mock_base_url, workdir):
+        """Serve the WSGI app on a free port, talking to the mock and writing into a scratch directory"""
+        from django.core.wsgi import get_wsgi_application
+        from llm_cache import llm_cache
+        from llm_client import llm_clients
+        from MedFlow import api_views, processing
+        from MedFlow.patient_storage import patient_storage
+        from MedFlow.transcript_cache import transcript_cache
+
+        os.environ['OPENAI_BASE_URL'] = mock_base_url
+        os.environ.setdefault('OPENAI_API_KEY', 'sk-loadtest')
+        # Pooled clients were built against the real API when the app started
+        llm_clients.reset()
+
+        # Cache hits would measure lookups instead of the pipeline
+        llm_cache.enabled = False
+        transcript_cache.enabled = False
+
+        api_views.AUDIO_DIR = workdir / 'audio_recordings'
+        processing.OUTPUT_DIR = workdir / 'output'
+        patient_storage.storage_dir = workdir / 'patients'
+        patient_storage.storage_dir.mkdir(parents=True, exist_ok=True)
+
+        server = make_server('127.0.0.1', 0, get_wsgi_application(),
+                             server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True).start()
+        return server
+
+    def _run_level(self, base_url, endpoints, concurrency, duration):
+        samples = []
+        lock = threading.Lock()
+        deadline = time.monotonic() + duration
+
+        def worker(index):
+            # Closed loop: each client sends its next request when the previous one returns
+            with httpx.Client(base_url=base_url, timeout=600) as client:
+                count = 0
+                while time.monotonic() < deadline:
+                    endpoint = endpoints[(index + count) % len(endpoints)]
+                    count += 1
+                    sample = self._request(client, endpoint)
+                    with lock:
+                        samples.append(sample)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        return self._summarize_level(concurrency, elapsed, endpoints, samples)
+
+    def _request(self, client, endpoint):
+        sample = {'endpoint': endpoint, 'ok': False, 'status': None, 'stages': {}}
+        started = time.perf_counter()
+        try:
+            if endpoint.endswith('transcribe'):
+                response = client.post(ENDPOINTS[endpoint], files={'audio': ('load.wav', noise_wav(), 'audio/wav')})
+            else:
+                response = client.post(ENDPOINTS[endpoint], json={'transcription': SAMPLE_TRANSCRIPT})
+            sample['status'] = response.status_code
+            sample['ok'] = response.status_code == 200
+            if sample['ok'] and endpoint.endswith('process'):
+                stage_timings = response.json().get('metadata', {}).get('stage_timings', {})
+                sample['stages'] = stage_timings.get('stages', {})
+        except httpx.HTTPError as e:
+            sample['error'] = str(e)
+        sample['seconds'] = time.perf_counter() - started
+        return sample
+
+    def _summarize_level(self, concurrency, elapsed, endpoints, samples):
+        ok = [s for s in samples if s['ok']]
+        level = {
+            'concurrency': concurrency,
+            'seconds': round(elapsed, 2),
+            'requests': len(samples),
+            'errors': len(samples) - len(ok),
+            'error_rate': round((len(samples) - len(ok)) / len(samples), 4) if samples else 0.0,
+            'throughput': round(len(ok) / elapsed, 3) if elapsed else 0.0,
+            'endpoints': {},
+            'stages': {},
+        }
+
+        for endpoint in endpoints:
+            mine = [s for s in samples if s['endpoint'] == endpoint]
+            succeeded = [s['seconds'] for s in mine if s['ok']]
+            summary = latency_summary(succeeded)
+            summary['requests'] = len(mine)
+            summary['errors'] = len(mine) - len(succeeded)
+            summary['error_rate'] = round(summary['errors'] / len(mine), 4) if mine else 0.0
+            summary['throughput'] = round(len(succeeded) / elapsed, 3) if elapsed else 0.0
+            statuses = {}
+            for s in mine:
+                if not s['ok']:
+                    key = str(s['status'] or 'connection')
+                    statuses[key] = statuses.get(key, 0) + 1
+            summary['failures'] = statuses
+            level['endpoints'][endpoint] = summary
+
+        stage_names = sorted({name for s in ok for name in s['stages']})
+        for name in stage_names:
+            level['stages'][name] = latency_summary([s['stages'][name] for s in ok if name in s['stages']])
+
+        return level
+
+    def _find_saturation(self, results, min_gain):
+        """The last level before throughput stops growing or errors appear"""
+        if not results:
+            return None
+        for previous, current in zip(results, results[1:]):
+            if current['error_rate'] > 0.05:
+                return {'concurrency': previous['concurrency'],
+                        'reason': f"error rate {current['error_rate']:.1%} at concurrency {current['concurrency']}"}
+            gain = (current['throughput'] - previous['throughput']) / previous['throughput'] if previous['throughput'] else 0.0
+            if gain < min_gain:
+                return {'concurrency': previous['concurrency'],
+                        'reason': f"throughput gain {gain:+.1%} at concurrency {current['concurrency']}"}
+        return None
+
+    def _print_level(self, level):
+        self.stdout.write(
+            f"  {level['requests']} requests in {level['seconds']:.1f}s, "
+            f"{level['throughput']:.2f} req/s, error rate {level['error_rate']:.1%}"
+        )
+        self.stdout.write(f"  {'endpoint':<28}{'count':>7}{'errors':>8}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}")
+        for name, s in level['endpoints'].items():
+            self.stdout.write(f"  {name:<28}{s['count']:>7}{s['errors']:>8}{self._fmt(s['p50'])}{self._fmt(s['p95'])}{self._fmt(s['p99'])}")
+            if s['failures']:
+                self.stdout.write(f"  {'':<28}failures by status: {s['failures']}")
+        for name, s in level['stages'].items():
+            self.stdout.write(f"    stage {name:<20}{s['count']:>7}{'':>8}{self._fmt(s['p50'])}{self._fmt(s['p95'])}{self._fmt(s['p99'])}")
+
+    def _print_summary(self, results, saturation):
+        self.stdout.write("")
+        self.stdout.write(f"{'clients':>8}{'req/s':>9}{'errors':>9}" + ''.join(
+            f"{name + ' p95':>22}" for name in results[0]['endpoints']
+        ))
+        for level in results:
+            self.stdout.write(
+                f"{level['concurrency']:>8}{level['throughput']:>9.2f}{level['error_rate']:>9.1%}" + ''.join(
+                    f"{self._fmt(s['p95'], 22)}" for s in level['endpoints'].values()
+                )
+            )
+
+        if saturation:
+            self.stdout.write(self.style.WARNING(
+                f"\nSaturates at concurrency {saturation['concurrency']} ({saturation['reason']})"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS("\nThroughput still growing at the highest level tested"))
+
+    def _fmt(self, value, width=9):
+        return f"{value:>{width}.2f}" if value is not None else f"{'-':>{width}}"
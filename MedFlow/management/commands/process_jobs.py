@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from MedFlow.jobs import JobQueue
+
+
+class Command(BaseCommand):
+    help = "Run a standalone worker pool for queued /api/process/jobs/ jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Worker threads (default: MEDFLOW_JOB_WORKERS)')
+
+    def handle(self, *args, **options):
+        queue = JobQueue(workers=options['workers'])
+        queue.start()
+        self.stdout.write(self.style.SUCCESS(f"Processing jobs with {queue.workers} workers, Ctrl+C to stop"))
+
+        try:
+            while True:
+                time.sleep(60)
+                self.stdout.write(f"Queue: {queue.stats()['jobs']}")
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping job workers")
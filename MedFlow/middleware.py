@@ -0,0 +1,47 @@
+import time
+import asyncio
+
+from django.utils.decorators import sync_and_async_middleware
+
+from metrics import metrics
+
+
+@sync_and_async_middleware
+class RequestMetricsMiddleware:
+    """
+    Records the duration of every request by URL pattern, method and status.
+    This worker's metrics file is written from a background thread within
+    MEDFLOW_METRICS_FLUSH_SECONDS, never during the request.
+
+    Under ASGI the async branch is used, so async views keep running on the
+    event loop instead of being handed to the single sync thread.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks the instance as async for Django, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - started)
+        return response
+
+    def _record(self, request, response, elapsed: float):
+        # The route pattern, not the path, so patient names do not become series
+        match = request.resolver_match
+        endpoint = '/' + match.route if match is not None else 'unmatched'
+        metrics.observe(
+            'medflow_request_duration_seconds', elapsed,
+            endpoint=endpoint, method=request.method, status=response.status_code
+        )
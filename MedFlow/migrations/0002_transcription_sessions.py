@@ -0,0 +1,50 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:43
+
+import MedFlow.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscriptionSession',
+            fields=[
+                ('session_id', models.CharField(default=MedFlow.models._new_job_id, editable=False, max_length=32, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('finalized', 'Finalized')], default='open', max_length=16)),
+                ('transcript', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finalized_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TranscriptionChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('audio_file', models.CharField(max_length=255)),
+                ('text', models.TextField(blank=True, default='')),
+                ('error', models.TextField(blank=True, default='')),
+                ('seconds', models.FloatField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='MedFlow.transcriptionsession')),
+            ],
+            options={
+                'ordering': ['session', 'sequence'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='transcriptionchunk',
+            constraint=models.UniqueConstraint(fields=('session', 'sequence'), name='unique_chunk_sequence'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0002_transcription_sessions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioTranscript',
+            fields=[
+                ('content_hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('audio_file', models.CharField(max_length=255)),
+                ('model', models.CharField(max_length=64)),
+                ('transcription', models.TextField()),
+                ('segments', models.PositiveIntegerField(default=1)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
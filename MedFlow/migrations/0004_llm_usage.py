@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0003_audio_transcripts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=64)),
+                ('model', models.CharField(max_length=64)),
+                ('cached', models.BooleanField(default=False)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('total_tokens', models.PositiveIntegerField(default=0)),
+                ('seconds', models.FloatField(default=0.0)),
+                ('cost_usd', models.FloatField(default=0.0)),
+                ('visit_id', models.CharField(blank=True, default='', max_length=64)),
+                ('patient_name', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='llmusage',
+            index=models.Index(fields=['created_at', 'category'], name='MedFlow_llm_created_7de95e_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:04
+
+import MedFlow.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0004_llm_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineRun',
+            fields=[
+                ('run_id', models.CharField(default=MedFlow.models._new_job_id, editable=False, max_length=32, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('incomplete', 'Incomplete'), ('succeeded', 'Succeeded')], default='running', max_length=16)),
+                ('mode', models.CharField(max_length=16)),
+                ('transcription', models.TextField()),
+                ('audio_file', models.CharField(blank=True, default='', max_length=255)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('failed_stage', models.CharField(blank=True, default='', max_length=64)),
+                ('error', models.TextField(blank=True, default='')),
+                ('usage_calls', models.JSONField(blank=True, default=list)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PipelineCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=64)),
+                ('output', models.JSONField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='MedFlow.pipelinerun')),
+            ],
+            options={
+                'ordering': ['run', 'created_at'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='pipelinecheckpoint',
+            constraint=models.UniqueConstraint(fields=('run', 'stage'), name='unique_run_stage'),
+        ),
+    ]
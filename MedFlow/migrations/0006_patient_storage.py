@@ -0,0 +1,51 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0005_pipeline_runs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Patient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('mrn', models.CharField(blank=True, db_index=True, default='', max_length=64)),
+                ('first_visit', models.CharField(max_length=32)),
+                ('last_visit', models.CharField(db_index=True, max_length=32)),
+                ('visit_count', models.PositiveIntegerField(default=0)),
+                ('demographics', models.JSONField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-last_visit'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Visit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('visit_id', models.CharField(max_length=64)),
+                ('timestamp', models.CharField(max_length=32)),
+                ('record', models.JSONField()),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visits', to='MedFlow.patient')),
+            ],
+            options={
+                'ordering': ['patient', '-visit_id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['timestamp'], name='MedFlow_vis_timesta_0f52b3_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='visit',
+            constraint=models.UniqueConstraint(fields=('patient', 'visit_id'), name='unique_patient_visit'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:21
+
+from django.db import migrations, models
+
+
+def _has_orders(requisition):
+    return bool(requisition) and requisition.get('request_type') != 'none'
+
+
+def fill_order_flags(apps, schema_editor):
+    Visit = apps.get_model('MedFlow', 'Visit')
+    db = schema_editor.connection.alias
+    for visit in Visit.objects.using(db).iterator():
+        visit.has_lab_orders = _has_orders(visit.record.get('lab_requisition'))
+        visit.has_prescriptions = _has_orders(visit.record.get('pharmacy_requisition'))
+        visit.save(update_fields=['has_lab_orders', 'has_prescriptions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0006_patient_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visit',
+            name='has_lab_orders',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='has_prescriptions',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(fill_order_flags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:24
+
+from django.db import migrations, models
+
+
+def _snippet(record):
+    soap_note = record.get('soap_note')
+    assessment = soap_note.get('assessment') if isinstance(soap_note, dict) else None
+    snippet = ' '.join(str(assessment or '').split())
+    if len(snippet) > 160:
+        snippet = snippet[:160].rsplit(' ', 1)[0] + '…'
+    return snippet
+
+
+def fill_headers(apps, schema_editor):
+    Visit = apps.get_model('MedFlow', 'Visit')
+    db = schema_editor.connection.alias
+    for visit in Visit.objects.using(db).iterator():
+        visit.patient_mrn = visit.record.get('patient_mrn', '')
+        visit.assessment_snippet = _snippet(visit.record)
+        visit.save(update_fields=['patient_mrn', 'assessment_snippet'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0007_visit_order_flags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visit',
+            name='assessment_snippet',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='patient_mrn',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.RunPython(fill_headers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0008_visit_headers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transcriptionchunk',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
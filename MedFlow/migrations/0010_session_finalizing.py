@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MedFlow', '0009_chunk_claims'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transcriptionsession',
+            name='status',
+            field=models.CharField(choices=[('open', 'Open'), ('finalizing', 'Finalizing'), ('finalized', 'Finalized')], default='open', max_length=16),
+        ),
+    ]
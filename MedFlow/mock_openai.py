@@ -0,0 +1,206 @@
+"""
+Local stand-in for the OpenAI API, used by the loadtest management command
+
+Serves /v1/chat/completions and /v1/audio/transcriptions with canned but
+well-formed answers. The prompt category of a chat request is recognised from
+its system prompt in prompts.json, so every agent gets a response it can
+parse. Latency is drawn from a log-normal distribution per endpoint, and a
+configurable fraction of requests fails with HTTP 500, like a real upstream.
+"""
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+SAMPLE_TRANSCRIPT = (
+    "Doctor: Good morning, what brings you in today? Patient: Headaches for about a week and I feel tired. "
+    "Doctor: Blood pressure is 145 over 92. I'm increasing your Lisinopril to 20mg daily and ordering "
+    "a basic metabolic panel. Come back in two weeks."
+)
+
+SOAP_NOTE = (
+    "SUBJECTIVE:\nHeadaches for one week, fatigue.\n\n"
+    "OBJECTIVE:\nBP 145/92 mmHg.\n\n"
+    "ASSESSMENT:\nUncontrolled hypertension.\n\n"
+    "PLAN:\nIncrease Lisinopril to 20mg daily. Basic metabolic panel. Follow up in two weeks."
+)
+
+CLINICAL_DATA = {
+    "vital_signs": {"blood_pressure": {"value": "145/92", "unit": "mmHg"}},
+    "medications": [{"name": "Lisinopril", "dosage": "20mg", "frequency": "once daily"}],
+    "diagnoses": ["Hypertension"],
+}
+
+LAB_REQUEST = {"request_type": "lab_test_request", "tests_requested": [{"test_name": "Basic Metabolic Panel"}]}
+
+PHARMACY_REQUEST = {
+    "request_type": "pharmacy_prescription_request",
+    "prescriptions": [{"medication_name": "Lisinopril", "strength": "20mg", "frequency": "once daily"}],
+}
+
+
+def patient_data(rng: random.Random):
+    return {
+        "personal_info": {"full_name": f"Load Test {rng.randint(1, 500):03d}", "age": rng.randint(20, 90)},
+        "identifiers": {"patient_id": f"LT-{rng.randint(1, 99999):05d}"},
+    }
+
+
+class LatencyProfile:
+    """Log-normal latency around ``median`` seconds, plus an error rate"""
+
+    def __init__(self, median: float, sigma: float = 0.4, error_rate: float = 0.0):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        return rng.lognormvariate(math.log(self.median), self.sigma)
+
+    def to_dict(self):
+        return {'median': self.median, 'sigma': self.sigma, 'error_rate': self.error_rate}
+
+
+class MockOpenAIServer:
+
+    def __init__(self, chat: LatencyProfile, transcription: LatencyProfile, port: int = 0, seed: int = None):
+        self.profiles = {'chat': chat, 'transcription': transcription}
+        self.port = port
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._categories = self._load_categories()
+        self._server = None
+        self._thread = None
+        self.counts = {'chat': 0, 'transcription': 0, 'errors': 0}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.endswith('/chat/completions'):
+                    mock._respond(self, 'chat', lambda: mock._chat_response(body))
+                elif self.path.endswith('/audio/transcriptions'):
+                    mock._respond(self, 'transcription', mock._transcription_response)
+                else:
+                    mock._send(self, 404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock-openai', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _load_categories(self):
+        prompts = json.loads((Path(__file__).parent / 'src' / 'prompts.json').read_text(encoding='utf-8'))
+        return {
+            config['system_prompt']: category
+            for category, config in prompts.items()
+            if isinstance(config, dict) and 'system_prompt' in config
+        }
+
+    def _random(self, func, *args):
+        with self._rng_lock:
+            return func(*args)
+
+    def _respond(self, handler, endpoint, build):
+        profile = self.profiles[endpoint]
+        time.sleep(self._random(profile.sample, self._rng))
+        failed = self._random(self._rng.random) < profile.error_rate
+        with self._rng_lock:
+            self.counts[endpoint] += 1
+            if failed:
+                self.counts['errors'] += 1
+
+        if failed:
+            self._send(handler, 500, {"error": {"message": "Mock upstream failure", "type": "server_error"}})
+            return
+        self._send(handler, 200, build())
+
+    def _send(self, handler, status_code, payload):
+        data = json.dumps(payload).encode('utf-8')
+        handler.send_response(status_code)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        try:
+            handler.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, e.g. a hedged attempt that lost the race
+            pass
+
+    def _chat_response(self, body: bytes):
+        request = json.loads(body or b'{}')
+        messages = request.get('messages', [])
+        system_prompt = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '')
+        category = self._categories.get(system_prompt, '')
+
+        if category == 'soap_note':
+            content = SOAP_NOTE
+        elif category == 'data_extraction':
+            content = json.dumps(CLINICAL_DATA)
+        elif category == 'patient_data_extraction':
+            content = json.dumps(self._random(patient_data, self._rng))
+        elif category == 'patient_data_fields':
+            data = self._random(patient_data, self._rng)
+            content = json.dumps({**data['personal_info'], **data['identifiers']})
+        elif category == 'lab_request_generation':
+            content = json.dumps(LAB_REQUEST)
+        elif category == 'pharmacy_request_generation':
+            content = json.dumps(PHARMACY_REQUEST)
+        elif category == 'fused_pipeline':
+            sections = dict(line.split(':\n', 1) for line in SOAP_NOTE.split('\n\n'))
+            content = json.dumps({
+                "patient_data": self._random(patient_data, self._rng),
+                "soap_note": {k.lower(): v for k, v in sections.items()},
+                "clinical_data": CLINICAL_DATA,
+                "lab_request": LAB_REQUEST,
+                "pharmacy_request": PHARMACY_REQUEST,
+            })
+        else:
+            content = json.dumps({})
+
+        prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'gpt-4o'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _transcription_response(self):
+        return {"text": SAMPLE_TRANSCRIPT}
@@ -1,3 +1,301 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+def _new_job_id():
+    return uuid.uuid4().hex
+
+
+class ProcessingJob(models.Model):
+    """A queued run of the five-agent pipeline over one transcription"""
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    job_id = models.CharField(max_length=32, primary_key=True, default=_new_job_id, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    transcription = models.TextField()
+    audio_file = models.CharField(max_length=255, blank=True, default='')
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    worker = models.CharField(max_length=128, blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.job_id} ({self.status})"
+
+    def to_dict(self, include_result=True):
+        data = {
+            'job_id': self.job_id,
+            'status': self.status,
+            'audio_file': self.audio_file,
+            'attempts': self.attempts,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+        if self.status == self.STATUS_FAILED:
+            data['error'] = self.error
+        if include_result and self.status == self.STATUS_SUCCEEDED:
+            data['result'] = self.result
+        return data
+
+
+class TranscriptionSession(models.Model):
+    """A recording transcribed chunk by chunk while it is still in progress"""
+
+    STATUS_OPEN = 'open'
+    # Finalize was asked for while chunks were still being transcribed
+    STATUS_FINALIZING = 'finalizing'
+    STATUS_FINALIZED = 'finalized'
+    STATUS_CHOICES = [
+        (STATUS_OPEN, 'Open'),
+        (STATUS_FINALIZING, 'Finalizing'),
+        (STATUS_FINALIZED, 'Finalized'),
+    ]
+
+    session_id = models.CharField(max_length=32, primary_key=True, default=_new_job_id, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_OPEN)
+    transcript = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finalized_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.session_id} ({self.status})"
+
+    def to_dict(self):
+        chunks = list(self.chunks.order_by('sequence'))
+        return {
+            'session_id': self.session_id,
+            'status': self.status,
+            'transcript': self.transcript,
+            'chunks': [chunk.to_dict() for chunk in chunks],
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finalized_at': self.finalized_at.isoformat() if self.finalized_at else None,
+        }
+
+
+class TranscriptionChunk(models.Model):
+    """One self-contained piece of audio posted to a TranscriptionSession"""
+
+    STATUS_PENDING = 'pending'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    session = models.ForeignKey(TranscriptionSession, related_name='chunks', on_delete=models.CASCADE)
+    sequence = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    audio_file = models.CharField(max_length=255)
+    text = models.TextField(blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    seconds = models.FloatField(null=True, blank=True)
+    # When the request transcribing this chunk took it on; only that request saves the result
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['session', 'sequence']
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'sequence'], name='unique_chunk_sequence'),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id}#{self.sequence} ({self.status})"
+
+    def to_dict(self):
+        data = {
+            'sequence': self.sequence,
+            'status': self.status,
+            'audio_file': self.audio_file,
+            'seconds': self.seconds,
+        }
+        if self.status == self.STATUS_FAILED:
+            data['error'] = self.error
+        return data
+
+
+class AudioTranscript(models.Model):
+    """Whisper output for one uploaded recording, keyed by the SHA-256 of its bytes"""
+
+    content_hash = models.CharField(max_length=64, primary_key=True)
+    audio_file = models.CharField(max_length=255)
+    model = models.CharField(max_length=64)
+    transcription = models.TextField()
+    segments = models.PositiveIntegerField(default=1)
+    size = models.PositiveBigIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} -> {self.audio_file}"
+
+
+class LLMUsage(models.Model):
+    """Token usage and cost of one chat completion (or cache hit) made by an agent"""
+
+    category = models.CharField(max_length=64)
+    model = models.CharField(max_length=64)
+    cached = models.BooleanField(default=False)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    total_tokens = models.PositiveIntegerField(default=0)
+    seconds = models.FloatField(default=0.0)
+    cost_usd = models.FloatField(default=0.0)
+    visit_id = models.CharField(max_length=64, blank=True, default='')
+    patient_name = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'category']),
+        ]
+
+    def __str__(self):
+        return f"{self.category} {self.model} ({self.total_tokens} tokens)"
+
+
+class PipelineRun(models.Model):
+    """One consultation's pass through the agent pipeline, resumable from its checkpoints"""
+
+    STATUS_RUNNING = 'running'
+    STATUS_INCOMPLETE = 'incomplete'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_CHOICES = [
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_INCOMPLETE, 'Incomplete'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+    ]
+
+    run_id = models.CharField(max_length=32, primary_key=True, default=_new_job_id, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    mode = models.CharField(max_length=16)
+    transcription = models.TextField()
+    audio_file = models.CharField(max_length=255, blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+    failed_stage = models.CharField(max_length=64, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    # Chat completions of earlier attempts, summarised with the visit once it is saved
+    usage_calls = models.JSONField(default=list, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.run_id} ({self.status})"
+
+
+class PipelineCheckpoint(models.Model):
+    """The output of one pipeline stage, saved as soon as the stage finished"""
+
+    run = models.ForeignKey(PipelineRun, related_name='checkpoints', on_delete=models.CASCADE)
+    stage = models.CharField(max_length=64)
+    output = models.JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['run', 'created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['run', 'stage'], name='unique_run_stage'),
+        ]
+
+    def __str__(self):
+        return f"{self.run_id}:{self.stage}"
+
+
+class Patient(models.Model):
+    """A patient of the database storage backend, with the summary the JSON backend keeps in patient_summary.json"""
+
+    # Same rule as the JSON backend's directory names, so both find a patient the same way
+    key = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=255)
+    mrn = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # ISO strings exactly as saved, so both backends return (and sort by) the same values
+    first_visit = models.CharField(max_length=32)
+    last_visit = models.CharField(max_length=32, db_index=True)
+    visit_count = models.PositiveIntegerField(default=0)
+    demographics = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-last_visit']
+
+    def __str__(self):
+        return f"{self.name} ({self.mrn})"
+
+    def to_dict(self):
+        data = {
+            'patient_name': self.name,
+            'first_visit': self.first_visit,
+            'visit_count': self.visit_count,
+            'mrn': self.mrn,
+            'last_visit': self.last_visit,
+        }
+        if self.demographics is not None:
+            data['demographics'] = self.demographics
+        return data
+
+
+class Visit(models.Model):
+    """One saved consultation of a Patient; ``record`` is the visit as the API returns it"""
+
+    patient = models.ForeignKey(Patient, related_name='visits', on_delete=models.CASCADE)
+    visit_id = models.CharField(max_length=64)
+    timestamp = models.CharField(max_length=32)
+    # The visit's header, copied out of ``record`` so listings can filter and return it without reading records
+    patient_mrn = models.CharField(max_length=64, blank=True, default='')
+    assessment_snippet = models.CharField(max_length=200, blank=True, default='')
+    has_lab_orders = models.BooleanField(default=False)
+    has_prescriptions = models.BooleanField(default=False)
+    record = models.JSONField()
+
+    class Meta:
+        ordering = ['patient', '-visit_id']
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'visit_id'], name='unique_patient_visit'),
+        ]
+        indexes = [
+            models.Index(fields=['timestamp']),
+        ]
+
+    def __str__(self):
+        return f"{self.patient_id}:{self.visit_id}"
+
+    @staticmethod
+    def header_columns(header):
+        """Column values of a visit header (see listing.visit_header)"""
+        return {name: header[name] for name in
+                ('timestamp', 'patient_mrn', 'assessment_snippet', 'has_lab_orders', 'has_prescriptions')}
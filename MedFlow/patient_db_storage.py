@@ -0,0 +1,218 @@
+"""
+Patient data storage in the Django database
+
+Same API and same records as the JSON-file PatientStorage, kept in the
+Patient and Visit tables: a patient's summary is one indexed row instead of
+a file to open, and a visit and its summary are written in one transaction.
+On SQLite the database runs in WAL mode (see MedflowConfig.ready), so
+requests reading patients are not blocked while a visit is saved, and writes
+take the database's write lock when their transaction starts (see
+write_transaction), so two workers saving visits queue up instead of failing.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict, Optional, Tuple
+
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Lower
+
+from metrics import metrics
+
+from .listing import (
+    PATIENT_SORTS, PATIENT_CURSOR_TYPES, VISIT_CURSOR_TYPES, HEADER_FIELDS, HEADER_RECORD_FIELDS,
+    encode_cursor, decode_cursor, until_bound, project, visit_header
+)
+from .models import Patient, Visit
+from .visit_ids import new_visit_id
+from .visit_updates import apply_visit_update
+
+# Patient columns behind the listing's sort fields
+SORT_COLUMNS = {'last_visit': 'last_visit', 'name': 'sort_name', 'visit_count': 'visit_count'}
+
+
+def patient_key(patient_name: str) -> str:
+    """The JSON backend's directory name for ``patient_name``"""
+    return "".join(c for c in patient_name if c.isalnum() or c in (' ', '-', '_')).strip().replace(' ', '_')
+
+
+@contextmanager
+def write_transaction(using: str):
+    """
+    transaction.atomic holding the write lock from the start. SQLite begins
+    transactions deferred (and Django 3.2 cannot ask for BEGIN IMMEDIATE): one
+    that read before writing fails with "database is locked" if another worker
+    wrote in between, and select_for_update does nothing there. A first write
+    that changes nothing takes the lock, waiting out the busy timeout.
+    """
+    with transaction.atomic(using=using):
+        connection = connections[using]
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(f'UPDATE {connection.ops.quote_name(Patient._meta.db_table)} SET id = id WHERE 0')
+        yield
+
+
+class DatabasePatientStorage:
+    def __init__(self, using: str = 'default'):
+        # Database alias, e.g. a scratch database for the storage benchmark
+        self.using = using
+
+    @metrics.timed('storage.save_patient_visit')
+    def save_patient_visit(self, patient_data: Dict) -> str:
+        """Save a patient visit record"""
+        patient_name = patient_data.get('patient_name', 'Unknown')
+
+        # Generate visit ID
+        now = datetime.now()
+        visit_id = new_visit_id(now)
+
+        visit_record = {
+            'visit_id': visit_id,
+            'timestamp': now.isoformat(),
+            'patient_name': patient_name,
+            **patient_data
+        }
+
+        with write_transaction(self.using):
+            patient, _ = Patient.objects.using(self.using).select_for_update().get_or_create(
+                key=patient_key(patient_name),
+                defaults={
+                    'name': patient_name,
+                    'first_visit': visit_record['timestamp'],
+                    'last_visit': visit_record['timestamp'],
+                    'mrn': visit_record.get('patient_mrn', ''),
+                }
+            )
+            _, created = Visit.objects.using(self.using).update_or_create(
+                patient=patient,
+                visit_id=visit_id,
+                defaults={'record': visit_record, **Visit.header_columns(visit_header(visit_record))}
+            )
+
+            # Update summary, in the database rather than from the row read above
+            patients = Patient.objects.using(self.using).filter(pk=patient.pk)
+            if created:
+                patients.update(visit_count=F('visit_count') + 1)
+            latest = {'last_visit': visit_record['timestamp']}
+            patient_data = visit_record.get('patient_data') or {}
+            if 'personal_info' in patient_data:
+                latest['demographics'] = patient_data['personal_info']
+            # Unless a later visit was saved meanwhile
+            patients.filter(last_visit__lte=visit_record['timestamp']).update(**latest)
+
+        return visit_id
+
+    @metrics.timed('storage.get_patient_visits')
+    def get_patient_visits(self, patient_name: str) -> List[Dict]:
+        """Get all visits for a patient"""
+        visits = Visit.objects.using(self.using).filter(patient__key=patient_key(patient_name)).order_by('-visit_id')
+        return list(visits.values_list('record', flat=True))
+
+    @metrics.timed('storage.get_all_patients')
+    def get_all_patients(self) -> List[Dict]:
+        """Get summary of all patients"""
+        return [patient.to_dict() for patient in Patient.objects.using(self.using).order_by('-last_visit')]
+
+    @metrics.timed('storage.list_patients')
+    def list_patients(self, sort: str = 'last_visit', order: str = None, limit: int = None, cursor: str = None,
+                      since: str = None, until: str = None) -> Tuple[List[Dict], Optional[str]]:
+        """One page of patient summaries and the cursor of the next page, as PatientStorage.list_patients"""
+        order = order or PATIENT_SORTS[sort]
+        column = SORT_COLUMNS[sort]
+        patients = Patient.objects.using(self.using).annotate(sort_name=Lower('name'))
+        if since:
+            patients = patients.filter(last_visit__gte=since)
+        if until:
+            patients = patients.filter(last_visit__lt=until_bound(until))
+        if cursor:
+            value, key = decode_cursor(cursor, sort, order, types=PATIENT_CURSOR_TYPES[sort])
+            direction = 'gt' if order == 'asc' else 'lt'
+            patients = patients.filter(
+                Q(**{f'{column}__{direction}': value}) | Q(**{column: value, f'key__{direction}': key})
+            )
+        prefix = '' if order == 'asc' else '-'
+        patients = list(patients.order_by(f'{prefix}{column}', f'{prefix}key')[:limit + 1 if limit else None])
+        
+        next_cursor = None
+        if limit is not None and len(patients) > limit:
+            patients = patients[:limit]
+            last = patients[-1]
+            next_cursor = encode_cursor(sort, order, getattr(last, column), last.key)
+        return [patient.to_dict() for patient in patients], next_cursor
+
+    @metrics.timed('storage.list_patient_visits')
+    def list_patient_visits(self, patient_name: str, order: str = 'desc', limit: int = None, cursor: str = None,
+                            since: str = None, until: str = None, has_lab_orders: bool = None,
+                            has_prescriptions: bool = None, headers: bool = False,
+                            fields: List[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        One page of a patient's visits and the cursor of the next page, as
+        PatientStorage.list_patient_visits; headers come from their columns
+        without loading the records.
+        """
+        visits = Visit.objects.using(self.using).filter(patient__key=patient_key(patient_name))
+        if since:
+            visits = visits.filter(timestamp__gte=since)
+        if until:
+            visits = visits.filter(timestamp__lt=until_bound(until))
+        if has_lab_orders is not None:
+            visits = visits.filter(has_lab_orders=has_lab_orders)
+        if has_prescriptions is not None:
+            visits = visits.filter(has_prescriptions=has_prescriptions)
+        if cursor:
+            after = decode_cursor(cursor, order, types=VISIT_CURSOR_TYPES)[0]
+            visits = visits.filter(**{f"visit_id__{'gt' if order == 'asc' else 'lt'}": after})
+        visits = visits.order_by('visit_id' if order == 'asc' else '-visit_id')
+        if headers or (fields is not None and set(fields) <= set(HEADER_RECORD_FIELDS)):
+            rows = list(visits.values(*HEADER_FIELDS)[:limit + 1 if limit else None])
+        else:
+            rows = list(visits.values_list('record', flat=True)[:limit + 1 if limit else None])
+        
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(order, rows[-1]['visit_id'])
+        return [project(row, fields) for row in rows], next_cursor
+
+    @metrics.timed('storage.get_patient_summary')
+    def get_patient_summary(self, patient_name: str) -> Optional[Dict]:
+        """Get summary for a specific patient"""
+        patient = Patient.objects.using(self.using).filter(key=patient_key(patient_name)).first()
+        return patient.to_dict() if patient else None
+
+    def get_patient_visit(self, patient_name: str, visit_id: str) -> Optional[Dict]:
+        """Get a single visit of a patient"""
+        visit = Visit.objects.using(self.using).filter(patient__key=patient_key(patient_name), visit_id=visit_id).first()
+        return visit.record if visit else None
+
+    @metrics.timed('storage.update_patient_visit')
+    def update_patient_visit(self, patient_name: str, visit_id: str, updated_data: Dict,
+                             expected: Dict = None, append: Dict = None) -> bool:
+        """
+        Update an existing patient visit record. When the edit changes the
+        demographics of the patient's latest visit, the patient summary is
+        updated in the same transaction. ``expected`` and ``append`` are
+        checked and applied to the visit as stored, with its row locked (see
+        apply_visit_update).
+        """
+        with write_transaction(self.using):
+            visit = (Visit.objects.using(self.using).select_for_update().select_related('patient')
+                     .filter(patient__key=patient_key(patient_name), visit_id=visit_id).first())
+            if visit is None:
+                return False
+
+            apply_visit_update(visit.record, updated_data, expected, append)
+            columns = Visit.header_columns(visit_header(visit.record))
+            for name, value in columns.items():
+                setattr(visit, name, value)
+            visit.save(update_fields=['record', *columns])
+
+            patient = visit.patient
+            latest = patient.visits.order_by('-visit_id').values_list('visit_id', flat=True).first()
+            demographics = (visit.record.get('patient_data') or {}).get('personal_info')
+            if latest == visit_id and demographics is not None and patient.demographics != demographics:
+                patient.demographics = demographics
+                patient.save(update_fields=['demographics'])
+
+        return True
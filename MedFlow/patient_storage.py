@@ -1,47 +1,96 @@
 """
 Patient data storage using JSON files
-Simple file-based storage until database is implemented
+
+One directory per patient, holding a file per visit and patient_summary.json,
+plus patient_index.jsonl with every patient's summary for listing them.
+Writes to a patient's files hold a flock on the patient's lock file, and
+visits and summaries are renamed into place, so worker processes can share
+the directory.
+The Django database backend in patient_db_storage.py has the same API; the
+``patient_storage`` instance uses the backend chosen with
+MEDFLOW_STORAGE_BACKEND (``json``, the default, or ``database``). Existing
+JSON data is copied into the database with ``manage.py import_patient_data``.
 """
+import os
 import json
+import fcntl
+import threading
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+from metrics import metrics
+
+from .visit_ids import new_visit_id
+from .visit_updates import apply_visit_update
+from .listing import (
+    PATIENT_SORTS, PATIENT_CURSOR_TYPES, VISIT_CURSOR_TYPES, HEADER_RECORD_FIELDS, encode_cursor, decode_cursor,
+    in_range, project, visit_header
+)
+
+INDEX_FILE = 'patient_index.jsonl'
+# Bumped when the layout of the index rows changes, so old indexes are rebuilt
+INDEX_VERSION = 1
+# Superseded index rows tolerated before the file is compacted
+INDEX_SLACK_LINES = 1000
+# Per patient: one header line per visit save or edit
+HEADERS_FILE = 'headers.jsonl'
+HEADERS_SLACK_LINES = 20
+# Per patient: locked by the process writing the patient's files
+LOCK_FILE = '.lock'
 
 
 class PatientStorage:
-    def __init__(self):
-        self.storage_dir = Path(__file__).parent / 'patient_data'
-        self.storage_dir.mkdir(exist_ok=True)
+    def __init__(self, storage_dir: Path = None):
+        self.storage_dir = Path(storage_dir) if storage_dir else Path(__file__).parent / 'patient_data'
+        self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self._locks_guard = threading.Lock()
+        self._locks = {}
+        # The patient index as far as this process has read it
+        self._index_lock = threading.Lock()
+        self._index_file = None
+        self._index_inode = None
+        self._index_rows = {}
+        self._index_offset = 0
+        self._index_lines = 0
+        self._index_sorted = {}
         
+    @metrics.timed('storage.save_patient_visit')
     def save_patient_visit(self, patient_data: Dict) -> str:
         """Save a patient visit record"""
-        # Create patient directory
         patient_name = patient_data.get('patient_name', 'Unknown')
         patient_dir = self.storage_dir / self._sanitize_filename(patient_name)
-        patient_dir.mkdir(exist_ok=True)
         
-        # Generate visit ID
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        visit_id = f'visit_{timestamp}'
-        
-        # Add metadata
-        visit_record = {
-            'visit_id': visit_id,
-            'timestamp': datetime.now().isoformat(),
-            'patient_name': patient_name,
-            **patient_data
-        }
-        
-        # Save visit file
-        visit_file = patient_dir / f'{visit_id}.json'
-        with open(visit_file, 'w') as f:
-            json.dump(visit_record, f, indent=2)
-        
-        # Update patient summary
-        self._update_patient_summary(patient_name, visit_record)
+        # Creates the patient directory
+        with self._patient_lock(patient_name):
+            # Generate visit ID; taken with the lock held, so a patient's visits sort in the order they were saved
+            now = datetime.now()
+            visit_id = new_visit_id(now)
+            while (patient_dir / f'{visit_id}.json').exists():
+                visit_id = new_visit_id(now)
+            
+            # Add metadata
+            visit_record = {
+                'visit_id': visit_id,
+                'timestamp': now.isoformat(),
+                'patient_name': patient_name,
+                **patient_data
+            }
+            
+            # Save visit file
+            visit_file = patient_dir / f'{visit_id}.json'
+            os.replace(self._write_temp(visit_file, visit_record), visit_file)
+            
+            # Update patient summary
+            self._append_headers(patient_dir, [visit_header(visit_record)])
+            summary = self._update_patient_summary(patient_name, visit_record)
+            self._update_index(patient_dir.name, summary)
         
         return visit_id
     
+    @metrics.timed('storage.get_patient_visits')
     def get_patient_visits(self, patient_name: str) -> List[Dict]:
         """Get all visits for a patient"""
         patient_dir = self.storage_dir / self._sanitize_filename(patient_name)
@@ -55,19 +104,107 @@ class PatientStorage:
         
         return visits
     
+    @metrics.timed('storage.get_all_patients')
     def get_all_patients(self) -> List[Dict]:
-        """Get summary of all patients"""
-        patients = []
+        """Get summary of all patients, from the patient index"""
+        _, rows = self._sorted_index('last_visit')
+        
+        # Copies: the rows are shared by every request of this process
+        return [dict(patient) for patient in reversed(rows)]
+    
+    @metrics.timed('storage.list_patients')
+    def list_patients(self, sort: str = 'last_visit', order: str = None, limit: int = None, cursor: str = None,
+                      since: str = None, until: str = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        One page of patient summaries and the cursor of the next page (None
+        on the last one), sorted by ``last_visit``, ``name`` or
+        ``visit_count`` and filtered on the last visit's date. Served from
+        the patient index without reading any other file.
+        """
+        order = order or PATIENT_SORTS[sort]
+        keys, rows = self._sorted_index(sort)
+        
+        after = tuple(decode_cursor(cursor, sort, order, types=PATIENT_CURSOR_TYPES[sort])) if cursor else None
+        try:
+            if order == 'asc':
+                positions = range(bisect_right(keys, after) if after else 0, len(rows))
+            else:
+                positions = range((bisect_left(keys, after) if after else len(rows)) - 1, -1, -1)
+        except TypeError:
+            raise ValueError('Invalid cursor')
         
-        for patient_dir in self.storage_dir.iterdir():
-            if patient_dir.is_dir():
-                summary_file = patient_dir / 'patient_summary.json'
-                if summary_file.exists():
-                    with open(summary_file, 'r') as f:
-                        patients.append(json.load(f))
+        page, last = [], None
+        for position in positions:
+            last_visit = rows[position].get('last_visit', '')
+            if not in_range(last_visit, since, until):
+                # Sorted by the filtered field, so past one end of the range nothing further matches
+                if sort == 'last_visit' and not (in_range(last_visit, since, None) if order == 'desc'
+                                                 else in_range(last_visit, None, until)):
+                    break
+                continue
+            if limit is not None and len(page) == limit:
+                return page, encode_cursor(sort, order, *keys[last])
+            page.append(dict(rows[position]))
+            last = position
         
-        return sorted(patients, key=lambda x: x.get('last_visit', ''), reverse=True)
+        return page, None
     
+    @metrics.timed('storage.list_patient_visits')
+    def list_patient_visits(self, patient_name: str, order: str = 'desc', limit: int = None, cursor: str = None,
+                            since: str = None, until: str = None, has_lab_orders: bool = None,
+                            has_prescriptions: bool = None, headers: bool = False,
+                            fields: List[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        One page of a patient's visits and the cursor of the next page (None
+        on the last one), by time, filtered on date and on whether the visit
+        ordered labs or prescriptions, as full records or (``headers``) as
+        visit headers, optionally projected onto ``fields``. Visits are
+        filtered on the patient's headers file; a visit file is opened only
+        for a full record on the page.
+        """
+        patient_dir = self.storage_dir / self._sanitize_filename(patient_name)
+        if not patient_dir.exists():
+            return [], None
+        
+        visit_ids = sorted(name[:-len('.json')] for name in os.listdir(patient_dir)
+                           if name.startswith('visit_') and name.endswith('.json'))
+        visit_headers = self._visit_headers(patient_dir, visit_ids)
+        if order == 'asc':
+            start = bisect_right(visit_ids, decode_cursor(cursor, order, types=VISIT_CURSOR_TYPES)[0]) if cursor else 0
+            visit_ids = visit_ids[start:]
+        else:
+            end = bisect_left(visit_ids, decode_cursor(cursor, order, types=VISIT_CURSOR_TYPES)[0]) if cursor else len(visit_ids)
+            visit_ids = visit_ids[:end][::-1]
+        from_headers = headers or (fields is not None and set(fields) <= set(HEADER_RECORD_FIELDS))
+        
+        page, last = [], None
+        for visit_id in visit_ids:
+            header = visit_headers.get(visit_id)
+            if header is None:
+                # Removed since the directory was listed
+                continue
+            if not in_range(header['timestamp'], since, until):
+                continue
+            if has_lab_orders is not None and header['has_lab_orders'] != has_lab_orders:
+                continue
+            if has_prescriptions is not None and header['has_prescriptions'] != has_prescriptions:
+                continue
+            if limit is not None and len(page) == limit:
+                return page, encode_cursor(order, last)
+            if from_headers:
+                visit = dict(header)
+            else:
+                try:
+                    with open(patient_dir / f'{visit_id}.json', 'r') as f:
+                        visit = json.load(f)
+                except FileNotFoundError:
+                    continue
+            page.append(project(visit, fields))
+            last = visit_id
+        
+        return page, None
+    
+    @metrics.timed('storage.get_patient_summary')
     def get_patient_summary(self, patient_name: str) -> Optional[Dict]:
         """Get summary for a specific patient"""
         patient_dir = self.storage_dir / self._sanitize_filename(patient_name)
@@ -79,28 +216,100 @@ class PatientStorage:
         
         return None
     
-    def update_patient_visit(self, patient_name: str, visit_id: str, updated_data: Dict) -> bool:
-        """Update an existing patient visit record"""
+    def get_patient_visit(self, patient_name: str, visit_id: str) -> Optional[Dict]:
+        """Get a single visit of a patient"""
+        visit_file = self.storage_dir / self._sanitize_filename(patient_name) / f'{visit_id}.json'
+        if not visit_file.exists():
+            return None
+        with open(visit_file, 'r') as f:
+            return json.load(f)
+    
+    @metrics.timed('storage.update_patient_visit')
+    def update_patient_visit(self, patient_name: str, visit_id: str, updated_data: Dict,
+                             expected: Dict = None, append: Dict = None) -> bool:
+        """
+        Update an existing patient visit record. When the edit changes the
+        demographics of the patient's latest visit, the patient summary is
+        rewritten with it: both files are written in full before either
+        replaces its previous version. ``expected`` and ``append`` are checked
+        and applied to the visit as stored, with the patient's lock held (see
+        apply_visit_update).
+        """
         patient_dir = self.storage_dir / self._sanitize_filename(patient_name)
         visit_file = patient_dir / f'{visit_id}.json'
-        
+        summary_file = patient_dir / 'patient_summary.json'
         if not visit_file.exists():
+            # Checked again with the lock held; this only keeps unknown patients from getting a directory
             return False
         
-        # Load existing visit
-        with open(visit_file, 'r') as f:
-            visit_record = json.load(f)
-        
-        # Update with new data
-        visit_record.update(updated_data)
-        visit_record['last_modified'] = datetime.now().isoformat()
-        
-        # Save updated visit
-        with open(visit_file, 'w') as f:
-            json.dump(visit_record, f, indent=2)
+        with self._patient_lock(patient_name):
+            if not visit_file.exists():
+                return False
+            
+            # Load existing visit
+            with open(visit_file, 'r') as f:
+                visit_record = json.load(f)
+            
+            # Update with new data
+            apply_visit_update(visit_record, updated_data, expected, append)
+            
+            summary = None
+            latest = max(patient_dir.glob('visit_*.json'), default=None)
+            if summary_file.exists() and latest is not None and latest.name == visit_file.name:
+                with open(summary_file, 'r') as f:
+                    summary = json.load(f)
+                demographics = (visit_record.get('patient_data') or {}).get('personal_info')
+                if demographics is None or summary.get('demographics') == demographics:
+                    summary = None
+                else:
+                    summary['demographics'] = demographics
+            
+            # Save updated visit (and summary)
+            visit_tmp = self._write_temp(visit_file, visit_record)
+            try:
+                summary_tmp = self._write_temp(summary_file, summary) if summary is not None else None
+            except Exception:
+                visit_tmp.unlink()
+                raise
+            os.replace(visit_tmp, visit_file)
+            self._append_headers(patient_dir, [visit_header(visit_record)])
+            if summary_tmp is not None:
+                os.replace(summary_tmp, summary_file)
+                self._update_index(patient_dir.name, summary)
         
         return True
     
+    @contextmanager
+    def _patient_lock(self, patient_name: str):
+        """
+        Exclusive access to one patient's files: a lock between the threads
+        of this process, and flock on the patient's lock file between
+        processes. Creates the patient directory.
+        """
+        key = self._sanitize_filename(patient_name)
+        with self._locks_guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            patient_dir = self.storage_dir / key
+            patient_dir.mkdir(exist_ok=True)
+            # Released when the file is closed, also when the process dies
+            with open(patient_dir / LOCK_FILE, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+    
+    def _write_temp(self, path: Path, data: Dict) -> Path:
+        """
+        Write ``data`` next to ``path`` under a temporary name, to be renamed
+        over it: readers and a crash see the old file or the new one, never a
+        truncated one. Flushed to disk first, so the rename cannot outlive the data.
+        """
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp_path
+    
     def _update_patient_summary(self, patient_name: str, visit_record: Dict):
         """Update the patient summary file"""
         patient_dir = self.storage_dir / self._sanitize_filename(patient_name)
@@ -123,17 +332,232 @@ class PatientStorage:
         summary['last_visit'] = visit_record['timestamp']
         
         # Update demographics if present
-        if 'patient_data' in visit_record and 'personal_info' in visit_record['patient_data']:
-            summary['demographics'] = visit_record['patient_data']['personal_info']
+        patient_data = visit_record.get('patient_data') or {}
+        if 'personal_info' in patient_data:
+            summary['demographics'] = patient_data['personal_info']
         
         # Save summary
-        with open(summary_file, 'w') as f:
-            json.dump(summary, f, indent=2)
+        os.replace(self._write_temp(summary_file, summary), summary_file)
+        
+        return summary
+    
+    def _load_index(self):
+        """
+        Make ``_index_rows`` current. Only the lines appended since this
+        process last read the index file are read; the whole file is read
+        again when another process compacted it. The index is rebuilt from
+        the summary files when it is missing, unreadable, of an older version,
+        or (checked on the first read per process) does not match the patient
+        directories. Call with ``_index_lock`` held.
+        """
+        index_file = self.storage_dir / INDEX_FILE
+        try:
+            stat = os.stat(index_file)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_size == 0:
+            # Empty while another process is about to replace it with its rebuild
+            self._rebuild_index(index_file, 'missing')
+            return
+        
+        first_read = index_file != self._index_file
+        if first_read or stat.st_ino != self._index_inode:
+            # A compaction or rebuild replaces the file; appends keep its inode
+            self._index_file, self._index_inode = index_file, stat.st_ino
+            self._index_rows, self._index_offset, self._index_lines = {}, 0, 0
+            self._index_sorted = {}
+        if stat.st_size == self._index_offset:
+            return
+        
+        with open(index_file, 'rb') as f:
+            f.seek(self._index_offset)
+            data = f.read()
+        # A line still being appended is picked up by the next read
+        complete = data[:data.rfind(b'\n') + 1]
+        try:
+            lines = [json.loads(line) for line in complete.splitlines()]
+        except ValueError:
+            self._rebuild_index(index_file, 'unreadable')
+            return
+        if self._index_offset == 0 and (not lines or lines[0] != {'version': INDEX_VERSION}):
+            self._rebuild_index(index_file, 'outdated')
+            return
+        
+        for key, summary in lines[1:] if self._index_offset == 0 else lines:
+            self._index_rows[key] = summary
+        self._index_offset += len(complete)
+        self._index_lines += len(lines)
+        self._index_sorted = {}
+        
+        if first_read:
+            with os.scandir(self.storage_dir) as entries:
+                patient_dirs = {entry.name for entry in entries if entry.is_dir()}
+            # A directory without a summary is a first visit still being saved
+            unlisted = [name for name in patient_dirs - set(self._index_rows)
+                        if (self.storage_dir / name / 'patient_summary.json').exists()]
+            if unlisted or not set(self._index_rows).issubset(patient_dirs):
+                self._rebuild_index(index_file, 'stale')
+    
+    def _sorted_index(self, sort: str) -> Tuple[List[tuple], List[Dict]]:
+        """Sort keys and index rows in ascending order of ``sort``, kept until the index changes"""
+        with self._index_lock:
+            self._load_index()
+            if sort not in self._index_sorted:
+                if sort == 'name':
+                    entries = [((row.get('patient_name', '').lower(), key), row) for key, row in self._index_rows.items()]
+                else:
+                    entries = [((row.get(sort, ''), key), row) for key, row in self._index_rows.items()]
+                entries.sort(key=lambda entry: entry[0])
+                self._index_sorted[sort] = ([key for key, _ in entries], [row for _, row in entries])
+            return self._index_sorted[sort]
+    
+    def _visit_headers(self, patient_dir: Path, visit_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Headers of the visits ``visit_ids``, from the patient's headers file,
+        where a later line supersedes an earlier one of the same visit. A
+        visit without a header (saved before headers existed, or still being
+        saved) has its header added; an unreadable or mostly superseded file
+        is rewritten.
+        """
+        headers_file = patient_dir / HEADERS_FILE
+        headers, lines = self._read_headers(headers_file)
+        if lines is not None and lines <= 2 * len(visit_ids) + HEADERS_SLACK_LINES and \
+                all(visit_id in headers for visit_id in visit_ids):
+            return headers
+        
+        with self._patient_lock(patient_dir.name):
+            # Read again: a save may have appended since
+            headers, lines = self._read_headers(headers_file)
+            missing = [visit_id for visit_id in visit_ids if visit_id not in headers]
+            for visit_id in missing:
+                try:
+                    with open(patient_dir / f'{visit_id}.json', 'r') as f:
+                        headers[visit_id] = visit_header({'visit_id': visit_id, **json.load(f)})
+                except FileNotFoundError:
+                    pass
+            if lines is None or lines > 2 * len(visit_ids) + HEADERS_SLACK_LINES:
+                tmp_path = self._write_temp_lines(headers_file, [headers[v] for v in visit_ids if v in headers])
+                os.replace(tmp_path, headers_file)
+            else:
+                self._append_headers(patient_dir, [headers[v] for v in missing if v in headers])
+        return headers
+    
+    def _read_headers(self, headers_file: Path) -> Tuple[Dict[str, Dict], Optional[int]]:
+        """The headers in ``headers_file`` by visit ID and its number of lines (None when unreadable)"""
+        headers = {}
+        try:
+            with open(headers_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return headers, 0
+        # A line still being appended is picked up by the next read
+        lines = data[:data.rfind(b'\n') + 1].splitlines()
+        try:
+            for line in lines:
+                header = json.loads(line)
+                headers[header['visit_id']] = header
+        except (ValueError, KeyError, TypeError):
+            return {}, None
+        return headers, len(lines)
+    
+    def _append_headers(self, patient_dir: Path, headers: List[Dict]):
+        """Append visit headers to the patient's headers file; call with the patient lock held"""
+        if headers:
+            with open(patient_dir / HEADERS_FILE, 'ab') as f:
+                f.write(b''.join(json.dumps(header, separators=(',', ':')).encode() + b'\n' for header in headers))
+    
+    def _write_temp_lines(self, path: Path, rows: List) -> Path:
+        """Write ``rows`` as JSON lines next to ``path`` under a temporary name, to be renamed over it"""
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            for row in rows:
+                f.write(json.dumps(row, separators=(',', ':')).encode() + b'\n')
+        return tmp_path
+    
+    def _rebuild_index(self, index_file: Path, reason: str):
+        with self._locked_index_file(index_file):
+            rows = {}
+            for patient_dir in self.storage_dir.iterdir():
+                if patient_dir.is_dir():
+                    summary_file = patient_dir / 'patient_summary.json'
+                    if summary_file.exists():
+                        with open(summary_file, 'r') as f:
+                            rows[patient_dir.name] = json.load(f)
+            self._replace_index(index_file, rows)
+        print(f"↺ Rebuilt {reason} patient index: {len(rows)} patients")
+    
+    def _update_index(self, key: str, summary: Dict):
+        """Append the new index row of one patient"""
+        line = json.dumps([key, summary], separators=(',', ':')).encode() + b'\n'
+        with self._index_lock:
+            self._load_index()
+            index_file = self._index_file
+            with self._locked_index_file(index_file) as f:
+                f.write(line)
+            self._load_index()
+            
+            # Superseded rows pile up; rewrite the file once they outnumber the live ones
+            if self._index_lines > 2 * len(self._index_rows) + INDEX_SLACK_LINES:
+                with self._locked_index_file(index_file) as f:
+                    # A row another process appended meanwhile would be lost; compact on a later update
+                    stat = os.fstat(f.fileno())
+                    if stat.st_ino == self._index_inode and stat.st_size == self._index_offset:
+                        self._replace_index(index_file, self._index_rows)
+    
+    def _replace_index(self, index_file: Path, rows: Dict[str, Dict]):
+        """Write ``rows`` as a new index file, one line each; call with the index file locked"""
+        tmp_path = index_file.with_name(f'.{index_file.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'version': INDEX_VERSION}, separators=(',', ':')).encode() + b'\n')
+            for key, summary in rows.items():
+                f.write(json.dumps([key, summary], separators=(',', ':')).encode() + b'\n')
+            size = f.tell()
+        os.replace(tmp_path, index_file)
+        
+        self._index_file = index_file
+        self._index_inode = os.stat(index_file).st_ino
+        self._index_rows = dict(rows)
+        self._index_offset = size
+        self._index_lines = len(rows) + 1
+        self._index_sorted = {}
+    
+    @contextmanager
+    def _locked_index_file(self, index_file: Path):
+        """
+        The index file opened for appending, locked against the other
+        processes' appends and rewrites. A process that waited while the file
+        was replaced locks the new one, so no row is appended to a replaced file.
+        """
+        while True:
+            f = open(index_file, 'ab')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(index_file).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        try:
+            yield f
+        finally:
+            f.close()
     
     def _sanitize_filename(self, name: str) -> str:
         """Sanitize patient name for use as filename"""
         return "".join(c for c in name if c.isalnum() or c in (' ', '-', '_')).strip().replace(' ', '_')
 
 
+def create_patient_storage(backend: str = None):
+    """The storage for ``backend``, by default the one MEDFLOW_STORAGE_BACKEND names"""
+    backend = (backend or os.getenv('MEDFLOW_STORAGE_BACKEND', 'json')).strip().lower()
+    if backend == 'json':
+        return PatientStorage()
+    if backend == 'database':
+        # Imported here: the models need the app registry, the JSON backend does not
+        from .patient_db_storage import DatabasePatientStorage
+        return DatabasePatientStorage()
+    raise ValueError(f"Unknown storage backend '{backend}' (expected 'json' or 'database')")
+
+
 # Singleton instance
-patient_storage = PatientStorage()
+patient_storage = create_patient_storage()
@@ -0,0 +1,91 @@
+"""
+Checkpoints of consultation pipeline runs
+
+Every stage's output is saved under the run's ID as soon as the stage
+finishes. When a stage fails, the run is left incomplete; posting the same
+run ID again runs only the stages that have no checkpoint, so a transient
+failure of one agent costs one call instead of all of them. A finished run
+keeps its response, and its checkpoints are dropped.
+"""
+from typing import Dict, Any, List, Tuple
+
+from django.db import IntegrityError
+
+from .models import PipelineRun, PipelineCheckpoint
+
+
+class PipelineRunNotFound(Exception):
+    """Raised when a retry names a run that does not exist"""
+
+
+class PipelineRuns:
+
+    def open(self, transcription: str, audio_file: str, mode: str, run_id: str = None,
+             create: bool = True) -> Tuple[PipelineRun, Dict[str, Any]]:
+        """
+        The run to execute and the stage outputs it already has. An existing
+        run keeps its transcription and mode; without ``create`` an unknown
+        ``run_id`` raises PipelineRunNotFound.
+        """
+        run = PipelineRun.objects.filter(run_id=run_id).first() if run_id else None
+        if run is None:
+            if run_id and not create:
+                raise PipelineRunNotFound(f"Pipeline run {run_id} not found")
+            if not transcription:
+                raise ValueError('No transcription provided')
+            fields = {'run_id': run_id} if run_id else {}
+            run = PipelineRun.objects.create(
+                mode=mode,
+                transcription=transcription,
+                audio_file=audio_file or '',
+                attempts=1,
+                **fields
+            )
+            return run, {}
+
+        if transcription and transcription != run.transcription:
+            raise ValueError(f"Pipeline run {run.run_id} was started with a different transcription")
+        if run.status == PipelineRun.STATUS_SUCCEEDED:
+            return run, {}
+
+        run.attempts += 1
+        run.status = PipelineRun.STATUS_RUNNING
+        run.save(update_fields=['attempts', 'status', 'updated_at'])
+        completed = {c.stage: c.output for c in run.checkpoints.all()}
+        if completed:
+            print(f"↺ Resuming pipeline run {run.run_id} (attempt {run.attempts}), "
+                  f"skipping {', '.join(completed)}")
+        return run, completed
+
+    def checkpoint(self, run: PipelineRun, stage: str, output: Any):
+        try:
+            PipelineCheckpoint.objects.create(run=run, stage=stage, output=output)
+        except IntegrityError:
+            # A concurrent retry of the same run got there first; its output is as good
+            pass
+
+    def fail(self, run: PipelineRun, stage: str, error: Exception, outputs: Dict[str, Any],
+             usage_calls: List[Dict[str, Any]]):
+        """Mark the run incomplete, keeping every output the failed attempt produced"""
+        saved = set(run.checkpoints.values_list('stage', flat=True))
+        for name, output in outputs.items():
+            if name not in saved:
+                self.checkpoint(run, name, output)
+        run.status = PipelineRun.STATUS_INCOMPLETE
+        run.failed_stage = stage
+        run.error = str(error)
+        run.usage_calls = list(run.usage_calls) + list(usage_calls)
+        run.save(update_fields=['status', 'failed_stage', 'error', 'usage_calls', 'updated_at'])
+
+    def succeed(self, run: PipelineRun, result: Dict[str, Any]):
+        run.status = PipelineRun.STATUS_SUCCEEDED
+        run.failed_stage = ''
+        run.error = ''
+        run.result = result
+        run.save(update_fields=['status', 'failed_stage', 'error', 'result', 'updated_at'])
+        # The response holds everything a later retry needs
+        run.checkpoints.all().delete()
+
+
+# Singleton instance
+pipeline_runs = PipelineRuns()
@@ -0,0 +1,304 @@
+"""
+Consultation processing shared by the API views and the background job workers
+"""
+import json
+from pathlib import Path
+from datetime import datetime
+from asgiref.sync import sync_to_async
+from .patient_storage import patient_storage
+from .visit_updates import VisitChanged
+from .pipeline_runs import pipeline_runs
+from .models import PipelineRun
+from .usage import usage_ledger
+
+# Complete records of every processed consultation
+OUTPUT_DIR = Path(__file__).parent / 'src' / 'output'
+# Tries of a recompute that keeps finding the visit edited under it
+RECOMPUTE_ATTEMPTS = 3
+
+
+class PipelineIncomplete(Exception):
+    """A stage failed; ``payload`` is the partial response, naming the run to retry"""
+
+    def __init__(self, payload):
+        super().__init__(payload['error'])
+        self.payload = payload
+
+
+def run_consultation_pipeline(transcription, audio_filename='', run_id=None, create=True):
+    """
+    Run all five agents on a transcription, persist the results and return the API payload.
+    With ``run_id`` an earlier incomplete run is resumed from its checkpoints.
+    """
+    from pipeline import build_pipeline_stages, pipeline_executor, pipeline_mode, PipelineError
+    from llm_client import record_usage
+    
+    run, completed = pipeline_runs.open(transcription, audio_filename, pipeline_mode(), run_id, create)
+    if run.status == PipelineRun.STATUS_SUCCEEDED:
+        print(f"✓ Pipeline run {run.run_id} already completed")
+        return run.result
+    
+    print("\n" + "="*80)
+    print("PROCESSING TRANSCRIPTION THROUGH AGENTS")
+    print("="*80)
+    print(f"Audio file: {run.audio_file}")
+    
+    # Multi mode: demographics and SOAP note run in parallel, then the three
+    # SOAP-dependent agents run in parallel. Fused mode: one combined call.
+    # A resumed run keeps the mode it was started in, so its checkpoints match.
+    stages = build_pipeline_stages(run.mode)
+    print(f"Running pipeline in {run.mode} mode on up to {pipeline_executor.max_workers} workers...")
+    with record_usage() as usage:
+        try:
+            result = pipeline_executor.run(
+                stages,
+                {'transcription': run.transcription},
+                completed=completed,
+                on_stage_complete=lambda name, output: pipeline_runs.checkpoint(run, name, output)
+            )
+        except PipelineError as e:
+            raise PipelineIncomplete(record_incomplete_run(run, stages, e, usage.calls)) from e
+    print_stage_timings(result)
+    
+    return finish_pipeline_run(run, result, completed, usage.calls)
+
+
+async def arun_consultation_pipeline(transcription, audio_filename='', run_id=None, create=True):
+    """Async counterpart of run_consultation_pipeline"""
+    from pipeline import build_pipeline_stages, pipeline_executor, pipeline_mode, PipelineError
+    from llm_client import record_usage
+    
+    run, completed = await sync_to_async(pipeline_runs.open)(
+        transcription, audio_filename, pipeline_mode(), run_id, create
+    )
+    if run.status == PipelineRun.STATUS_SUCCEEDED:
+        print(f"✓ Pipeline run {run.run_id} already completed")
+        return run.result
+    
+    print("\n" + "="*80)
+    print("PROCESSING TRANSCRIPTION THROUGH AGENTS (ASYNC)")
+    print("="*80)
+    print(f"Audio file: {run.audio_file}")
+    
+    stages = build_pipeline_stages(run.mode, use_async=True)
+    checkpoint = sync_to_async(pipeline_runs.checkpoint)
+    with record_usage() as usage:
+        try:
+            result = await pipeline_executor.arun(
+                stages,
+                {'transcription': run.transcription},
+                completed=completed,
+                on_stage_complete=lambda name, output: checkpoint(run, name, output)
+            )
+        except PipelineError as e:
+            payload = await sync_to_async(record_incomplete_run)(run, stages, e, usage.calls)
+            raise PipelineIncomplete(payload) from e
+    print_stage_timings(result)
+    
+    return await sync_to_async(finish_pipeline_run)(run, result, completed, usage.calls)
+
+
+def record_incomplete_run(run, stages, error, usage_calls):
+    """Checkpoint what a failed attempt produced and build the partial-success payload"""
+    from pipeline import CONSULTATION_OUTPUTS
+    
+    usage_calls = list(usage_calls)
+    pipeline_runs.fail(run, error.stage, error.error, error.outputs, usage_calls)
+    usage_ledger.record(usage_calls)
+    
+    completed = [stage.name for stage in stages if stage.name in error.outputs]
+    missing = [stage.name for stage in stages if stage.name not in error.outputs]
+    print(f"❌ Pipeline run {run.run_id} incomplete: {error}")
+    print(f"  - Completed: {', '.join(completed) or 'none'}")
+    print(f"  - Missing: {', '.join(missing)}")
+    
+    payload = {
+        'success': False,
+        'partial': True,
+        'error': str(error),
+        'run_id': run.run_id,
+        'failed_stage': error.stage,
+        'completed_stages': completed,
+        'missing_stages': missing,
+        'transcription': run.transcription,
+    }
+    payload.update({name: output for name, output in error.outputs.items() if name in CONSULTATION_OUTPUTS})
+    return payload
+
+
+def finish_pipeline_run(run, result, completed, usage_calls):
+    payload = save_pipeline_results(
+        run.transcription, run.audio_file, result, usage_calls, earlier_usage_calls=run.usage_calls
+    )
+    payload['metadata']['run_id'] = run.run_id
+    payload['metadata']['attempts'] = run.attempts
+    if completed:
+        payload['metadata']['resumed_stages'] = list(completed)
+    pipeline_runs.succeed(run, payload)
+    return payload
+
+
+def save_pipeline_results(transcription, audio_filename, result, usage_calls=(), earlier_usage_calls=()):
+    """
+    Persist a finished pipeline run and build the API response payload. The
+    visit's usage covers ``earlier_usage_calls`` of failed attempts too; those
+    were already written to the ledger when the attempt failed.
+    """
+    patient_data = result['patient_data']
+    soap_note = result['soap_note']
+    clinical_data = result['clinical_data']
+    lab_requisition = result['lab_requisition']
+    pharmacy_requisition = result['pharmacy_requisition']
+    usage = usage_ledger.summarize(list(earlier_usage_calls) + list(usage_calls))
+    
+    # Save complete record to file
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_dir = OUTPUT_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    complete_record = {
+        "metadata": {
+            "generated_at": datetime.now().isoformat(),
+            "audio_file": audio_filename,
+            "timestamp": timestamp
+        },
+        "transcription": transcription,
+        "patient_demographics": patient_data,
+        "soap_note": soap_note,
+        "clinical_data": clinical_data,
+        "lab_requisition": lab_requisition,
+        "pharmacy_requisition": pharmacy_requisition,
+        "usage": usage
+    }
+    
+    output_file = output_dir / f'complete_record_{timestamp}.json'
+    with open(output_file, 'w') as f:
+        json.dump(complete_record, f, indent=2)
+    
+    print(f"✓ Complete record saved: {output_file}\n")
+    
+    # Save patient visit to storage
+    patient_name = patient_data.get('personal_info', {}).get('full_name', 'Unknown')
+    visit_id = ''
+    if patient_name != 'Unknown':
+        visit_data = {
+            'patient_name': patient_name,
+            'patient_mrn': f"{patient_name[:3].upper()}-{datetime.now().year}-{datetime.now().strftime('%m%d%H%M')}",
+            'transcription': transcription,
+            'patient_data': patient_data,
+            'soap_note': soap_note,
+            'clinical_data': clinical_data,
+            'lab_requisition': lab_requisition,
+            'pharmacy_requisition': pharmacy_requisition,
+            'audio_file': audio_filename,
+            'usage': usage,
+        }
+        visit_id = patient_storage.save_patient_visit(visit_data)
+        print(f"✓ Patient visit saved: {visit_id}\n")
+    
+    usage_ledger.record(list(usage_calls), visit_id, patient_name if visit_id else '')
+    print(f"✓ LLM usage: {usage['total_tokens']} tokens in {usage['calls']} calls, ${usage['cost_usd']:.4f}\n")
+    
+    return {
+        'success': True,
+        'transcription': transcription,
+        'patient_data': patient_data,
+        'soap_note': soap_note,
+        'clinical_data': clinical_data,
+        'lab_requisition': lab_requisition,
+        'pharmacy_requisition': pharmacy_requisition,
+        'metadata': {
+            'generated_at': datetime.now().isoformat(),
+            'audio_file': audio_filename,
+            'timestamp': timestamp,
+            'stage_timings': result.timing_summary(),
+            'usage': usage
+        }
+    }
+
+
+def print_stage_timings(result):
+    for stage_name, seconds in result.timings.items():
+        print(f"  - {stage_name}: {seconds:.2f}s")
+    print(f"✓ All agents completed successfully in {result.total_seconds:.2f}s\n")
+
+
+def recompute_visit(patient_name, visit_id, updated_data):
+    """
+    Apply an edit to a stored visit and rerun only the agents whose inputs it
+    changed (e.g. a new SOAP plan reruns clinical data, lab and pharmacy but
+    not demographics). Returns None when the visit does not exist.
+    The results are saved only if the visit still holds what the agents ran
+    on; when another edit or recompute landed meanwhile the recompute starts
+    over from the new visit, and VisitChanged is raised after
+    RECOMPUTE_ATTEMPTS tries.
+    """
+    for attempt in range(1, RECOMPUTE_ATTEMPTS + 1):
+        try:
+            return _recompute_visit(patient_name, visit_id, updated_data)
+        except VisitChanged as e:
+            if attempt == RECOMPUTE_ATTEMPTS:
+                raise
+            print(f"↺ Visit {visit_id} changed during the recompute ({', '.join(e.fields)}), starting over")
+
+
+def _recompute_visit(patient_name, visit_id, updated_data):
+    from pipeline import build_consultation_stages, pipeline_executor, changed_fields, stale_stages
+    from llm_client import record_usage
+    
+    visit = patient_storage.get_patient_visit(patient_name, visit_id)
+    if visit is None:
+        return None
+    
+    # Always the five-agent graph: a fused call cannot rerun one agent on its own
+    stages = build_consultation_stages()
+    outputs = [stage.name for stage in stages]
+    changed = changed_fields(visit, updated_data, ['transcription'] + outputs)
+    merged = {**visit, **updated_data}
+    rerun = stale_stages(stages, changed, edited=[name for name in outputs if name in updated_data])
+    if rerun:
+        # A stage the stored visit has no output for is recomputed, not fed to the others as None
+        missing = [name for name in outputs if name not in rerun and name not in updated_data and merged.get(name) is None]
+        rerun = [name for name in outputs if name in rerun or name in missing]
+    reused = [name for name in outputs if name not in rerun]
+    
+    updates = dict(updated_data)
+    usage_calls = []
+    print(f"\n↻ Recomputing {visit_id}: changed {', '.join(changed) or 'nothing'}; "
+          f"rerunning {', '.join(rerun) or 'nothing'}")
+    if rerun:
+        with record_usage() as usage:
+            result = pipeline_executor.run(
+                stages,
+                {'transcription': merged.get('transcription', '')},
+                completed={name: merged.get(name) for name in reused}
+            )
+        print_stage_timings(result)
+        usage_calls = list(usage.calls)
+        updates.update({name: result[name] for name in rerun})
+    
+    recomputation = {
+        'recomputed_at': datetime.now().isoformat(),
+        'changed_fields': changed,
+        'recomputed': rerun,
+        'reused': reused,
+        'usage': usage_ledger.summarize(usage_calls),
+    }
+    
+    try:
+        # Written only if the transcription and agent outputs are still the ones read above
+        updated = patient_storage.update_patient_visit(
+            patient_name, visit_id, updates,
+            expected={name: visit.get(name) for name in ['transcription'] + outputs},
+            append={'recomputations': recomputation}
+        )
+    finally:
+        # The tokens were spent whether or not the results are kept
+        usage_ledger.record(usage_calls, visit_id, patient_name)
+    if not updated:
+        return None
+    
+    return {
+        **recomputation,
+        'visit': patient_storage.get_patient_visit(patient_name, visit_id),
+    }
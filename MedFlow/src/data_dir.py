@@ -0,0 +1,17 @@
+"""
+Where MedFlow keeps the files it writes at run time: the LLM response cache,
+rate limit buckets, metrics and the order prefilter log.
+
+MEDFLOW_DATA_DIR (environment or MedFlow/.env) chooses the directory; the
+default is var/ at the top of the checkout, outside the source tree. Each
+file can still be moved on its own with its own variable.
+"""
+import os
+from pathlib import Path
+
+DEFAULT_DATA_DIR = Path(__file__).resolve().parents[2] / 'var'
+
+
+def data_path(*parts: str) -> Path:
+    """``parts`` under the data directory"""
+    return Path(os.getenv('MEDFLOW_DATA_DIR') or DEFAULT_DATA_DIR).joinpath(*parts)
@@ -1,7 +1,8 @@
 import os
 import json
 from typing import Dict, Any
-from openai import OpenAI
+from openai import AsyncOpenAI
+from llm_client import get_client, get_async_client, chat_completion, achat_completion
 from prompt_loader import PromptLoader
 
 class SOAPDataExtractor:
@@ -10,48 +11,71 @@ class SOAPDataExtractor:
         self.api_key = api_key or os.getenv('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("OpenAI API key required")
-        self.client = OpenAI(api_key=self.api_key)
+        self.client = get_client(self.api_key)
         self.prompt_loader = PromptLoader(prompts_file)
         self.config = self.prompt_loader.get_config('data_extraction')
     
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        # Async clients are bound to the running event loop
+        return get_async_client(self.api_key)
+    
     def extract_data(self, soap_note: str, preserve_structure: bool = True) -> Dict[str, Any]:
-        if isinstance(soap_note, dict):
-            soap_text = self._dict_to_text(soap_note)
-        else:
-            soap_text = soap_note
-        
-        if not soap_text or len(soap_text.strip()) < 10:
-            raise ValueError("SOAP note too short")
+        request = self._build_request(soap_note)
         
         try:
-            user_message = self.config['user_message_template'].format(
-                soap_note=soap_text
-            )
+            content = chat_completion(self.client, 'data_extraction', request)
+            return self._handle_response(content, preserve_structure)
             
-            response = self.client.chat.completions.create(
-                model=self.config['model'],
-                messages=[
-                    {"role": "system", "content": self.config['system_prompt']},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=self.config['temperature'],
-                max_tokens=self.config['max_tokens'],
-                response_format={"type": "json_object"}
-            )
-            
-            content = response.choices[0].message.content
-            data = json.loads(content)
-            
-            if preserve_structure:
-                return self._clean_empty_fields(data)
-            else:
-                return data
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse JSON response: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error extracting data: {str(e)}")
+    
+    async def aextract_data(self, soap_note: str, preserve_structure: bool = True) -> Dict[str, Any]:
+        request = self._build_request(soap_note)
+        
+        try:
+            content = await achat_completion(self.async_client, 'data_extraction', request)
+            return self._handle_response(content, preserve_structure)
             
         except json.JSONDecodeError as e:
             raise Exception(f"Failed to parse JSON response: {str(e)}")
         except Exception as e:
             raise Exception(f"Error extracting data: {str(e)}")
     
+    def _build_request(self, soap_note: str) -> Dict[str, Any]:
+        if isinstance(soap_note, dict):
+            soap_text = self._dict_to_text(soap_note)
+        else:
+            soap_text = soap_note
+        
+        if not soap_text or len(soap_text.strip()) < 10:
+            raise ValueError("SOAP note too short")
+        
+        user_message = self.config['user_message_template'].format(
+            soap_note=soap_text
+        )
+        
+        return {
+            "model": self.config['model'],
+            "messages": [
+                {"role": "system", "content": self.config['system_prompt']},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": self.config['temperature'],
+            "max_tokens": self.config['max_tokens'],
+            "response_format": {"type": "json_object"}
+        }
+    
+    def _handle_response(self, content: str, preserve_structure: bool) -> Dict[str, Any]:
+        data = json.loads(content)
+        
+        if preserve_structure:
+            return self._clean_empty_fields(data)
+        else:
+            return data
+    
     def _clean_empty_fields(self, data: Dict[str, Any]) -> Dict[str, Any]:
         if isinstance(data, dict):
             return {
@@ -0,0 +1,373 @@
+import re
+from datetime import date, datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from order_prefilter import DRUG_SUFFIX_PATTERN
+
+# Fields the patient_data_extraction prompt asks for, and where each goes in its JSON
+FIELDS = {
+    'full_name': ('personal_info', 'full_name'),
+    'date_of_birth': ('personal_info', 'date_of_birth'),
+    'age': ('personal_info', 'age'),
+    'gender': ('personal_info', 'gender'),
+    'phone': ('contact_info', 'phone'),
+    'address': ('contact_info', 'address'),
+    'patient_id': ('identifiers', 'patient_id'),
+    'allergies': ('medical_history', 'allergies'),
+    'current_medications': ('medical_history', 'current_medications'),
+}
+
+# How each field is described to the LLM when the rules leave it unresolved
+FIELD_DESCRIPTIONS = {
+    'full_name': 'patient full name, "First Last"',
+    'date_of_birth': 'date of birth, YYYY-MM-DD',
+    'age': 'age in years, integer',
+    'gender': 'gender',
+    'phone': 'phone number',
+    'address': 'address as one string',
+    'patient_id': 'patient ID or medical record number',
+    'allergies': 'list of known allergies, [] if the patient has none',
+    'current_medications': 'list of current medications with dose, [] if none',
+}
+
+# Words that show the conversation talks about a field; with no cue the field
+# is simply absent, with a cue the rules must parse it or hand it to the LLM
+CUES = {
+    'date_of_birth': re.compile(r'\b(?:date of birth|birth ?date|birthday|born|dob|d\.o\.b)\b', re.I),
+    'age': re.compile(r'\b(?:how old|years? old|year-old|age)\b', re.I),
+    'gender': re.compile(r'\b(?:gender|sex|male|female|woman|man|boy|girl|mr|mrs|ms|miss|sir|ma\'am|non-binary)\b', re.I),
+    'phone': re.compile(r'\b(?:phone|cell|telephone|contact number|call you|reach you)\b|\d{3}[-.\s]\d{4}\b', re.I),
+    'address': re.compile(r'\b(?:address|live at|live on|street|avenue|road|apartment|zip)\b', re.I),
+    'patient_id': re.compile(r'\b(?:patient id|patient number|id number|mrn|medical record|chart number)\b', re.I),
+    'allergies': re.compile(r'\ballerg', re.I),
+    'current_medications': re.compile(r'\b(?:medications?|meds|taking any|currently taking|prescriptions?)\b', re.I),
+}
+
+# Questions that make the next patient turn the answer for a field
+QUESTIONS = {
+    'full_name': re.compile(r'\bname\b', re.I),
+    'date_of_birth': CUES['date_of_birth'],
+    'age': re.compile(r'\bhow old\b|\byour age\b', re.I),
+    'gender': re.compile(r'\b(?:gender|sex)\b', re.I),
+    'phone': re.compile(r'\b(?:phone|number|reach you|call you)\b', re.I),
+    'address': re.compile(r'\b(?:address|where do you live)\b', re.I),
+    'allergies': CUES['allergies'],
+    'current_medications': CUES['current_medications'],
+}
+
+TURN = re.compile(r'(?:^|\n|(?<=[.?!]) )\s*(Doctor|Dr\.?|Physician|Provider|Nurse|Patient)\s*:\s*', re.I)
+
+MONTHS = {
+    name: index for index, names in enumerate([
+        ('january', 'jan'), ('february', 'feb'), ('march', 'mar'), ('april', 'apr'), ('may',),
+        ('june', 'jun'), ('july', 'jul'), ('august', 'aug'), ('september', 'sep', 'sept'),
+        ('october', 'oct'), ('november', 'nov'), ('december', 'dec'),
+    ], start=1) for name in names
+}
+MONTH = r'(' + '|'.join(sorted(MONTHS, key=len, reverse=True)) + r')\.?'
+DAY = r'(\d{1,2})(?:st|nd|rd|th)?'
+DATE_PATTERNS = (
+    (re.compile(MONTH + r'\s+' + DAY + r',?\s+(\d{4})', re.I), ('month', 'day', 'year')),
+    (re.compile(DAY + r'\s+(?:of\s+)?' + MONTH + r',?\s+(\d{4})', re.I), ('day', 'month', 'year')),
+    (re.compile(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b'), ('year', 'month', 'day')),
+    (re.compile(r'\b(\d{1,2})[/-](\d{1,2})[/-](\d{4})\b'), ('month', 'day', 'year')),
+)
+
+AGE = re.compile(r'\b(\d{1,3})[-\s]years?[-\s]old\b|\b(?:i\'m|i am|age(?: is)?)\s+(\d{1,3})\b(?!\s*(?:lbs?|pounds|kg|%|/))', re.I)
+YEARS_OLD = re.compile(r'\b(\d{1,3})[-\s]years?[-\s]old\b', re.I)
+STATED_GENDER = re.compile(r'\b(\d{1,3})[-\s]years?[-\s]old\s+(male|female|man|woman|boy|girl)\b', re.I)
+GENDER_WORDS = {
+    'male': 'male', 'man': 'male', 'boy': 'male',
+    'female': 'female', 'woman': 'female', 'girl': 'female',
+    'non-binary': 'non-binary', 'nonbinary': 'non-binary',
+}
+GENDER_ANSWER = re.compile(r'\b(' + '|'.join(GENDER_WORDS) + r')\b', re.I)
+PHONE = re.compile(r'(?<!\d)(?:\+?1[-.\s]?)?\(?(\d{3})\)?[-.\s]?(\d{3})[-.\s](\d{4})(?!\d)')
+PATIENT_ID = re.compile(
+    r'\b(?:patient id|patient number|id number|mrn|medical record(?: number)?|chart number)'
+    r'(?:\s+(?:is|number))?\s*[:#]?\s*([A-Z]{0,4}-?\d[A-Z0-9-]*)', re.I
+)
+ADDRESS = re.compile(r'^\d+[A-Za-z]?\s+[A-Za-z0-9 .\'-]+(?:,\s*[A-Za-z0-9 .\'-]+){0,4}$')
+NAME = re.compile(r"^[A-Z][a-zA-Z'\-]+(?:\s+[A-Z][a-zA-Z'\-\.]*){1,3}$")
+NAME_LEAD_IN = re.compile(r"^(?:(?:yes|yeah|sure|okay|ok|hi|hello)[,.!]?\s+)?(?:my (?:full )?name is|it's|it is|i'm|i am|this is)\s+", re.I)
+INLINE_NAME = re.compile(r"\b(?i:my (?:full )?name is)\s+([A-Z][a-zA-Z'\-]+(?:\s+[A-Z][a-zA-Z'\-]+){1,3})")
+# A "none" answer: every clause of it must be one of these
+NEGATIVE = re.compile(
+    r"(?:(?:um|uh|well|oh|hmm)\s+)*(?:"
+    r"no|nope|nah|none|nothing|nothing at all|not really|not any|no known (?:drug )?allergies|no allergies|"
+    r"no (?:medications?|meds)|nkda|nka|none that i(?:'m| am)? (?:know of|aware of)|"
+    r"not that i(?:'m| am)? (?:know of|aware of|can think of|remember)|i don'?t think so|i do not think so|"
+    r"i(?:'m| am) not (?:on|taking) any(?:thing| medications?| meds)?|i(?:'m| am) not (?:on|taking) anything|"
+    r"i don'?t (?:take|have) any(?:thing| medications?| meds| allergies)?|i do not (?:take|have) any(?:thing)?|"
+    r"(?:i(?:'m| am) )?not allergic to anything|not (?:at the moment|currently|right now)|"
+    r"no doctor"
+    r")", re.I
+)
+# Clauses that may stand next to a "none" answer without changing it
+FILLER = re.compile(r"um|uh|well|oh|hmm|doctor|doc|thank you|thanks|sorry", re.I)
+LIST_LEAD_IN = re.compile(r"^(?:(?:yes|yeah|yep|sure|um|uh)[,.!]?\s*)*(?:i(?:'m| am) (?:allergic to|taking|on)|i take|just|only|to)?\s*", re.I)
+LIST_SPLIT = re.compile(r',\s*(?:and\s+)?|\s+and\s+|;\s*')
+
+# Drugs patients name when asked what they take; generic names with a class
+# stem (-pril, -statin, ...) are recognized without being listed
+MEDICATIONS = {
+    'acetaminophen', 'tylenol', 'aspirin', 'baby aspirin', 'ibuprofen', 'advil', 'motrin', 'naproxen', 'aleve',
+    'metformin', 'glipizide', 'glyburide', 'insulin', 'lantus', 'humalog', 'januvia', 'jardiance', 'farxiga',
+    'ozempic', 'trulicity', 'mounjaro', 'levothyroxine', 'synthroid', 'lisinopril', 'losartan', 'valsartan',
+    'amlodipine', 'norvasc', 'diltiazem', 'verapamil', 'metoprolol', 'atenolol', 'carvedilol', 'propranolol',
+    'hydrochlorothiazide', 'hctz', 'chlorthalidone', 'furosemide', 'lasix', 'spironolactone', 'clonidine',
+    'hydralazine', 'atorvastatin', 'lipitor', 'simvastatin', 'zocor', 'rosuvastatin', 'crestor', 'pravastatin',
+    'warfarin', 'coumadin', 'eliquis', 'xarelto', 'clopidogrel', 'plavix', 'digoxin', 'amiodarone',
+    'nitroglycerin', 'omeprazole', 'prilosec', 'pantoprazole', 'protonix', 'nexium', 'famotidine', 'pepcid',
+    'albuterol', 'ventolin', 'proair', 'advair', 'symbicort', 'flonase', 'singulair', 'cetirizine', 'zyrtec',
+    'loratadine', 'claritin', 'fexofenadine', 'allegra', 'diphenhydramine', 'benadryl', 'sertraline',
+    'zoloft', 'prozac', 'celexa', 'lexapro', 'bupropion', 'wellbutrin', 'trazodone', 'venlafaxine', 'effexor',
+    'cymbalta', 'buspirone', 'alprazolam', 'xanax', 'lorazepam', 'ativan', 'clonazepam', 'klonopin',
+    'zolpidem', 'ambien', 'quetiapine', 'seroquel', 'lamotrigine', 'lamictal', 'levetiracetam', 'keppra',
+    'topiramate', 'gabapentin', 'neurontin', 'pregabalin', 'lyrica', 'cyclobenzaprine', 'flexeril',
+    'tramadol', 'oxycodone', 'hydrocodone', 'norco', 'percocet', 'morphine', 'prednisone', 'medrol',
+    'tamsulosin', 'flomax', 'finasteride', 'sildenafil', 'viagra', 'tadalafil', 'cialis', 'allopurinol',
+    'colchicine', 'methotrexate', 'hydroxychloroquine', 'plaquenil', 'estradiol', 'progesterone',
+    'testosterone', 'birth control', 'the pill', 'amoxicillin', 'augmentin', 'azithromycin', 'z-pack',
+    'doxycycline', 'cephalexin', 'keflex', 'bactrim', 'ondansetron', 'zofran', 'melatonin', 'multivitamin',
+    'multivitamins', 'vitamin d', 'vitamin b12', 'b12', 'vitamin c', 'vitamins', 'fish oil', 'calcium',
+    'iron', 'folic acid', 'magnesium', 'potassium', 'probiotic', 'probiotics', 'miralax', 'docusate',
+    'epipen', 'inhaler',
+}
+# What patients report being allergic to, drugs included
+ALLERGENS = MEDICATIONS | {
+    'penicillin', 'penicillins', 'sulfa', 'sulfonamides', 'cephalosporins', 'codeine', 'nsaids',
+    'erythromycin', 'tetracycline', 'ciprofloxacin', 'cipro', 'vancomycin', 'contrast', 'iodine', 'latex',
+    'adhesive', 'tape', 'nickel', 'lidocaine', 'novocaine', 'anesthesia', 'peanuts', 'peanut', 'tree nuts',
+    'nuts', 'almonds', 'walnuts', 'cashews', 'shellfish', 'shrimp', 'fish', 'eggs', 'egg', 'milk', 'dairy',
+    'lactose', 'soy', 'wheat', 'gluten', 'sesame', 'strawberries', 'bee stings', 'bees', 'wasps', 'pollen',
+    'ragweed', 'grass', 'dust', 'dust mites', 'mold', 'cats', 'cat dander', 'dogs', 'dog dander', 'pet dander',
+}
+# Words an item may carry besides the drug or allergen itself ("penicillin drugs", "lisinopril 10 mg daily")
+ITEM_WORDS = {
+    'drug', 'drugs', 'antibiotic', 'antibiotics', 'medication', 'medications', 'meds', 'dye', 'based',
+    'products', 'mg', 'mcg', 'milligrams', 'micrograms', 'g', 'ml', 'unit', 'units', 'iu', 'tablet', 'tablets',
+    'pill', 'pills', 'capsule', 'capsules', 'puff', 'puffs', 'once', 'twice', 'three', 'times', 'a', 'per',
+    'day', 'daily', 'week', 'weekly', 'nightly', 'at', 'night', 'bedtime', 'in', 'the', 'morning', 'evening',
+    'every', 'other', 'as', 'needed', 'prn', 'bid', 'tid', 'qd', 'qhs', 'low', 'dose', 'extended', 'release',
+    'er', 'xr', 'sr', 'my',
+}
+
+
+class DemographicsRules:
+    """
+    Compiled-regex and lexicon extractor for the patient_data_extraction schema.
+
+    Transcripts ask for demographics in rigid spoken patterns ("Date of birth?"
+    "April 8th, 1985."), so most fields can be read from the patient turn that
+    answers the doctor's question. ``extract`` returns what it could parse and
+    the fields it could not: a field is unresolved when the conversation talks
+    about it (a cue word is present) but no pattern matched. Fields without a
+    cue are absent, as the LLM would also report them; the name is always
+    needed to file the visit, so it is unresolved whenever it was not found.
+    A stated age with no birth date mentioned gives an approximate birth date.
+    """
+
+    def turns(self, transcription: str) -> List[Tuple[str, str]]:
+        """(speaker, text) turns, speaker being 'doctor' or 'patient'"""
+        parts = TURN.split(transcription)
+        turns = []
+        for speaker, text in zip(parts[1::2], parts[2::2]):
+            text = ' '.join(text.split())
+            if text:
+                turns.append(('patient' if speaker.lower() == 'patient' else 'doctor', text))
+        return turns
+
+    def extract(self, transcription: str) -> Tuple[Dict[str, Any], List[str]]:
+        turns = self.turns(transcription)
+        patient_text = ' '.join(text for speaker, text in turns if speaker == 'patient')
+        found: Dict[str, Any] = {}
+
+        answers = self._answers(turns)
+        parsers = {
+            'full_name': self._name,
+            'date_of_birth': self._date,
+            'age': self._age,
+            'gender': self._gender,
+            'phone': self._phone,
+            'address': self._address,
+            'allergies': self._allergies,
+            'current_medications': self._medications,
+        }
+        for field, parse in parsers.items():
+            for answer in answers.get(field, []):
+                value = parse(answer)
+                if value is not None:
+                    found[field] = value
+                    break
+
+        # Statements that do not need a question in front of them
+        if 'full_name' not in found:
+            match = INLINE_NAME.search(patient_text)
+            if match:
+                found['full_name'] = match.group(1)
+        if 'patient_id' not in found:
+            match = PATIENT_ID.search(transcription)
+            if match:
+                found['patient_id'] = match.group(1).upper()
+        if 'age' not in found:
+            age = self._age(patient_text)
+            if age is None:
+                # "a 62-year-old man", said by either side
+                match = YEARS_OLD.search(transcription)
+                age = int(match.group(1)) if match and 0 < int(match.group(1)) < 125 else None
+            if age is not None:
+                found['age'] = age
+        if 'gender' not in found:
+            match = STATED_GENDER.search(transcription)
+            if match:
+                found['gender'] = GENDER_WORDS[match.group(2).lower()]
+        if 'age' not in found and 'date_of_birth' in found:
+            found['age'] = self._age_from_birth(found['date_of_birth'])
+
+        unresolved = [
+            field for field in FIELDS
+            if field not in found and (field == 'full_name' or (field in CUES and CUES[field].search(transcription)))
+        ]
+        if 'age' in found and 'date_of_birth' not in found and 'date_of_birth' not in unresolved:
+            # As the extraction prompt does: an age alone gives an approximate birth date
+            found['date_of_birth'] = self._birth_from_age(found['age'])
+        return found, unresolved
+
+    def to_schema(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """Flat field values in the nested patient_data_extraction structure"""
+        data: Dict[str, Any] = {}
+        for field, value in fields.items():
+            if field in FIELDS:
+                section, key = FIELDS[field]
+                data.setdefault(section, {})[key] = value
+        return data
+
+    def excerpts(self, transcription: str, fields: List[str]) -> str:
+        """The turns that mention ``fields``, each with the turn that answers it"""
+        turns = self.turns(transcription)
+        if not turns:
+            return transcription
+        keep = set()
+        for index, (speaker, text) in enumerate(turns):
+            for field in fields:
+                pattern = QUESTIONS.get(field) or CUES.get(field)
+                if pattern is not None and pattern.search(text):
+                    keep.update((index, index + 1))
+        if 'full_name' in fields:
+            # Introductions happen at the start
+            keep.update(range(4))
+        return '\n'.join(
+            f"{speaker.capitalize()}: {text}" for index, (speaker, text) in enumerate(turns) if index in keep
+        )
+
+    def _answers(self, turns: List[Tuple[str, str]]) -> Dict[str, List[str]]:
+        answers: Dict[str, List[str]] = {}
+        for (speaker, text), following in zip(turns, turns[1:]):
+            if speaker != 'doctor' or following[0] != 'patient':
+                continue
+            # Only the question at the end of the turn is the one being answered
+            question = re.split(r'(?<=[.!])\s+', text)[-1]
+            for field, pattern in QUESTIONS.items():
+                if pattern.search(question):
+                    answers.setdefault(field, []).append(following[1])
+        return answers
+
+    def _name(self, answer: str) -> Optional[str]:
+        text = NAME_LEAD_IN.sub('', answer.strip())
+        text = re.split(r'[,.;!?]\s|[,;!?]$|\.$', text)[0].strip()
+        return text if NAME.match(text) else None
+
+    def _date(self, answer: str) -> Optional[str]:
+        for pattern, order in DATE_PATTERNS:
+            match = pattern.search(answer)
+            if not match:
+                continue
+            parts = dict(zip(order, match.groups()))
+            month = parts['month']
+            month = MONTHS.get(month.lower().rstrip('.')) if not month.isdigit() else int(month)
+            try:
+                return date(int(parts['year']), month, int(parts['day'])).isoformat()
+            except (TypeError, ValueError):
+                continue
+        return None
+
+    def _age(self, answer: str) -> Optional[int]:
+        match = AGE.search(answer)
+        if not match:
+            return None
+        age = int(match.group(1) or match.group(2))
+        return age if 0 < age < 125 else None
+
+    def _age_from_birth(self, birth: str) -> int:
+        born = datetime.strptime(birth, '%Y-%m-%d').date()
+        today = date.today()
+        return today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+
+    def _birth_from_age(self, age: int) -> str:
+        today = date.today()
+        try:
+            return today.replace(year=today.year - age).isoformat()
+        except ValueError:
+            # Today is February 29th
+            return today.replace(year=today.year - age, day=28).isoformat()
+
+    def _gender(self, answer: str) -> Optional[str]:
+        match = GENDER_ANSWER.search(answer)
+        return GENDER_WORDS[match.group(1).lower()] if match else None
+
+    def _phone(self, answer: str) -> Optional[str]:
+        match = PHONE.search(answer)
+        return '-'.join(match.groups()) if match else None
+
+    def _address(self, answer: str) -> Optional[str]:
+        text = re.sub(r"^(?:i live at|it's|it is|my address is)\s+", '', answer.strip(), flags=re.I).rstrip('.')
+        return text if ADDRESS.match(text) else None
+
+    def _allergies(self, answer: str) -> Optional[List[str]]:
+        return self._list(answer, ALLERGENS)
+
+    def _medications(self, answer: str) -> Optional[List[str]]:
+        return self._list(answer, MEDICATIONS)
+
+    def _list(self, answer: str, lexicon: set) -> Optional[List[str]]:
+        """
+        The items of a list answer, [] for a "none" answer, or None when any
+        part of the answer is not a known drug or allergen (it goes to the LLM)
+        """
+        text = answer.strip().rstrip('.!')
+        clauses = [clause.strip() for clause in re.split(r'[,.;!]\s*', text) if clause.strip()]
+        if any(NEGATIVE.fullmatch(clause) for clause in clauses) and \
+                all(NEGATIVE.fullmatch(clause) or FILLER.fullmatch(clause) for clause in clauses):
+            return []
+        if re.search(r'[.!?]\s', text):
+            # A longer answer ("Penicillin. It gives me hives.") is left to the LLM
+            return None
+        text = LIST_LEAD_IN.sub('', text)
+        items = [item.strip(' .') for item in LIST_SPLIT.split(text) if item.strip(' .')]
+        if not items or not all(self._known_item(item, lexicon) for item in items):
+            return None
+        return items
+
+    def _known_item(self, item: str, lexicon: set) -> bool:
+        """Whether ``item`` is a drug or allergen from ``lexicon``, with nothing but dose or qualifier words around it"""
+        words = re.findall(r"[a-z0-9][a-z0-9'-]*", item.lower())
+        known = False
+        i = 0
+        while i < len(words):
+            # The longest lexicon term starting here ("dust mites" before "dust")
+            for length in (3, 2, 1):
+                term = ' '.join(words[i:i + length])
+                if len(words) - i >= length and (term in lexicon or (length == 1 and DRUG_SUFFIX_PATTERN.fullmatch(term))):
+                    known = True
+                    i += length
+                    break
+            else:
+                if words[i] not in ITEM_WORDS and not re.fullmatch(r'\d+(?:\.\d+)?(?:mg|mcg|g|ml)?', words[i]):
+                    return False
+                i += 1
+        return known
+
+
+# Singleton instance
+demographics_rules = DemographicsRules()
@@ -0,0 +1,131 @@
+import os
+import json
+from typing import Dict, Any
+from openai import AsyncOpenAI
+from llm_client import get_client, get_async_client, chat_completion, achat_completion
+from prompt_loader import PromptLoader
+from soap_generator_agent import SOAPNoteGenerator
+from data_extractor_agent import SOAPDataExtractor
+from patient_agent import PatientDataExtractor
+from lab_request_agent import LabRequestGenerator
+from pharmacy_request_agent import PharmacyRequestGenerator
+
+SOAP_KEYS = ['subjective', 'objective', 'assessment', 'plan']
+
+
+class FusedPipelineAgent:
+    """
+    Produces all five pipeline outputs with one completion.
+
+    The ``fused_pipeline`` prompt asks for a single JSON object holding the
+    demographics, SOAP note, clinical data and both order lists; the parts are
+    then post-processed by the regular agents, so the results have exactly the
+    shapes the multi-call pipeline returns.
+    """
+
+    def __init__(self, api_key: str = None, prompts_file: str = None):
+        self.api_key = api_key or os.getenv('OPENAI_API_KEY')
+        if not self.api_key:
+            raise ValueError("OpenAI API key required")
+        self.client = get_client(self.api_key)
+        self.prompt_loader = PromptLoader(prompts_file)
+        self.config = self.prompt_loader.get_config('fused_pipeline')
+
+        self.soap_generator = SOAPNoteGenerator(self.api_key, prompts_file)
+        self.data_extractor = SOAPDataExtractor(self.api_key, prompts_file)
+        self.patient_extractor = PatientDataExtractor(self.api_key, prompts_file)
+        self.lab_generator = LabRequestGenerator(self.api_key, prompts_file)
+        self.pharmacy_generator = PharmacyRequestGenerator(self.api_key, prompts_file)
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        # Async clients are bound to the running event loop
+        return get_async_client(self.api_key)
+
+    def process(self, transcription: str) -> Dict[str, Any]:
+        request = self._build_request(transcription)
+
+        try:
+            content = chat_completion(self.client, 'fused_pipeline', request)
+            return self._split_response(content)
+
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse JSON response: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error in fused pipeline: {str(e)}")
+
+    async def aprocess(self, transcription: str) -> Dict[str, Any]:
+        request = self._build_request(transcription)
+
+        try:
+            content = await achat_completion(self.async_client, 'fused_pipeline', request)
+            return self._split_response(content)
+
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse JSON response: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error in fused pipeline: {str(e)}")
+
+    def _build_request(self, transcription: str) -> Dict[str, Any]:
+        if not transcription or len(transcription.strip()) < 20:
+            raise ValueError("Transcription too short")
+
+        user_message = self.config['user_message_template'].format(
+            transcription=transcription
+        )
+
+        return {
+            "model": self.config['model'],
+            "messages": [
+                {"role": "system", "content": self.config['system_prompt']},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": self.config['temperature'],
+            "max_tokens": self.config['max_tokens'],
+            "response_format": {"type": "json_object"}
+        }
+
+    def _split_response(self, content: str) -> Dict[str, Any]:
+        data = json.loads(content)
+
+        patient_data = self.patient_extractor._clean_empty_fields(data.get('patient_data') or {})
+        soap_note = self._soap_note(data.get('soap_note') or {})
+        clinical_data = self.data_extractor._clean_empty_fields(data.get('clinical_data') or {})
+
+        # Same rules as the lab and pharmacy agents: no plan means no orders,
+        # and real orders go through the full requisition post-processing
+        if not soap_note.get('plan'):
+            lab_requisition = self.lab_generator._no_plan_response()
+            pharmacy_requisition = self.pharmacy_generator._no_plan_response()
+        else:
+            lab_request = data.get('lab_request') or {"request_type": "none", "message": "No lab tests found in plan"}
+            pharmacy_request = data.get('pharmacy_request') or {"request_type": "none", "message": "No medications found in plan"}
+            if lab_request.get('request_type') == 'none':
+                lab_requisition = lab_request
+            else:
+                lab_requisition = self.lab_generator._create_complete_requisition(lab_request, patient_data)
+            if pharmacy_request.get('request_type') == 'none':
+                pharmacy_requisition = pharmacy_request
+            else:
+                pharmacy_requisition = self.pharmacy_generator._create_complete_requisition(
+                    pharmacy_request, patient_data, soap_note
+                )
+
+        return {
+            'patient_data': patient_data,
+            'soap_note': soap_note,
+            'clinical_data': clinical_data,
+            'lab_requisition': lab_requisition,
+            'pharmacy_requisition': pharmacy_requisition,
+        }
+
+    def _soap_note(self, sections: Dict[str, Any]) -> Dict[str, str]:
+        # The multi-call path parses the note from text and only keeps sections it found
+        soap_note = {}
+        for key in SOAP_KEYS:
+            value = sections.get(key) or sections.get(key.upper())
+            if isinstance(value, list):
+                value = '\n'.join(str(item) for item in value)
+            if value:
+                soap_note[key] = str(value).strip()
+        return soap_note
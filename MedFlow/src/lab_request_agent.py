@@ -1,9 +1,11 @@
 import os
 import json
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from datetime import datetime
-from openai import OpenAI
+from openai import AsyncOpenAI
+from llm_client import get_client, get_async_client, chat_completion, achat_completion
 from prompt_loader import PromptLoader
+from order_prefilter import order_prefilter
 
 
 class LabRequestGenerator:
@@ -12,21 +14,69 @@ class LabRequestGenerator:
         self.api_key = api_key or os.getenv('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("OpenAI API key required")
-        self.client = OpenAI(api_key=self.api_key)
+        self.client = get_client(self.api_key)
         self.prompt_loader = PromptLoader(prompts_file)
         self.config = self.prompt_loader.get_config('lab_request_generation')
     
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        # Async clients are bound to the running event loop
+        return get_async_client(self.api_key)
+    
     def generate_lab_request(
         self, 
         soap_note: Dict[str, str], 
         patient_data: Dict[str, Any]
     ) -> Dict[str, Any]:
+        request = self._build_request(soap_note)
+        if request is None:
+            return self._no_plan_response()
+        
+        # A plan that mentions no orders is answered without calling the API
+        screening = order_prefilter.screen('lab', soap_note)
+        if screening.skip:
+            return screening.no_orders_response()
+        
+        try:
+            content = chat_completion(self.client, 'lab_request_generation', request)
+            result = self._handle_response(content, patient_data)
+            order_prefilter.review(screening, result)
+            return result
+            
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse JSON response: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error generating lab request: {str(e)}")
+    
+    async def agenerate_lab_request(
+        self, 
+        soap_note: Dict[str, str], 
+        patient_data: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        request = self._build_request(soap_note)
+        if request is None:
+            return self._no_plan_response()
+        
+        # A plan that mentions no orders is answered without calling the API
+        screening = order_prefilter.screen('lab', soap_note)
+        if screening.skip:
+            return screening.no_orders_response()
+        
+        try:
+            content = await achat_completion(self.async_client, 'lab_request_generation', request)
+            result = self._handle_response(content, patient_data)
+            order_prefilter.review(screening, result)
+            return result
+            
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse JSON response: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error generating lab request: {str(e)}")
+    
+    def _build_request(self, soap_note: Dict[str, str]) -> Optional[Dict[str, Any]]:
         plan = soap_note.get('plan', '')
         if not plan:
-            return {
-                "request_type": "none",
-                "message": "No plan found in SOAP note"
-            }
+            return None
         
         assessment = soap_note.get('assessment', '')
         
@@ -38,39 +88,41 @@ PLAN:
 {plan}
 """
         
-        try:
-            user_message = self.config['user_message_template'].format(
-                context=context
-            )
-            
-            response = self.client.chat.completions.create(
-                model=self.config['model'],
-                messages=[
-                    {"role": "system", "content": self.config['system_prompt']},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=self.config['temperature'],
-                max_tokens=self.config['max_tokens'],
-                response_format={"type": "json_object"}
-            )
-            
-            content = response.choices[0].message.content
-            lab_request = json.loads(content)
-            
-            if lab_request.get('request_type') == 'none':
-                return lab_request
-            
-            complete_requisition = self._create_complete_requisition(
-                lab_request, 
-                patient_data
-            )
-            
-            return complete_requisition
-            
-        except json.JSONDecodeError as e:
-            raise Exception(f"Failed to parse JSON response: {str(e)}")
-        except Exception as e:
-            raise Exception(f"Error generating lab request: {str(e)}")
+        user_message = self.config['user_message_template'].format(
+            context=context
+        )
+        
+        return {
+            "model": self.config['model'],
+            "messages": [
+                {"role": "system", "content": self.config['system_prompt']},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": self.config['temperature'],
+            "max_tokens": self.config['max_tokens'],
+            "response_format": {"type": "json_object"}
+        }
+    
+    def _no_plan_response(self) -> Dict[str, Any]:
+        return {
+            "request_type": "none",
+            "message": "No plan found in SOAP note"
+        }
+    
+    def _handle_response(
+        self, 
+        content: str, 
+        patient_data: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        lab_request = json.loads(content)
+        
+        if lab_request.get('request_type') == 'none':
+            return lab_request
+        
+        return self._create_complete_requisition(
+            lab_request, 
+            patient_data
+        )
     
     def _create_complete_requisition(
         self, 
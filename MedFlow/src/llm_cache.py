@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+from data_dir import data_path
+
+
+class LLMResponseCache:
+    """
+    Content-addressed cache of chat completion results, shared by every worker
+    process through a single SQLite file.
+
+    The key hashes the prompt category, model, temperature, system prompt and
+    rendered user message (plus max_tokens and response_format), so editing a
+    prompt in prompts.json changes the key and old entries simply stop matching.
+    Each entry also records a fingerprint of the prompt it was generated from;
+    the first time a process sees a new fingerprint for a category, the stale
+    entries of that category are deleted so they do not wait for LRU eviction.
+
+    Configuration from the environment:
+        MEDFLOW_LLM_CACHE                  set to 0 to disable the cache
+        MEDFLOW_LLM_CACHE_PATH             SQLite file (default $MEDFLOW_DATA_DIR/llm_responses.sqlite3)
+        MEDFLOW_LLM_CACHE_MAX_MB           size bound for LRU eviction (default 256)
+        MEDFLOW_LLM_CACHE_MAX_AGE_DAYS     entries older than this are dropped (default 30)
+        MEDFLOW_LLM_CACHE_EXCLUDE          comma-separated prompt categories never cached
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        max_bytes: int = None,
+        max_age_seconds: float = None,
+        excluded_categories=None,
+        enabled: bool = None
+    ):
+        if enabled is None:
+            enabled = os.getenv('MEDFLOW_LLM_CACHE', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+        if path is None:
+            path = os.getenv('MEDFLOW_LLM_CACHE_PATH') or data_path('llm_responses.sqlite3')
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv('MEDFLOW_LLM_CACHE_MAX_MB', '256')) * 1024 * 1024)
+        if max_age_seconds is None:
+            max_age_seconds = float(os.getenv('MEDFLOW_LLM_CACHE_MAX_AGE_DAYS', '30')) * 86400
+        if excluded_categories is None:
+            excluded_categories = [c.strip() for c in os.getenv('MEDFLOW_LLM_CACHE_EXCLUDE', '').split(',') if c.strip()]
+
+        self.enabled = enabled
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.excluded_categories = set(excluded_categories)
+        self._local = threading.local()
+        self._purged_fingerprints = {}
+
+    def is_enabled_for(self, category: str) -> bool:
+        return self.enabled and category not in self.excluded_categories
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, and never one inherited across fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    category TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at);
+                CREATE INDEX IF NOT EXISTS responses_category ON responses (category, fingerprint);
+                CREATE TABLE IF NOT EXISTS stats (
+                    category TEXT PRIMARY KEY,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    misses INTEGER NOT NULL DEFAULT 0
+                );
+            ''')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def make_key(self, category: str, request: Dict[str, Any]) -> str:
+        system_prompt, user_message = self._split_messages(request)
+        return self._hash({
+            'category': category,
+            'model': request.get('model'),
+            'temperature': request.get('temperature'),
+            'system_prompt': system_prompt,
+            'user_message': user_message,
+            'max_tokens': request.get('max_tokens'),
+            'response_format': request.get('response_format'),
+        })
+
+    def fingerprint(self, request: Dict[str, Any]) -> str:
+        system_prompt, _ = self._split_messages(request)
+        return self._hash({
+            'model': request.get('model'),
+            'temperature': request.get('temperature'),
+            'system_prompt': system_prompt,
+            'max_tokens': request.get('max_tokens'),
+            'response_format': request.get('response_format'),
+        })
+
+    def get(self, category: str, request: Dict[str, Any]) -> Optional[str]:
+        if not self.is_enabled_for(category):
+            return None
+
+        try:
+            conn = self._connection()
+            self._purge_stale_prompts(conn, category, self.fingerprint(request))
+
+            key = self.make_key(category, request)
+            now = time.time()
+            row = conn.execute(
+                'SELECT content, created_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+
+            if row is not None and now - row[1] <= self.max_age_seconds:
+                conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+                self._count(conn, category, hit=True)
+                return row[0]
+
+            self._count(conn, category, hit=False)
+        except sqlite3.Error as e:
+            # A broken cache must never fail the request, it only costs a call
+            print(f"⚠️  LLM cache read failed: {str(e)}")
+        return None
+
+    def set(self, category: str, request: Dict[str, Any], content: str):
+        if not self.is_enabled_for(category) or content is None:
+            return
+
+        try:
+            conn = self._connection()
+            now = time.time()
+            conn.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, category, fingerprint, content, size, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    self.make_key(category, request),
+                    category,
+                    self.fingerprint(request),
+                    content,
+                    len(content.encode('utf-8')),
+                    now,
+                    now
+                )
+            )
+            self._evict(conn, now)
+        except sqlite3.Error as e:
+            print(f"⚠️  LLM cache write failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {'enabled': False}
+
+        conn = self._connection()
+        categories = {}
+        for category, hits, misses in conn.execute('SELECT category, hits, misses FROM stats ORDER BY category'):
+            total = hits + misses
+            categories[category] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / total, 3) if total else 0.0
+            }
+        entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {
+            'enabled': True,
+            'entries': entries,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes,
+            'excluded_categories': sorted(self.excluded_categories),
+            'categories': categories,
+        }
+
+    def clear(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM responses')
+        conn.execute('DELETE FROM stats')
+
+    def _count(self, conn: sqlite3.Connection, category: str, hit: bool):
+        column = 'hits' if hit else 'misses'
+        conn.execute(
+            f'INSERT INTO stats (category, {column}) VALUES (?, 1) '
+            f'ON CONFLICT(category) DO UPDATE SET {column} = {column} + 1',
+            (category,)
+        )
+
+    def _purge_stale_prompts(self, conn: sqlite3.Connection, category: str, fingerprint: str):
+        if self._purged_fingerprints.get(category) == fingerprint:
+            return
+        conn.execute(
+            'DELETE FROM responses WHERE category = ? AND fingerprint != ?',
+            (category, fingerprint)
+        )
+        self._purged_fingerprints[category] = fingerprint
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute('DELETE FROM responses WHERE created_at < ?', (now - self.max_age_seconds,))
+
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Drop least recently used entries until back under the bound
+        excess = total - self.max_bytes
+        doomed = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+            doomed.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany('DELETE FROM responses WHERE key = ?', doomed)
+
+    def _split_messages(self, request: Dict[str, Any]):
+        system_prompt = ''
+        user_message = ''
+        for message in request.get('messages', []):
+            if message.get('role') == 'system':
+                system_prompt += message.get('content', '')
+            elif message.get('role') == 'user':
+                user_message += message.get('content', '')
+        return system_prompt, user_message
+
+    def _hash(self, payload: Dict[str, Any]) -> str:
+        encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+
+llm_cache = LLMResponseCache()
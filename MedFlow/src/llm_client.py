@@ -0,0 +1,340 @@
+import os
+import time
+import asyncio
+import threading
+import weakref
+import contextvars
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Dict, Any, Iterator, List, Optional
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from llm_cache import llm_cache
+from metrics import metrics
+from llm_policy import llm_policies
+from rate_limiter import estimate_tokens, CHARS_PER_TOKEN
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class LLMClientRegistry:
+    """
+    Process-wide OpenAI clients shared by every agent.
+
+    One client per API key keeps a single keep-alive connection pool per process
+    instead of a fresh pool (and TLS handshake) per agent per request. Async
+    clients are additionally keyed by event loop, since an httpx async pool
+    cannot be shared across loops. Everything is dropped in a forked child so
+    workers never reuse sockets inherited from a preforking parent.
+
+    Pool settings come from the environment:
+        OPENAI_MAX_CONNECTIONS             total connections per pool (default 20)
+        OPENAI_MAX_KEEPALIVE_CONNECTIONS   idle connections kept open (default 10)
+        OPENAI_KEEPALIVE_EXPIRY            seconds an idle connection is kept (default 30)
+        OPENAI_TIMEOUT                     read/write timeout in seconds (default 120)
+        OPENAI_TRANSCRIPTION_TIMEOUT       read/write timeout of Whisper uploads (default 600)
+        OPENAI_CONNECT_TIMEOUT             connect timeout in seconds (default 10)
+        OPENAI_HTTP2                       negotiate HTTP/2 (default true)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._clients: Dict[str, OpenAI] = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self.settings = self._load_settings()
+
+    def _load_settings(self) -> Dict[str, Any]:
+        return {
+            'max_connections': int(os.getenv('OPENAI_MAX_CONNECTIONS', '20')),
+            'max_keepalive_connections': int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '10')),
+            'keepalive_expiry': float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '30')),
+            'timeout': float(os.getenv('OPENAI_TIMEOUT', '120')),
+            'transcription_timeout': float(os.getenv('OPENAI_TRANSCRIPTION_TIMEOUT', '600')),
+            'connect_timeout': float(os.getenv('OPENAI_CONNECT_TIMEOUT', '10')),
+            'http2': _env_bool('OPENAI_HTTP2', True),
+        }
+
+    def _http_options(self) -> Dict[str, Any]:
+        settings = self.settings
+        return {
+            'limits': httpx.Limits(
+                max_connections=settings['max_connections'],
+                max_keepalive_connections=settings['max_keepalive_connections'],
+                keepalive_expiry=settings['keepalive_expiry'],
+            ),
+            'timeout': httpx.Timeout(settings['timeout'], connect=settings['connect_timeout']),
+            'http2': settings['http2'],
+            'follow_redirects': True,
+        }
+
+    def transcription_timeout(self) -> httpx.Timeout:
+        """Per-request timeout of Whisper calls: one upload of a long recording outlasts any completion"""
+        return httpx.Timeout(self.settings['transcription_timeout'], connect=self.settings['connect_timeout'])
+
+    def _resolve_key(self, api_key: Optional[str]) -> str:
+        api_key = api_key or os.getenv('OPENAI_API_KEY')
+        if not api_key:
+            raise ValueError("OpenAI API key required")
+        return api_key
+
+    def _check_fork(self):
+        # Fallback for platforms without os.register_at_fork
+        if self._pid != os.getpid():
+            self._after_fork()
+
+    def _after_fork(self):
+        # The parent still owns these sockets, so drop the references without closing them
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._clients = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def get_client(self, api_key: str = None) -> OpenAI:
+        api_key = self._resolve_key(api_key)
+        self._check_fork()
+        client = self._clients.get(api_key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(api_key)
+                if client is None:
+                    client = OpenAI(
+                        api_key=api_key,
+                        http_client=httpx.Client(**self._http_options())
+                    )
+                    self._clients[api_key] = client
+        return client
+
+    def get_async_client(self, api_key: str = None) -> AsyncOpenAI:
+        api_key = self._resolve_key(api_key)
+        self._check_fork()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            loop_clients = self._async_clients.setdefault(loop, {})
+            client = loop_clients.get(api_key)
+            if client is None:
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    http_client=httpx.AsyncClient(**self._http_options())
+                )
+                loop_clients[api_key] = client
+        return client
+
+    def reset(self):
+        """Close and forget every client, e.g. after OPENAI_BASE_URL changed"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+            self._async_clients = weakref.WeakKeyDictionary()
+        for client in clients:
+            client.close()
+
+    def warm(self, api_key: str = None):
+        """Build the default client up front so the first request does not pay for it"""
+        self.get_client(api_key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pid': self._pid,
+            'sync_clients': len(self._clients),
+            'async_loops': len(self._async_clients),
+            'settings': dict(self.settings),
+        }
+
+
+llm_clients = LLMClientRegistry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=llm_clients._after_fork)
+
+
+def get_client(api_key: str = None) -> OpenAI:
+    return llm_clients.get_client(api_key)
+
+
+def get_async_client(api_key: str = None) -> AsyncOpenAI:
+    return llm_clients.get_async_client(api_key)
+
+
+def transcription_timeout() -> httpx.Timeout:
+    return llm_clients.transcription_timeout()
+
+
+class UsageRecorder:
+    """Token usage of every completion made while ``record_usage()`` is active"""
+
+    def __init__(self):
+        self.calls: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add(self, category: str, request: Dict[str, Any], usage=None, cached: bool = False, seconds: float = 0.0):
+        call = {
+            'category': category,
+            'model': request.get('model'),
+            'cached': cached,
+            'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+            'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+            'seconds': round(seconds, 3),
+        }
+        call['total_tokens'] = call['prompt_tokens'] + call['completion_tokens']
+        with self._lock:
+            self.calls.append(call)
+
+    def totals(self) -> Dict[str, int]:
+        with self._lock:
+            calls = list(self.calls)
+        return {
+            'calls': len(calls),
+            'cached_calls': sum(1 for c in calls if c['cached']),
+            'prompt_tokens': sum(c['prompt_tokens'] for c in calls),
+            'completion_tokens': sum(c['completion_tokens'] for c in calls),
+            'total_tokens': sum(c['total_tokens'] for c in calls),
+            'seconds': round(sum(c['seconds'] for c in calls), 3),
+        }
+
+
+_usage_recorder = contextvars.ContextVar('medflow_usage_recorder', default=None)
+
+
+@contextmanager
+def record_usage():
+    """
+    Collect token usage for the completions made in this context. The pipeline
+    executor runs stages in a copy of the caller's context, so calls made by
+    agents on worker threads are included.
+    """
+    recorder = UsageRecorder()
+    token = _usage_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _usage_recorder.reset(token)
+
+
+def _record(category: str, request: Dict[str, Any], usage=None, cached: bool = False, seconds: float = 0.0):
+    recorder = _usage_recorder.get()
+    if recorder is not None:
+        recorder.add(category, request, usage, cached, seconds)
+
+
+def _discarded_hedge_recorder(category: str):
+    # A hedged attempt that lost the race still used tokens; it finishes on another thread or task
+    recorder = _usage_recorder.get()
+
+    def on_discard(response, request: Dict[str, Any], seconds: float = 0.0):
+        if recorder is not None:
+            recorder.add(category, request, getattr(response, 'usage', None), seconds=seconds)
+    return on_discard
+
+
+def _cache_answer(category: str, request: Dict[str, Any], sent: Dict[str, Any], content: str):
+    # A fallback model's answer must not be served later as the primary model's
+    if sent.get('model') == request.get('model'):
+        llm_cache.set(category, request, content)
+
+
+def chat_completion(client: OpenAI, category: str, request: Dict[str, Any]) -> str:
+    """
+    Run a chat completion for a prompts.json category and return the message
+    content, answering from the shared response cache when possible. The call
+    runs under the category's deadline, retry, hedging and fallback policy.
+    """
+    cached = llm_cache.get(category, request)
+    if cached is not None:
+        _record(category, request, cached=True)
+        return cached
+
+    def send(attempt: Dict[str, Any], timeout: float):
+        # Retries and timeouts are up to the category's policy, not the SDK
+        return client.with_options(timeout=timeout, max_retries=0).chat.completions.create(**attempt)
+
+    started = time.perf_counter()
+    with metrics.span(f'llm.{category}'):
+        response, sent = llm_policies.call(category, request, send, on_discard=_discarded_hedge_recorder(category))
+    _record(category, sent, getattr(response, 'usage', None), seconds=time.perf_counter() - started)
+    content = response.choices[0].message.content
+    _cache_answer(category, request, sent, content)
+    return content
+
+
+async def achat_completion(client: AsyncOpenAI, category: str, request: Dict[str, Any]) -> str:
+    # SQLite may wait on another worker's write lock, so keep it off the event loop
+    cached = await asyncio.to_thread(llm_cache.get, category, request)
+    if cached is not None:
+        _record(category, request, cached=True)
+        return cached
+
+    async def send(attempt: Dict[str, Any], timeout: float):
+        return await client.with_options(timeout=timeout, max_retries=0).chat.completions.create(**attempt)
+
+    started = time.perf_counter()
+    with metrics.span(f'llm.{category}'):
+        response, sent = await llm_policies.acall(category, request, send,
+                                                  on_discard=_discarded_hedge_recorder(category))
+    _record(category, sent, getattr(response, 'usage', None), seconds=time.perf_counter() - started)
+    content = response.choices[0].message.content
+    await asyncio.to_thread(_cache_answer, category, request, sent, content)
+    return content
+
+
+def stream_chat_completion(client: OpenAI, category: str, request: Dict[str, Any]) -> Iterator[str]:
+    """
+    Yield the completion text as it is generated. A cached answer is yielded
+    in one piece; a fully streamed answer is written to the cache afterwards.
+    The stream is opened under the category's policy and read up to its
+    deadline; its usage is recorded also when the consumer disconnects.
+    """
+    cached = llm_cache.get(category, request)
+    if cached is not None:
+        _record(category, request, cached=True)
+        yield cached
+        return
+
+    def send(attempt: Dict[str, Any], timeout: float):
+        # The final chunk then carries the token usage of the whole completion
+        return client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+            **attempt, stream=True, stream_options={'include_usage': True}
+        )
+
+    parts = []
+    usage = None
+    finished = False
+    started = time.perf_counter()
+    # Covers the whole stream, up to the last token
+    with metrics.span(f'llm.{category}'):
+        stream, sent, deadline = llm_policies.open_stream(category, request, send)
+        try:
+            for chunk in stream:
+                # Only sent when the request asks for stream usage
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+                llm_policies.check_deadline(category, deadline)
+            finished = True
+        finally:
+            # Also reached when the consumer disconnects mid-stream: the tokens generated so far are billed
+            stream.close()
+            if usage is None:
+                usage = _estimated_usage(sent, ''.join(parts))
+            _record(category, sent, usage, seconds=time.perf_counter() - started)
+
+    if finished:
+        _cache_answer(category, request, sent, ''.join(parts))
+
+
+def _estimated_usage(request: Dict[str, Any], content: str) -> SimpleNamespace:
+    # A stream cut short never receives its usage chunk
+    return SimpleNamespace(
+        prompt_tokens=estimate_tokens({'messages': request.get('messages', [])}),
+        completion_tokens=len(content) // CHARS_PER_TOKEN
+    )
@@ -0,0 +1,473 @@
+"""
+Deadlines, retries, hedging and model fallback for chat completions
+
+Every completion made through llm_client runs under the policy of its prompt
+category:
+
+- a deadline for the whole call, retries included
+- retries of transient failures (connection errors, timeouts, 408/409/429/5xx)
+  with full-jitter exponential backoff
+- optional hedging: when an attempt is still running after the observed p95
+  latency of the category, a duplicate is sent and the first answer wins
+- an optional faster fallback model, used for attempts started when less time
+  is left than the primary model usually needs
+
+Streamed completions get the same deadline, admission and fallback, with
+retries only while opening the stream and no hedging (see open_stream).
+
+Defaults come from the environment; MEDFLOW_LLM_POLICIES holds per-category
+overrides as JSON, e.g. '{"soap_note": {"deadline": 45, "hedge": true}}'.
+
+    MEDFLOW_LLM_DEADLINE            seconds per call, retries included (default 90)
+    MEDFLOW_LLM_RETRIES             retries after the first attempt (default 2)
+    MEDFLOW_LLM_BACKOFF             base backoff in seconds (default 0.5)
+    MEDFLOW_LLM_BACKOFF_MAX         backoff cap in seconds (default 8)
+    MEDFLOW_LLM_HEDGE               set to 1 to hedge slow attempts (default 0)
+    MEDFLOW_LLM_HEDGE_PERCENTILE    latency percentile that triggers a hedge (default 95)
+    MEDFLOW_LLM_HEDGE_MIN_SAMPLES   latencies observed before hedging starts (default 20)
+    MEDFLOW_LLM_FALLBACK_MODEL      faster model for attempts close to the deadline (default none)
+    MEDFLOW_LLM_FALLBACK_REMAINING  seconds left below which the fallback is used
+                                    (default: the primary model's observed p95, else a quarter of the deadline)
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Any, Callable, Optional, Tuple
+
+import openai
+from metrics import metrics
+from rate_limiter import rate_limiter, AdmissionTimeout
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+DEADLINE_SLACK = 0.05
+
+POLICY_KEYS = {
+    'deadline': float,
+    'retries': int,
+    'backoff': float,
+    'backoff_max': float,
+    'hedge': bool,
+    'hedge_percentile': float,
+    'hedge_min_samples': int,
+    'fallback_model': str,
+    'fallback_remaining': float,
+}
+
+COUNTERS = {
+    'calls': 'medflow_llm_calls_total',
+    'retries': 'medflow_llm_retries_total',
+    'hedges': 'medflow_llm_hedges_total',
+    'hedge_wins': 'medflow_llm_hedge_wins_total',
+    'fallbacks': 'medflow_llm_fallbacks_total',
+    'deadline_exceeded': 'medflow_llm_deadline_exceeded_total',
+}
+
+
+class DeadlineExceeded(Exception):
+    """The call, retries included, did not finish within its category's deadline"""
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, openai.APIConnectionError):
+        # Includes APITimeoutError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+class CallPolicy:
+
+    def __init__(self, deadline: float = 90.0, retries: int = 2, backoff: float = 0.5, backoff_max: float = 8.0,
+                 hedge: bool = False, hedge_percentile: float = 95.0, hedge_min_samples: int = 20,
+                 fallback_model: str = '', fallback_remaining: float = None):
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.fallback_model = fallback_model
+        self.fallback_remaining = fallback_remaining
+
+    def backoff_delay(self, retry: int) -> float:
+        """Full jitter: uniform between 0 and the capped exponential step"""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (retry - 1)))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in POLICY_KEYS}
+
+
+class LatencyTracker:
+    """Recent successful attempt latencies per category and model, for hedge and fallback thresholds"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[Tuple[str, str], deque] = {}
+        self._lock = threading.Lock()
+
+    def add(self, category: str, model: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get((category, model))
+            if samples is None:
+                samples = self._samples[(category, model)] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, category: str, model: str, p: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get((category, model), ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def keys(self):
+        with self._lock:
+            return list(self._samples)
+
+
+class LLMPolicies:
+
+    def __init__(self):
+        self.defaults = CallPolicy(
+            deadline=float(os.getenv('MEDFLOW_LLM_DEADLINE', '90')),
+            retries=int(os.getenv('MEDFLOW_LLM_RETRIES', '2')),
+            backoff=float(os.getenv('MEDFLOW_LLM_BACKOFF', '0.5')),
+            backoff_max=float(os.getenv('MEDFLOW_LLM_BACKOFF_MAX', '8')),
+            hedge=_env_bool('MEDFLOW_LLM_HEDGE', False),
+            hedge_percentile=float(os.getenv('MEDFLOW_LLM_HEDGE_PERCENTILE', '95')),
+            hedge_min_samples=int(os.getenv('MEDFLOW_LLM_HEDGE_MIN_SAMPLES', '20')),
+            fallback_model=os.getenv('MEDFLOW_LLM_FALLBACK_MODEL', ''),
+            fallback_remaining=float(os.environ['MEDFLOW_LLM_FALLBACK_REMAINING'])
+            if os.getenv('MEDFLOW_LLM_FALLBACK_REMAINING') else None,
+        )
+        self.overrides = json.loads(os.getenv('MEDFLOW_LLM_POLICIES') or '{}')
+        self.latencies = LatencyTracker()
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        # Losing async attempts still running, referenced so they are not collected
+        self._background = set()
+
+    def get(self, category: str) -> CallPolicy:
+        settings = self.defaults.to_dict()
+        for key, value in self.overrides.get(category, {}).items():
+            if key not in POLICY_KEYS:
+                raise ValueError(f"Unknown policy setting '{key}' for {category}, expected any of {', '.join(POLICY_KEYS)}")
+            settings[key] = POLICY_KEYS[key](value) if value is not None else None
+        return CallPolicy(**settings)
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        # Hedged attempts need threads of their own; rebuilt after fork like the pipeline pool
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPoolExecutor(
+                    max_workers=int(os.getenv('MEDFLOW_LLM_HEDGE_WORKERS', '16')),
+                    thread_name_prefix='medflow-llm-hedge'
+                )
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    # Thresholds
+
+    def _hedge_after(self, policy: CallPolicy, category: str, model: str) -> Optional[float]:
+        if not policy.hedge:
+            return None
+        return self.latencies.percentile(category, model, policy.hedge_percentile, policy.hedge_min_samples)
+
+    def _with_model(self, policy: CallPolicy, category: str, request: Dict[str, Any], remaining: float) -> Dict[str, Any]:
+        """``request``, switched to the fallback model if the primary would likely miss the deadline"""
+        if not policy.fallback_model or policy.fallback_model == request.get('model'):
+            return request
+        threshold = policy.fallback_remaining
+        if threshold is None:
+            threshold = self.latencies.percentile(category, request.get('model'), 95)
+        if threshold is None:
+            threshold = policy.deadline / 4
+        if remaining >= threshold:
+            return request
+        metrics.inc(COUNTERS['fallbacks'], category=category)
+        print(f"⚠️  {category}: {remaining:.1f}s left, falling back to {policy.fallback_model}")
+        return {**request, 'model': policy.fallback_model}
+
+    # Sync calls
+
+    def call(self, category: str, request: Dict[str, Any], send: Callable[[Dict[str, Any], float], Any],
+             on_discard: Callable[[Any, Dict[str, Any], float], None] = None) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Run ``send(request, timeout)`` under the category's policy. Returns the
+        response and the request that produced it (the model may be the
+        fallback). ``on_discard`` receives hedged responses that lost the race.
+        """
+        policy = self.get(category)
+        deadline = time.monotonic() + policy.deadline
+        metrics.inc(COUNTERS['calls'], category=category)
+
+        retry = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._exceeded(category, policy)
+            try:
+                return self._attempt(policy, category, request, send, deadline, on_discard)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                retry += 1
+                time.sleep(self._retry_delay(category, policy, e, retry, deadline))
+
+    def _retry_delay(self, category: str, policy: CallPolicy, error: Exception, retry: int, deadline: float) -> float:
+        """Backoff before retry number ``retry`` after ``error``; raises it (or DeadlineExceeded) when not to retry"""
+        if not is_retryable(error):
+            raise error
+        # Attempts time out at the deadline, so a timeout this close to it is the deadline's
+        if deadline - time.monotonic() <= DEADLINE_SLACK:
+            self._exceeded(category, policy)
+        if retry > policy.retries:
+            raise error
+        metrics.inc(COUNTERS['retries'], category=category)
+        delay = min(policy.backoff_delay(retry), max(0.0, deadline - time.monotonic()))
+        print(f"⚠️  {category}: {type(error).__name__}, retry {retry}/{policy.retries} in {delay:.2f}s")
+        return delay
+
+    def _attempt(self, policy, category, request, send, deadline, on_discard):
+        request = self._with_model(policy, category, request, deadline - time.monotonic())
+        # Admitted before the hedge clock starts, so waiting for budget never triggers a hedge
+        self._admit(category, policy, request, deadline)
+        hedge_after = self._hedge_after(policy, category, request.get('model'))
+
+        if hedge_after is None or hedge_after >= deadline - time.monotonic():
+            return self._timed_send(category, request, send, deadline), request
+
+        pool = self._get_pool()
+        # Each attempt gets its own copy of the caller's context (e.g. usage recording)
+        primary = pool.submit(contextvars.copy_context().run, self._timed_send, category, request, send, deadline)
+        attempts = {primary: request}
+        done, _ = wait([primary], timeout=hedge_after)
+        if not done:
+            hedge_request = self._with_model(policy, category, request, deadline - time.monotonic())
+            metrics.inc(COUNTERS['hedges'], category=category)
+            hedge = pool.submit(contextvars.copy_context().run, self._timed_send, category, hedge_request, send,
+                                deadline, policy)
+            attempts[hedge] = hedge_request
+
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                self._discard(pending, attempts, on_discard)
+                self._exceeded(category, policy)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        metrics.inc(COUNTERS['hedge_wins'], category=category)
+                    self._discard(pending, attempts, on_discard)
+                    return future.result(), attempts[future]
+                error = future.exception()
+        raise error
+
+    def _admit(self, category: str, policy: CallPolicy, request: Dict[str, Any], deadline: float):
+        # Time queued for rate limit budget comes out of the deadline but is not attempt latency
+        try:
+            rate_limiter.acquire(request, max_wait=max(0.0, deadline - time.monotonic()))
+        except AdmissionTimeout:
+            self._exceeded(category, policy)
+
+    async def _aadmit(self, category: str, policy: CallPolicy, request: Dict[str, Any], deadline: float):
+        try:
+            await rate_limiter.aacquire(request, max_wait=max(0.0, deadline - time.monotonic()))
+        except AdmissionTimeout:
+            self._exceeded(category, policy)
+
+    def _timed_send(self, category, request, send, deadline, admit_under: CallPolicy = None):
+        if admit_under is not None:
+            self._admit(category, admit_under, request, deadline)
+        started = time.perf_counter()
+        response = send(request, max(deadline - time.monotonic(), 0.001))
+        seconds = time.perf_counter() - started
+        self.latencies.add(category, request.get('model'), seconds)
+        return response
+
+    def _discard(self, futures, attempts, on_discard):
+        # Threads cannot be stopped; the losing attempt finishes in the background
+        if on_discard is None:
+            return
+        for future in futures:
+            future.add_done_callback(
+                lambda f, request=attempts[future]: f.exception() is None and on_discard(f.result(), request)
+            )
+
+    # Async calls
+
+    async def acall(self, category: str, request: Dict[str, Any], send,
+                    on_discard: Callable[[Any, Dict[str, Any], float], None] = None) -> Tuple[Any, Dict[str, Any]]:
+        """Async counterpart of ``call``; ``send(request, timeout)`` is a coroutine function"""
+        policy = self.get(category)
+        deadline = time.monotonic() + policy.deadline
+        metrics.inc(COUNTERS['calls'], category=category)
+
+        retry = 0
+        while True:
+            if deadline - time.monotonic() <= 0:
+                self._exceeded(category, policy)
+            try:
+                return await self._aattempt(policy, category, request, send, deadline, on_discard)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                retry += 1
+                await asyncio.sleep(self._retry_delay(category, policy, e, retry, deadline))
+
+    async def _aattempt(self, policy, category, request, send, deadline, on_discard):
+        request = self._with_model(policy, category, request, deadline - time.monotonic())
+        await self._aadmit(category, policy, request, deadline)
+        hedge_after = self._hedge_after(policy, category, request.get('model'))
+
+        primary = asyncio.ensure_future(self._atimed_send(category, request, send, deadline))
+        attempts = {primary: request}
+        try:
+            if hedge_after is not None and hedge_after < deadline - time.monotonic():
+                done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+                if not done:
+                    hedge_request = self._with_model(policy, category, request, deadline - time.monotonic())
+                    metrics.inc(COUNTERS['hedges'], category=category)
+                    hedge = asyncio.ensure_future(
+                        self._atimed_send(category, hedge_request, send, deadline, policy)
+                    )
+                    attempts[hedge] = hedge_request
+
+            pending = set(attempts)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    self._exceeded(category, policy)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            metrics.inc(COUNTERS['hedge_wins'], category=category)
+                        return task.result(), attempts[task]
+                    error = task.exception()
+            raise error
+        except asyncio.CancelledError:
+            # The caller gave up: nobody is left to take either answer
+            for task in attempts:
+                task.cancel()
+            raise
+        finally:
+            self._adiscard([task for task in attempts if not task.done()], attempts, on_discard)
+
+    def _adiscard(self, tasks, attempts, on_discard):
+        # As on the sync path the losing attempt runs to the end, so the tokens it used are reported;
+        # with nobody to report them to it is cancelled, closing its connection
+        for task in tasks:
+            if on_discard is None:
+                task.cancel()
+                continue
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+            task.add_done_callback(
+                lambda t, request=attempts[task]:
+                    not t.cancelled() and t.exception() is None and on_discard(t.result(), request)
+            )
+
+    async def _atimed_send(self, category, request, send, deadline, admit_under: CallPolicy = None):
+        if admit_under is not None:
+            await self._aadmit(category, admit_under, request, deadline)
+        started = time.perf_counter()
+        response = await send(request, max(deadline - time.monotonic(), 0.001))
+        self.latencies.add(category, request.get('model'), time.perf_counter() - started)
+        return response
+
+    # Streams
+
+    def open_stream(self, category: str, request: Dict[str, Any],
+                    send: Callable[[Dict[str, Any], float], Any]) -> Tuple[Any, Dict[str, Any], float]:
+        """
+        Open a streamed completion with ``send(request, timeout)`` under the
+        category's deadline, admission, retry and fallback policy. Only
+        opening is retried, before any token was passed on, and streams are
+        never hedged: a duplicate would be billed for the same answer. Returns
+        the stream, the request that opened it and the deadline (monotonic)
+        for ``check_deadline`` while it is read.
+        """
+        policy = self.get(category)
+        deadline = time.monotonic() + policy.deadline
+        metrics.inc(COUNTERS['calls'], category=category)
+
+        retry = 0
+        while True:
+            if deadline - time.monotonic() <= 0:
+                self._exceeded(category, policy)
+            attempt = self._with_model(policy, category, request, deadline - time.monotonic())
+            self._admit(category, policy, attempt, deadline)
+            try:
+                return send(attempt, max(deadline - time.monotonic(), 0.001)), attempt, deadline
+            except Exception as e:
+                retry += 1
+                time.sleep(self._retry_delay(category, policy, e, retry, deadline))
+
+    def check_deadline(self, category: str, deadline: float):
+        """Raise DeadlineExceeded once the deadline ``open_stream`` returned has passed"""
+        if time.monotonic() > deadline:
+            self._exceeded(category, self.get(category))
+
+    def _exceeded(self, category: str, policy: CallPolicy):
+        metrics.inc(COUNTERS['deadline_exceeded'], category=category)
+        raise DeadlineExceeded(f"{category} did not finish within {policy.deadline:.0f}s")
+
+    # Reporting
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters of all workers and hedge/fallback rates per category, with this worker's latency view"""
+        counters = metrics.collect()['counters'] if metrics.enabled else {}
+        totals: Dict[str, Dict[str, float]] = {}
+        names = {name: key for key, name in COUNTERS.items()}
+        for series, value in counters.items():
+            name, labels = json.loads(series)
+            labels = dict(labels)
+            if name in names and 'category' in labels:
+                totals.setdefault(labels['category'], {key: 0 for key in COUNTERS})[names[name]] += value
+
+        categories = {}
+        for category, counts in sorted(totals.items()):
+            calls = counts['calls'] or 1
+            policy = self.get(category)
+            categories[category] = {
+                **{key: int(value) for key, value in counts.items()},
+                'retry_rate': round(counts['retries'] / calls, 4),
+                'hedge_rate': round(counts['hedges'] / calls, 4),
+                'hedge_win_rate': round(counts['hedge_wins'] / counts['hedges'], 4) if counts['hedges'] else 0.0,
+                'fallback_rate': round(counts['fallbacks'] / calls, 4),
+                'deadline_exceeded_rate': round(counts['deadline_exceeded'] / calls, 4),
+                'policy': policy.to_dict(),
+            }
+        return {
+            'categories': categories,
+            'latency_p95': {
+                f"{category}/{model}": round(self.latencies.percentile(category, model, 95), 3)
+                for category, model in self.latencies.keys()
+            },
+        }
+
+
+# Singleton instance
+llm_policies = LLMPolicies()
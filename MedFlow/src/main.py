@@ -58,11 +58,7 @@ def main():
     """
     
     try:
-        from soap_generator_agent import SOAPNoteGenerator
-        from data_extractor_agent import SOAPDataExtractor
-        from patient_agent import PatientDataExtractor
-        from lab_request_agent import LabRequestGenerator
-        from pharmacy_request_agent import PharmacyRequestGenerator
+        from pipeline import build_pipeline_stages, pipeline_executor, pipeline_mode
         
         print("=" * 80)
         print("MEDICAL DOCUMENTATION PIPELINE")
@@ -70,35 +66,23 @@ def main():
         print(f"Timestamp: {datetime.now().isoformat()}")
         print("=" * 80)
         
-        # Step 1: Extract Patient Data
-        print("\n[STEP 1/5] Extracting Patient Demographics...")
-        patient_extractor = PatientDataExtractor()
-        patient_data = patient_extractor.extract_patient_data(simple_transcription)
-        print("✓ Patient data extracted")
-        
-        # Step 2: Generate SOAP Note
-        print("\n[STEP 2/5] Generating SOAP Note...")
-        soap_generator = SOAPNoteGenerator()
-        soap_note = soap_generator.generate_soap_note(simple_transcription)
-        print("✓ SOAP note generated")
-        
-        # Step 3: Extract Clinical Data
-        print("\n[STEP 3/5] Extracting Structured Clinical Data...")
-        data_extractor = SOAPDataExtractor()
-        clinical_data = data_extractor.extract_data(soap_note)
-        print("✓ Clinical data extracted")
-        
-        # Step 4: Generate Lab Request
-        print("\n[STEP 4/5] Generating Lab Test Requisition...")
-        lab_generator = LabRequestGenerator()
-        lab_requisition = lab_generator.generate_lab_request(soap_note, patient_data)
-        print("✓ Lab requisition generated")
-        
-        # Step 5: Generate Pharmacy Request
-        print("\n[STEP 5/5] Generating Pharmacy Prescription Request...")
-        pharmacy_generator = PharmacyRequestGenerator()
-        pharmacy_requisition = pharmacy_generator.generate_pharmacy_request(soap_note, patient_data)
-        print("✓ Pharmacy requisition generated")
+        # Steps 1-2 (demographics, SOAP note) run in parallel, then steps 3-5
+        # (clinical data, lab and pharmacy requisitions) run in parallel
+        print(f"\n[STEPS 1-5] Running agents ({pipeline_mode()} mode) on up to {pipeline_executor.max_workers} workers...")
+        result = pipeline_executor.run(
+            build_pipeline_stages(),
+            {'transcription': simple_transcription}
+        )
+        
+        patient_data = result['patient_data']
+        soap_note = result['soap_note']
+        clinical_data = result['clinical_data']
+        lab_requisition = result['lab_requisition']
+        pharmacy_requisition = result['pharmacy_requisition']
+        
+        for stage_name, seconds in result.timings.items():
+            print(f"✓ {stage_name} ({seconds:.2f}s)")
+        print(f"Pipeline wall time: {result.total_seconds:.2f}s")
         
         # Print all outputs as JSON
         print("\n" + "=" * 80)
@@ -163,7 +147,8 @@ def main():
         complete_record = {
             "metadata": {
                 "generated_at": datetime.now().isoformat(),
-                "pipeline_version": "1.0.0"
+                "pipeline_version": "1.0.0",
+                "stage_timings": result.timing_summary()
             },
             "patient_demographics": patient_data,
             "soap_note": soap_note,
@@ -0,0 +1,362 @@
+"""
+Latency histograms and error counters, exposed in Prometheus text format
+
+Each process keeps its series in memory and a background thread writes them
+to its own JSON file in the metrics directory, at most once per flush
+interval, so recording never waits for the disk (or blocks an event loop).
+``render()`` adds up the files of every process, so one scrape of any
+gunicorn worker reports the whole server. The files of exited processes are
+added to one aggregate file and deleted (at exit, or by the next scrape for
+a process that was killed), which keeps counters monotonic across worker
+restarts without a file per process ever started; clear the directory when
+deploying.
+
+Environment:
+    MEDFLOW_METRICS                 set to 0 to disable collection
+    MEDFLOW_METRICS_DIR             shared directory (default $MEDFLOW_DATA_DIR/metrics)
+    MEDFLOW_METRICS_FLUSH_SECONDS   time between writes of this process's file (default 1)
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import functools
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any, Tuple
+
+from data_dir import data_path
+
+# Series of exited processes, added up
+AGGREGATE_FILE = 'exited.json'
+
+# Upper bounds in seconds, from a local file write to a long Whisper upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+HELP = {
+    'medflow_stage_duration_seconds': 'Duration of agent calls, OpenAI calls, Whisper calls and storage operations',
+    'medflow_stage_errors_total': 'Stage calls that raised, by exception type',
+    'medflow_request_duration_seconds': 'Duration of HTTP requests until the response is returned',
+    'medflow_rate_limit_wait_seconds': 'Time OpenAI calls were queued for rate limit budget',
+    'medflow_llm_calls_total': 'Chat completions sent to the API, retries and hedges not counted',
+    'medflow_llm_retries_total': 'Chat completion attempts retried after a transient failure',
+    'medflow_llm_hedges_total': 'Duplicate attempts sent because the first was slower than the observed p95',
+    'medflow_llm_hedge_wins_total': 'Hedged attempts that answered first',
+    'medflow_llm_fallbacks_total': 'Attempts sent to the fallback model close to the deadline',
+    'medflow_llm_deadline_exceeded_total': 'Chat completions abandoned at their deadline',
+    'medflow_order_prefilter_total': 'Lab and pharmacy plans screened for orders, by outcome (orders, skipped, sampled)',
+    'medflow_order_prefilter_reviews_total': 'Screens checked against the LLM answer, by verdict (agree, missed, false_alarm)',
+    'medflow_demographics_total': 'Demographics extractions by path (rules only, rules plus a fields call, full LLM call)',
+}
+
+TYPES = {
+    'medflow_stage_duration_seconds': 'histogram',
+    'medflow_stage_errors_total': 'counter',
+    'medflow_request_duration_seconds': 'histogram',
+    'medflow_rate_limit_wait_seconds': 'histogram',
+    'medflow_llm_calls_total': 'counter',
+    'medflow_llm_retries_total': 'counter',
+    'medflow_llm_hedges_total': 'counter',
+    'medflow_llm_hedge_wins_total': 'counter',
+    'medflow_llm_fallbacks_total': 'counter',
+    'medflow_llm_deadline_exceeded_total': 'counter',
+    'medflow_order_prefilter_total': 'counter',
+    'medflow_order_prefilter_reviews_total': 'counter',
+    'medflow_demographics_total': 'counter',
+}
+
+
+def _series_key(name: str, labels: Dict[str, str]) -> str:
+    return json.dumps([name, sorted((k, str(v)) for k, v in labels.items())])
+
+
+def _parse_key(key: str) -> Tuple[str, Dict[str, str]]:
+    name, labels = json.loads(key)
+    return name, dict(labels)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(round(value, 6))
+
+
+def _add(total: Dict[str, Any], data: Dict[str, Any]):
+    """Add the histograms and counters of ``data`` to ``total`` (same buckets)"""
+    for key, series in data['histograms'].items():
+        summed = total['histograms'].setdefault(key, {'buckets': [0] * len(series['buckets']), 'sum': 0.0, 'count': 0})
+        summed['buckets'] = [a + b for a, b in zip(summed['buckets'], series['buckets'])]
+        summed['sum'] += series['sum']
+        summed['count'] += series['count']
+    for key, value in data['counters'].items():
+        total['counters'][key] = total['counters'].get(key, 0) + value
+
+
+def _process_exited(path: Path) -> bool:
+    """Whether the process that wrote ``<pid>-<id>.json`` is gone"""
+    try:
+        pid = int(path.name.split('-', 1)[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class Metrics:
+
+    def __init__(self, directory: Path = None, enabled: bool = None, flush_interval: float = None,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        if enabled is None:
+            enabled = os.getenv('MEDFLOW_METRICS', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+        if directory is None:
+            directory = os.getenv('MEDFLOW_METRICS_DIR') or data_path('metrics')
+        if flush_interval is None:
+            flush_interval = float(os.getenv('MEDFLOW_METRICS_FLUSH_SECONDS', '1'))
+
+        self.enabled = enabled
+        self.directory = Path(directory)
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._histograms: Dict[str, Dict[str, Any]] = {}
+        self._counters: Dict[str, float] = {}
+        self._dirty = False
+        self._last_flush = 0.0
+        self._timer = None
+        # The pid alone can be reused by a later worker, whose file would overwrite this one
+        self._file = self.directory / f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+
+    def _after_fork(self):
+        # A child starts empty; what the parent recorded stays in the parent's file
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._reset_state()
+
+    def observe(self, name: str, seconds: float, **labels):
+        if not self.enabled:
+            return
+        key = _series_key(name, labels)
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                series['buckets'][index] += 1
+            series['sum'] += seconds
+            series['count'] += 1
+            self._dirty = True
+        self._schedule_flush()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = _series_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._dirty = True
+        self._schedule_flush()
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time the block as ``stage``; an exception is also counted as an error of that stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc('medflow_stage_errors_total', stage=stage, error=type(e).__name__)
+            raise
+        finally:
+            self.observe('medflow_stage_duration_seconds', time.perf_counter() - started, stage=stage)
+
+    def timed(self, stage: str):
+        """Decorator form of ``span``"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _schedule_flush(self):
+        """Have a background thread write the file ``flush_interval`` after the last write"""
+        with self._lock:
+            if self._timer is not None:
+                return
+            delay = max(0.0, self.flush_interval - (time.monotonic() - self._last_flush))
+            self._timer = threading.Timer(delay, self._timed_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_flush(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def flush(self):
+        """Write this process's series to its file"""
+        if not self.enabled:
+            return
+        # Serializes writers so a newer snapshot is never replaced by an older one
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                payload = json.dumps({
+                    'buckets': self.buckets,
+                    'histograms': self._histograms,
+                    'counters': self._counters,
+                })
+                self._dirty = False
+                self._last_flush = time.monotonic()
+                path = self._file
+
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix('.tmp')
+                tmp_path.write_text(payload)
+                # Readers in other workers only ever see a complete file
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"⚠️  Could not write metrics to {path}: {e}")
+
+    def collect(self) -> Dict[str, Any]:
+        """Series of every process that wrote to the metrics directory, added up"""
+        self.flush()
+        self._fold([path for path in self.directory.glob('*-*.json') if _process_exited(path)])
+        total = {'histograms': {}, 'counters': {}}
+        try:
+            with self._directory_lock(fcntl.LOCK_SH):
+                # A fold in another worker cannot count a file twice, or not at all, while the files are read
+                aggregate = self._read(self.directory / AGGREGATE_FILE) or {}
+                folded = set(aggregate.get('folded', ()))
+                for path in sorted(self.directory.glob('*.json')):
+                    data = self._read(path) if path.name not in folded else None
+                    if data is not None:
+                        _add(total, data)
+        except OSError as e:
+            print(f"⚠️  Could not read metrics from {self.directory}: {e}")
+        return total
+
+    def fold_own(self):
+        """Write this process's series and move them to the aggregate file, when it exits"""
+        if not self.enabled:
+            return
+        self.flush()
+        self._fold([self._file])
+        # A timer still pending must not write the file again
+        self.enabled = False
+
+    @contextmanager
+    def _directory_lock(self, operation: int):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / '.lock', 'a') as lock:
+            fcntl.flock(lock, operation)
+            yield
+
+    def _read(self, path: Path):
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            # Removed or replaced between the glob and the read
+            return None
+        if tuple(data.get('buckets', ())) != self.buckets:
+            return None
+        return data
+
+    def _fold(self, paths):
+        """Add the files of exited processes to the aggregate file and delete them"""
+        paths = [path for path in paths if path.exists()]
+        if not paths:
+            return
+        aggregate_file = self.directory / AGGREGATE_FILE
+        try:
+            with self._directory_lock(fcntl.LOCK_EX):
+                aggregate = self._read(aggregate_file) or {'histograms': {}, 'counters': {}}
+                # Files added by a fold that stopped before deleting them
+                folded = set(aggregate.get('folded', ()))
+                for path in paths:
+                    data = self._read(path) if path.name not in folded else None
+                    if data is not None:
+                        _add(aggregate, data)
+                    folded.add(path.name)
+                aggregate['buckets'] = self.buckets
+                aggregate['folded'] = sorted(name for name in folded if (self.directory / name).exists())
+
+                tmp_path = aggregate_file.with_suffix('.tmp')
+                tmp_path.write_text(json.dumps(aggregate))
+                os.replace(tmp_path, aggregate_file)
+                for path in paths:
+                    for stale in (path, path.with_suffix('.tmp')):
+                        try:
+                            stale.unlink()
+                        except FileNotFoundError:
+                            pass
+        except OSError as e:
+            print(f"⚠️  Could not fold metrics files into {aggregate_file}: {e}")
+
+    def render(self) -> str:
+        """All series in the Prometheus text exposition format (version 0.0.4)"""
+        if not self.enabled:
+            return ''
+        data = self.collect()
+        families: Dict[str, list] = {}
+
+        for key, series in sorted(data['histograms'].items()):
+            name, labels = _parse_key(key)
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['buckets']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(series['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {series['count']}")
+
+        for key, value in sorted(data['counters'].items()):
+            name, labels = _parse_key(key)
+            families.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        output = []
+        for name in sorted(families):
+            if name in HELP:
+                output.append(f"# HELP {name} {HELP[name]}")
+            output.append(f"# TYPE {name} {TYPES.get(name, 'untyped')}")
+            output.extend(families[name])
+        return '\n'.join(output) + '\n' if output else ''
+
+
+# Singleton instance
+metrics = Metrics()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics._after_fork)
+
+# Whatever a short-lived process (e.g. a management command) recorded, without leaving a file of its own
+atexit.register(metrics.fold_own)
@@ -0,0 +1,246 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+from pathlib import Path
+from typing import Dict, Any, List
+
+from data_dir import data_path
+from metrics import metrics
+
+# Anything here in the assessment or plan sends the note to the LLM
+LAB_TERMS = (
+    'lab', 'labs', 'lab work', 'laboratory', 'blood work', 'bloodwork', 'blood test', 'blood draw', 'draw',
+    'panel', 'test', 'tests', 'testing', 'screen', 'screening', 'level', 'levels', 'culture', 'cultures',
+    'titer', 'assay', 'cbc', 'complete blood count', 'cmp', 'bmp', 'metabolic panel', 'lipid', 'lipids',
+    'cholesterol', 'a1c', 'hba1c', 'hemoglobin', 'hematocrit', 'platelets', 'tsh', 't3', 't4', 'thyroid',
+    'urinalysis', 'ua', 'urine', 'stool', 'psa', 'inr', 'pt/inr', 'ptt', 'ferritin', 'iron', 'b12', 'folate',
+    'vitamin d', 'magnesium', 'potassium', 'sodium', 'calcium', 'phosphorus', 'creatinine', 'bun', 'egfr',
+    'gfr', 'microalbumin', 'albumin', 'lft', 'lfts', 'liver function', 'ast', 'alt', 'bilirubin', 'lipase',
+    'amylase', 'troponin', 'bnp', 'd-dimer', 'esr', 'crp', 'sed rate', 'glucose', 'hcg', 'pregnancy',
+    'strep', 'covid', 'influenza', 'flu swab', 'swab', 'pcr', 'hiv', 'hepatitis', 'sti', 'std', 'pap',
+    'hpv', 'biopsy', 'pathology', 'fit test', 'fobt', 'hemoccult', 'ana', 'rheumatoid factor', 'uric acid',
+    'cortisol', 'testosterone', 'estradiol', 'prolactin', 'lactate', 'blood gas', 'abg', 'type and screen',
+    # Ordering verbs and studies the agent may list alongside lab tests
+    'order', 'orders', 'ordered', 'obtain', 'repeat', 'recheck', 'work-up', 'workup', 'imaging', 'x-ray',
+    'xray', 'ultrasound', 'ct', 'mri', 'ekg', 'ecg',
+)
+
+PHARMACY_TERMS = (
+    'medication', 'medications', 'med', 'meds', 'medicine', 'drug', 'drugs', 'prescription', 'prescriptions',
+    'prescribe', 'prescribed', 'rx', 'refill', 'refills', 'dose', 'doses', 'dosage', 'dosing', 'titrate',
+    'taper', 'tablet', 'tablets', 'tab', 'tabs', 'capsule', 'capsules', 'pill', 'pills', 'inhaler', 'nebulizer',
+    'patch', 'cream', 'ointment', 'gel', 'lotion', 'drops', 'spray', 'injection', 'injections', 'infusion',
+    'shot', 'vaccine', 'vaccination', 'immunization', 'booster', 'antibiotic', 'antibiotics', 'antiviral',
+    'steroid', 'steroids', 'supplement', 'supplements', 'otc', 'over the counter', 'insulin', 'aspirin',
+    'acetaminophen', 'tylenol', 'ibuprofen', 'advil', 'motrin', 'naproxen', 'aleve', 'metformin',
+    'levothyroxine', 'synthroid', 'warfarin', 'coumadin', 'heparin', 'prednisone', 'methylprednisolone',
+    'albuterol', 'fluticasone', 'montelukast', 'gabapentin', 'pregabalin', 'hydrochlorothiazide', 'hctz',
+    'chlorthalidone', 'furosemide', 'lasix', 'spironolactone', 'amoxicillin', 'augmentin', 'azithromycin',
+    'doxycycline', 'cephalexin', 'keflex', 'nitrofurantoin', 'bactrim', 'trimethoprim', 'clindamycin',
+    'metronidazole', 'sertraline', 'fluoxetine', 'citalopram', 'escitalopram', 'bupropion', 'trazodone',
+    'venlafaxine', 'duloxetine', 'buspirone', 'hydroxyzine', 'cetirizine', 'loratadine', 'diphenhydramine',
+    'ondansetron', 'zofran', 'clopidogrel', 'plavix', 'digoxin', 'amiodarone', 'nitroglycerin',
+    'tamsulosin', 'finasteride', 'allopurinol', 'colchicine', 'tramadol', 'oxycodone', 'hydrocodone',
+    'morphine', 'cyclobenzaprine', 'meloxicam', 'potassium chloride', 'vitamin', 'iron supplement',
+    'epinephrine', 'epipen', 'naloxone', 'nicotine', 'varenicline', 'sumatriptan', 'semaglutide',
+    'ozempic', 'tirzepatide', 'januvia', 'jardiance', 'eliquis', 'xarelto', 'lisinopril', 'losartan',
+    'amlodipine', 'atorvastatin', 'rosuvastatin', 'simvastatin', 'metoprolol', 'carvedilol', 'omeprazole',
+    'pantoprazole', 'famotidine', 'diclofenac', 'regimen',
+    # Medication changes where the drug name may be missing from the lexicon
+    'start', 'started', 'starting', 'begin', 'initiate', 'switch', 'switched', 'discontinue', 'discontinued',
+    'stop', 'resume', 'increase', 'increased', 'decrease', 'decreased', 'reduce', 'wean',
+)
+
+# Generic name stems shared by whole drug classes (-pril, -sartan, -olol, ...)
+DRUG_SUFFIX_PATTERN = re.compile(
+    r'\b[a-z]{3,}(?:pril|sartan|olol|dipine|statin|formin|gliptin|gliflozin|glutide|prazole|tidine|cillin|'
+    r'mycin|cycline|floxacin|conazole|oxetine|triptan|profen|parin|xaban|gatran|lukast|terol|asone|olone|'
+    r'thiazide|semide|tropium|vudine|ciclovir|mab)\b'
+)
+
+DOSE_PATTERNS = (
+    re.compile(r'\b\d+(?:\.\d+)?\s*(?:mg|mcg|µg|g|gm|ml|cc|units?|iu|meq|puffs?|tabs?|caps?|%)(?![a-z])'),
+    re.compile(r'\b(?:qd|bid|tid|qid|qhs|qam|qpm|qod|prn|po|sl|im|iv|subq|sq|q\d+h|q\s?\d+\s?hours?)\b'),
+    re.compile(r'\b(?:once|twice|three times|four times) (?:a |per )?(?:day|daily|week|weekly)\b'),
+    re.compile(r'\b(?:daily|nightly|at bedtime|every (?:morning|evening|night|other day))\b'),
+)
+
+# Orders that are explicitly ruled out ("no labs needed") do not count as mentions
+NEGATED_ORDERS = re.compile(
+    r'\b(?:no|without|not|none)\s+(?:new\s+|further\s+|additional\s+|other\s+|more\s+)?'
+    r'(?:labs?|lab work|blood ?work|tests?|testing|medications?|meds|prescriptions?|refills?|'
+    r'changes? (?:to|in) (?:medications?|meds))'
+    r'(?:\s+(?:needed|necessary|required|ordered|indicated|planned|at this time|today|this visit))*\b'
+)
+
+NO_ORDERS_MESSAGES = {
+    'lab': 'No lab tests found in plan',
+    'pharmacy': 'No medications found in plan',
+}
+
+PREFILTER_MODES = ('on', 'shadow', 'off')
+
+
+def _term_pattern(terms) -> re.Pattern:
+    alternatives = sorted((re.escape(term) for term in terms), key=len, reverse=True)
+    return re.compile(r'(?<![a-z0-9])(?:' + '|'.join(alternatives) + r')(?![a-z0-9])')
+
+
+LAB_PATTERNS = (_term_pattern(LAB_TERMS),)
+PHARMACY_PATTERNS = (_term_pattern(PHARMACY_TERMS), DRUG_SUFFIX_PATTERN) + DOSE_PATTERNS
+
+
+class Screening:
+    """What the prefilter saw in one plan, and whether the LLM call is skipped"""
+
+    def __init__(self, agent: str, matches: List[str], skip: bool, sampled: bool, text: str):
+        self.agent = agent
+        self.matches = matches
+        self.skip = skip
+        self.sampled = sampled
+        self.text = text
+
+    @property
+    def has_orders(self) -> bool:
+        return bool(self.matches)
+
+    def no_orders_response(self) -> Dict[str, Any]:
+        """The same answer the LLM gives for a plan without orders"""
+        return {
+            'request_type': 'none',
+            'message': NO_ORDERS_MESSAGES[self.agent]
+        }
+
+
+class OrderPrefilter:
+    """
+    Keyword and pattern screen run before the lab and pharmacy agents.
+
+    A plan whose assessment and plan mention no test, drug, drug-class stem or
+    dosing pattern cannot produce an order, so the agent answers
+    ``request_type: none`` without calling the API. The lexicons are
+    deliberately broad: a false alarm only costs the call the agent would
+    have made anyway.
+
+    To check that it is safe, a sample of the plans it would skip is still
+    sent to the LLM; any plan where the LLM finds orders is counted as a miss
+    and appended to the disagreement log for review.
+
+    Configuration from the environment:
+        MEDFLOW_ORDER_PREFILTER          on (default), shadow (always call, only compare) or off
+        MEDFLOW_ORDER_PREFILTER_SAMPLE   fraction of skippable plans sent anyway (default 0.05)
+        MEDFLOW_ORDER_PREFILTER_LOG      JSONL log of misses (default $MEDFLOW_DATA_DIR/order_prefilter_misses.jsonl)
+    """
+
+    def __init__(self, mode: str = None, sample_rate: float = None, log_path: str = None):
+        if mode is None:
+            mode = os.getenv('MEDFLOW_ORDER_PREFILTER', 'on').strip().lower()
+        if mode not in PREFILTER_MODES:
+            raise ValueError(f"Unknown MEDFLOW_ORDER_PREFILTER '{mode}', expected one of {', '.join(PREFILTER_MODES)}")
+        if sample_rate is None:
+            sample_rate = float(os.getenv('MEDFLOW_ORDER_PREFILTER_SAMPLE', '0.05'))
+        if log_path is None:
+            log_path = os.getenv('MEDFLOW_ORDER_PREFILTER_LOG') or data_path('order_prefilter_misses.jsonl')
+
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.log_path = Path(log_path)
+        self._log_lock = threading.Lock()
+
+    def find_orders(self, agent: str, soap_note: Dict[str, str]) -> List[str]:
+        """Order terms and patterns in the note's assessment and plan"""
+        text = f"{soap_note.get('assessment') or ''}\n{soap_note.get('plan') or ''}".lower()
+        text = NEGATED_ORDERS.sub(' ', text)
+        patterns = LAB_PATTERNS if agent == 'lab' else PHARMACY_PATTERNS
+        matches = []
+        for pattern in patterns:
+            for match in pattern.finditer(text):
+                if match.group(0) not in matches:
+                    matches.append(match.group(0))
+        return matches
+
+    def screen(self, agent: str, soap_note: Dict[str, str]) -> Screening:
+        if self.mode == 'off':
+            return Screening(agent, [], False, False, '')
+
+        matches = self.find_orders(agent, soap_note)
+        text = f"ASSESSMENT:\n{soap_note.get('assessment') or ''}\n\nPLAN:\n{soap_note.get('plan') or ''}"
+        if matches:
+            metrics.inc('medflow_order_prefilter_total', agent=agent, outcome='orders')
+            return Screening(agent, matches, False, False, text)
+
+        sampled = self.mode == 'shadow' or random.random() < self.sample_rate
+        metrics.inc('medflow_order_prefilter_total', agent=agent, outcome='sampled' if sampled else 'skipped')
+        if not sampled:
+            print(f"✓ {agent.capitalize()} request skipped: no orders in plan")
+        return Screening(agent, [], not sampled, sampled, text)
+
+    def review(self, screening: Screening, result: Dict[str, Any]):
+        """Compare the LLM's answer with the screen's; a missed order is logged for review"""
+        if self.mode == 'off':
+            return
+        llm_orders = result.get('request_type') != 'none'
+        if screening.has_orders:
+            verdict = 'agree' if llm_orders else 'false_alarm'
+        else:
+            verdict = 'missed' if llm_orders else 'agree'
+        metrics.inc('medflow_order_prefilter_reviews_total', agent=screening.agent, verdict=verdict)
+        if verdict == 'missed':
+            print(f"⚠️  Order prefilter missed {screening.agent} orders; logged to {self.log_path}")
+            self._log_miss(screening, result)
+
+    def _log_miss(self, screening: Screening, result: Dict[str, Any]):
+        entry = {
+            'time': time.time(),
+            'agent': screening.agent,
+            'text': screening.text,
+            'llm_result': result.get('test_details') or result.get('prescription_details') or result,
+        }
+        try:
+            with self._log_lock:
+                self.log_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(entry, default=str) + '\n')
+        except OSError as e:
+            print(f"⚠️  Could not write order prefilter log: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Skip and miss rates per agent, summed over all workers"""
+        counters = metrics.collect()['counters'] if metrics.enabled else {}
+        agents: Dict[str, Dict[str, float]] = {}
+        for series, value in counters.items():
+            name, labels = json.loads(series)
+            labels = dict(labels)
+            if name == 'medflow_order_prefilter_total':
+                key = labels['outcome']
+            elif name == 'medflow_order_prefilter_reviews_total':
+                key = labels['verdict']
+            else:
+                continue
+            counts = agents.setdefault(labels['agent'], {
+                'orders': 0, 'skipped': 0, 'sampled': 0, 'agree': 0, 'missed': 0, 'false_alarm': 0
+            })
+            counts[key] += value
+
+        result = {}
+        for agent, counts in sorted(agents.items()):
+            screened = counts['orders'] + counts['skipped'] + counts['sampled']
+            result[agent] = {
+                **{key: int(value) for key, value in counts.items()},
+                'screened': int(screened),
+                'skip_rate': round(counts['skipped'] / screened, 4) if screened else 0.0,
+                # Misses among the plans the screen would have skipped and the LLM saw anyway
+                'miss_rate': round(counts['missed'] / counts['sampled'], 4) if counts['sampled'] else 0.0,
+            }
+        return {
+            'mode': self.mode,
+            'sample_rate': self.sample_rate,
+            'agents': result,
+        }
+
+
+# Singleton instance
+order_prefilter = OrderPrefilter()
@@ -1,50 +1,129 @@
 import os
 import json
-from typing import Dict, Any
-from openai import OpenAI
+from typing import Dict, Any, List, Optional, Tuple
+from openai import AsyncOpenAI
+from llm_client import get_client, get_async_client, chat_completion, achat_completion
 from prompt_loader import PromptLoader
+from demographics_rules import demographics_rules, FIELD_DESCRIPTIONS
+from metrics import metrics
 
 
 class PatientDataExtractor:
     
-    def __init__(self, api_key: str = None, prompts_file: str = None):
+    def __init__(self, api_key: str = None, prompts_file: str = None, use_rules: bool = None):
         self.api_key = api_key or os.getenv('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("OpenAI API key required")
-        self.client = OpenAI(api_key=self.api_key)
+        if use_rules is None:
+            use_rules = os.getenv('MEDFLOW_DEMOGRAPHICS_RULES', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+        self.client = get_client(self.api_key)
         self.prompt_loader = PromptLoader(prompts_file)
         self.config = self.prompt_loader.get_config('patient_data_extraction')
+        self.fields_config = self.prompt_loader.get_config('patient_data_fields')
+        self.use_rules = use_rules
+    
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        # Async clients are bound to the running event loop
+        return get_async_client(self.api_key)
     
     def extract_patient_data(self, transcription: str) -> Dict[str, Any]:
-        if not transcription or len(transcription.strip()) < 20:
-            raise ValueError("Transcription too short")
+        found, unresolved = self._apply_rules(transcription)
+        if found is not None and not unresolved:
+            return self._clean_empty_fields(demographics_rules.to_schema(found))
         
+        category, request = self._build_llm_request(transcription, unresolved)
         try:
-            user_message = self.config['user_message_template'].format(
-                transcription=transcription
-            )
+            content = chat_completion(self.client, category, request)
+            data = json.loads(content)
             
-            response = self.client.chat.completions.create(
-                model=self.config['model'],
-                messages=[
-                    {"role": "system", "content": self.config['system_prompt']},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=self.config['temperature'],
-                max_tokens=self.config['max_tokens'],
-                response_format={"type": "json_object"}
-            )
+            return self._merge(found, unresolved, data)
             
-            content = response.choices[0].message.content
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse JSON response: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error extracting patient data: {str(e)}")
+    
+    async def aextract_patient_data(self, transcription: str) -> Dict[str, Any]:
+        found, unresolved = self._apply_rules(transcription)
+        if found is not None and not unresolved:
+            return self._clean_empty_fields(demographics_rules.to_schema(found))
+        
+        category, request = self._build_llm_request(transcription, unresolved)
+        try:
+            content = await achat_completion(self.async_client, category, request)
             data = json.loads(content)
             
-            return self._clean_empty_fields(data)
+            return self._merge(found, unresolved, data)
             
         except json.JSONDecodeError as e:
             raise Exception(f"Failed to parse JSON response: {str(e)}")
         except Exception as e:
             raise Exception(f"Error extracting patient data: {str(e)}")
     
+    def _apply_rules(self, transcription: str) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+        """Fields the rules resolved (None when they are off) and the ones left for the LLM"""
+        if not transcription or len(transcription.strip()) < 20:
+            raise ValueError("Transcription too short")
+        if not self.use_rules:
+            metrics.inc('medflow_demographics_total', path='full')
+            return None, []
+        
+        found, unresolved = demographics_rules.extract(transcription)
+        metrics.inc('medflow_demographics_total', path='fields' if unresolved else 'rules')
+        if unresolved:
+            print(f"✓ Demographics: {len(found)} field(s) from rules, asking the LLM for {', '.join(unresolved)}")
+        else:
+            print(f"✓ Demographics: all {len(found)} field(s) from rules, no LLM call")
+        return found, unresolved
+    
+    def _build_llm_request(self, transcription: str, unresolved: List[str]) -> Tuple[str, Dict[str, Any]]:
+        if not unresolved:
+            return 'patient_data_extraction', self._build_request(transcription)
+        return 'patient_data_fields', self._build_fields_request(transcription, unresolved)
+    
+    def _build_request(self, transcription: str) -> Dict[str, Any]:
+        user_message = self.config['user_message_template'].format(
+            transcription=transcription
+        )
+        
+        return {
+            "model": self.config['model'],
+            "messages": [
+                {"role": "system", "content": self.config['system_prompt']},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": self.config['temperature'],
+            "max_tokens": self.config['max_tokens'],
+            "response_format": {"type": "json_object"}
+        }
+    
+    def _build_fields_request(self, transcription: str, fields: List[str]) -> Dict[str, Any]:
+        """Ask only for ``fields``, showing only the turns that talk about them"""
+        user_message = self.fields_config['user_message_template'].format(
+            fields="\n".join(f"- {field}: {FIELD_DESCRIPTIONS[field]}" for field in fields),
+            excerpts=demographics_rules.excerpts(transcription, fields)
+        )
+        
+        return {
+            "model": self.fields_config['model'],
+            "messages": [
+                {"role": "system", "content": self.fields_config['system_prompt']},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": self.fields_config['temperature'],
+            "max_tokens": self.fields_config['max_tokens'],
+            "response_format": {"type": "json_object"}
+        }
+    
+    def _merge(self, found: Optional[Dict[str, Any]], unresolved: List[str], data: Dict[str, Any]) -> Dict[str, Any]:
+        if found is None:
+            # Full extraction: the response already has the nested structure
+            return self._clean_empty_fields(data)
+        fields = dict(found)
+        fields.update({field: data[field] for field in unresolved if field in data})
+        return self._clean_empty_fields(demographics_rules.to_schema(fields))
+    
     def _clean_empty_fields(self, data: Dict[str, Any]) -> Dict[str, Any]:
         if isinstance(data, dict):
             return {
@@ -1,9 +1,11 @@
 import os
 import json
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
-from openai import OpenAI
+from openai import AsyncOpenAI
+from llm_client import get_client, get_async_client, chat_completion, achat_completion
 from prompt_loader import PromptLoader
+from order_prefilter import order_prefilter
 
 
 class PharmacyRequestGenerator:
@@ -12,21 +14,69 @@ class PharmacyRequestGenerator:
         self.api_key = api_key or os.getenv('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("OpenAI API key required")
-        self.client = OpenAI(api_key=self.api_key)
+        self.client = get_client(self.api_key)
         self.prompt_loader = PromptLoader(prompts_file)
         self.config = self.prompt_loader.get_config('pharmacy_request_generation')
     
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        # Async clients are bound to the running event loop
+        return get_async_client(self.api_key)
+    
     def generate_pharmacy_request(
         self, 
         soap_note: Dict[str, str], 
         patient_data: Dict[str, Any]
     ) -> Dict[str, Any]:
+        request = self._build_request(soap_note)
+        if request is None:
+            return self._no_plan_response()
+        
+        # A plan that mentions no orders is answered without calling the API
+        screening = order_prefilter.screen('pharmacy', soap_note)
+        if screening.skip:
+            return screening.no_orders_response()
+        
+        try:
+            content = chat_completion(self.client, 'pharmacy_request_generation', request)
+            result = self._handle_response(content, patient_data, soap_note)
+            order_prefilter.review(screening, result)
+            return result
+            
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse JSON response: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error generating pharmacy request: {str(e)}")
+    
+    async def agenerate_pharmacy_request(
+        self, 
+        soap_note: Dict[str, str], 
+        patient_data: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        request = self._build_request(soap_note)
+        if request is None:
+            return self._no_plan_response()
+        
+        # A plan that mentions no orders is answered without calling the API
+        screening = order_prefilter.screen('pharmacy', soap_note)
+        if screening.skip:
+            return screening.no_orders_response()
+        
+        try:
+            content = await achat_completion(self.async_client, 'pharmacy_request_generation', request)
+            result = self._handle_response(content, patient_data, soap_note)
+            order_prefilter.review(screening, result)
+            return result
+            
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse JSON response: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error generating pharmacy request: {str(e)}")
+    
+    def _build_request(self, soap_note: Dict[str, str]) -> Optional[Dict[str, Any]]:
         plan = soap_note.get('plan', '')
         if not plan:
-            return {
-                "request_type": "none",
-                "message": "No plan found in SOAP note"
-            }
+            return None
         
         assessment = soap_note.get('assessment', '')
         
@@ -38,40 +88,43 @@ PLAN:
 {plan}
 """
         
-        try:
-            user_message = self.config['user_message_template'].format(
-                context=context
-            )
-            
-            response = self.client.chat.completions.create(
-                model=self.config['model'],
-                messages=[
-                    {"role": "system", "content": self.config['system_prompt']},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=self.config['temperature'],
-                max_tokens=self.config['max_tokens'],
-                response_format={"type": "json_object"}
-            )
-            
-            content = response.choices[0].message.content
-            pharmacy_request = json.loads(content)
-            
-            if pharmacy_request.get('request_type') == 'none':
-                return pharmacy_request
-            
-            complete_requisition = self._create_complete_requisition(
-                pharmacy_request, 
-                patient_data,
-                soap_note
-            )
-            
-            return complete_requisition
-            
-        except json.JSONDecodeError as e:
-            raise Exception(f"Failed to parse JSON response: {str(e)}")
-        except Exception as e:
-            raise Exception(f"Error generating pharmacy request: {str(e)}")
+        user_message = self.config['user_message_template'].format(
+            context=context
+        )
+        
+        return {
+            "model": self.config['model'],
+            "messages": [
+                {"role": "system", "content": self.config['system_prompt']},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": self.config['temperature'],
+            "max_tokens": self.config['max_tokens'],
+            "response_format": {"type": "json_object"}
+        }
+    
+    def _no_plan_response(self) -> Dict[str, Any]:
+        return {
+            "request_type": "none",
+            "message": "No plan found in SOAP note"
+        }
+    
+    def _handle_response(
+        self, 
+        content: str, 
+        patient_data: Dict[str, Any],
+        soap_note: Dict[str, str]
+    ) -> Dict[str, Any]:
+        pharmacy_request = json.loads(content)
+        
+        if pharmacy_request.get('request_type') == 'none':
+            return pharmacy_request
+        
+        return self._create_complete_requisition(
+            pharmacy_request, 
+            patient_data,
+            soap_note
+        )
     
     def _create_complete_requisition(
         self, 
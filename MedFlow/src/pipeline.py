@@ -0,0 +1,388 @@
+import os
+import time
+import asyncio
+import inspect
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Any, List, Callable, Iterable, Optional
+
+from metrics import metrics
+
+
+class Stage:
+    """
+    A single pipeline step: ``func`` is called with its ``inputs`` as keyword arguments.
+    ``reads`` optionally narrows a dictionary input to the keys the stage actually
+    uses, so an edit elsewhere in that input does not make the stage stale.
+    """
+
+    def __init__(self, name: str, func: Callable[..., Any], inputs: Iterable[str] = (),
+                 reads: Dict[str, Iterable[str]] = None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.reads = {name: tuple(keys) for name, keys in (reads or {}).items()}
+
+    def uses(self, field: str) -> bool:
+        """Whether ``field`` ('soap_note' or 'soap_note.plan') is part of this stage's input"""
+        name, _, key = field.partition('.')
+        if name not in self.inputs:
+            return False
+        keys = self.reads.get(name)
+        return keys is None or not key or key in keys
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={list(self.inputs)!r})"
+
+
+class PipelineError(Exception):
+    """Raised when a stage fails; carries whatever the other stages already produced."""
+
+    def __init__(self, stage: str, error: Exception, outputs: Dict[str, Any], timings: Dict[str, float]):
+        super().__init__(f"Stage '{stage}' failed: {error}")
+        self.stage = stage
+        self.error = error
+        self.outputs = outputs
+        self.timings = timings
+
+
+class PipelineResult:
+
+    def __init__(self, outputs: Dict[str, Any], timings: Dict[str, float], total_seconds: float):
+        self.outputs = outputs
+        self.timings = timings
+        self.total_seconds = total_seconds
+
+    def __getitem__(self, key: str) -> Any:
+        return self.outputs[key]
+
+    def timing_summary(self) -> Dict[str, Any]:
+        return {
+            "stages": {name: round(seconds, 3) for name, seconds in self.timings.items()},
+            "total": round(self.total_seconds, 3),
+        }
+
+
+class PipelineExecutor:
+    """
+    Runs a graph of stages, starting each one as soon as all of its inputs exist.
+
+    Independent stages run in parallel on a bounded thread pool shared by every
+    run in the process (or as concurrent coroutines with ``arun``), so
+    end-to-end latency is the longest path through the graph rather than the
+    sum of all stages.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or int(os.getenv('MEDFLOW_PIPELINE_WORKERS', '4'))
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        # Threads do not survive fork, so a pool inherited from a preforking parent is rebuilt
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='medflow-pipeline'
+                )
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def run(self, stages: List[Stage], initial: Dict[str, Any], completed: Dict[str, Any] = None,
+            on_stage_complete: Callable[[str, Any], Any] = None) -> PipelineResult:
+        """
+        Run ``stages`` from ``initial``. Stages already in ``completed`` (e.g.
+        checkpoints of an earlier attempt) are not run again; their outputs are
+        used as they are. ``on_stage_complete(name, output)`` is called as each
+        stage finishes.
+        """
+        completed = completed or {}
+        self._validate(stages, {**initial, **completed})
+
+        outputs = {**initial, **completed}
+        timings = {}
+        pending = {stage.name: stage for stage in stages if stage.name not in completed}
+        running = {}
+        pool = self._get_pool()
+        started = time.perf_counter()
+
+        def timed_call(stage: Stage, kwargs: Dict[str, Any]):
+            stage_start = time.perf_counter()
+            try:
+                with metrics.span(f'agent.{stage.name}'):
+                    return stage.func(**kwargs)
+            finally:
+                timings[stage.name] = time.perf_counter() - stage_start
+
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(dep in outputs for dep in stage.inputs):
+                    kwargs = {dep: outputs[dep] for dep in stage.inputs}
+                    # Each stage runs in a copy of the caller's context (e.g. usage recording)
+                    context = contextvars.copy_context()
+                    running[pool.submit(context.run, timed_call, stage, kwargs)] = name
+                    del pending[name]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    for other in running:
+                        other.cancel()
+                    wait(running)
+                    # Keep the work of stages that were already in flight
+                    for other, other_name in running.items():
+                        if not other.cancelled() and other.exception() is None:
+                            outputs[other_name] = other.result()
+                            self._notify(on_stage_complete, other_name, outputs[other_name])
+                    raise PipelineError(name, error, self._stage_outputs(outputs, initial), timings) from error
+                outputs[name] = future.result()
+                self._notify(on_stage_complete, name, outputs[name])
+
+        return PipelineResult(
+            self._stage_outputs(outputs, initial),
+            timings,
+            time.perf_counter() - started
+        )
+
+    async def arun(self, stages: List[Stage], initial: Dict[str, Any], completed: Dict[str, Any] = None,
+                   on_stage_complete: Callable[[str, Any], Any] = None) -> PipelineResult:
+        """
+        Async counterpart of ``run``. Coroutine stages run on the event loop;
+        plain callables are pushed onto the thread pool so they never block it.
+        ``on_stage_complete`` may be a coroutine function.
+        """
+        completed = completed or {}
+        self._validate(stages, {**initial, **completed})
+
+        loop = asyncio.get_running_loop()
+        outputs = {**initial, **completed}
+        timings = {}
+        pending = {stage.name: stage for stage in stages if stage.name not in completed}
+        running = {}
+        started = time.perf_counter()
+
+        async def timed_call(stage: Stage, kwargs: Dict[str, Any]):
+            stage_start = time.perf_counter()
+            try:
+                with metrics.span(f'agent.{stage.name}'):
+                    if asyncio.iscoroutinefunction(stage.func):
+                        return await stage.func(**kwargs)
+                    context = contextvars.copy_context()
+                    return await loop.run_in_executor(
+                        self._get_pool(),
+                        functools.partial(context.run, stage.func, **kwargs)
+                    )
+            finally:
+                timings[stage.name] = time.perf_counter() - stage_start
+
+        try:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if all(dep in outputs for dep in stage.inputs):
+                        kwargs = {dep: outputs[dep] for dep in stage.inputs}
+                        running[asyncio.ensure_future(timed_call(stage, kwargs))] = name
+                        del pending[name]
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    error = task.exception()
+                    if error is not None:
+                        # Let in-flight stages finish so their work is not lost
+                        finished = await asyncio.gather(*running, return_exceptions=True)
+                        for other_name, value in zip(running.values(), finished):
+                            if not isinstance(value, BaseException):
+                                outputs[other_name] = value
+                                await self._anotify(on_stage_complete, other_name, value)
+                        running.clear()
+                        raise PipelineError(name, error, self._stage_outputs(outputs, initial), timings) from error
+                    outputs[name] = task.result()
+                    await self._anotify(on_stage_complete, name, outputs[name])
+        finally:
+            for task in running:
+                task.cancel()
+
+        return PipelineResult(
+            self._stage_outputs(outputs, initial),
+            timings,
+            time.perf_counter() - started
+        )
+
+    def _notify(self, callback: Optional[Callable[[str, Any], Any]], name: str, output: Any):
+        if callback is None:
+            return
+        try:
+            callback(name, output)
+        except Exception as e:
+            # A lost checkpoint only costs a repeated stage on retry, never this run
+            print(f"⚠️  Stage '{name}' completion callback failed: {str(e)}")
+
+    async def _anotify(self, callback: Optional[Callable[[str, Any], Any]], name: str, output: Any):
+        if callback is None:
+            return
+        try:
+            value = callback(name, output)
+            if inspect.isawaitable(value):
+                await value
+        except Exception as e:
+            print(f"⚠️  Stage '{name}' completion callback failed: {str(e)}")
+
+    def _stage_outputs(self, outputs: Dict[str, Any], initial: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in outputs.items() if k not in initial}
+
+    def _validate(self, stages: List[Stage], initial: Dict[str, Any]):
+        available = set(initial)
+        remaining = list(stages)
+        while remaining:
+            ready = [s for s in remaining if all(dep in available for dep in s.inputs)]
+            if not ready:
+                missing = {s.name: [d for d in s.inputs if d not in available] for s in remaining}
+                raise ValueError(f"Unsatisfiable pipeline inputs: {missing}")
+            for stage in ready:
+                available.add(stage.name)
+                remaining.remove(stage)
+
+
+def changed_fields(before: Dict[str, Any], after: Dict[str, Any], names: Iterable[str]) -> List[str]:
+    """
+    Fields of ``names`` that differ between ``before`` and ``after``, one level
+    deep for dictionaries ('soap_note.plan'). Names missing from ``after`` are unchanged.
+    """
+    changed = []
+    for name in names:
+        if name not in after:
+            continue
+        old, new = before.get(name), after[name]
+        if isinstance(old, dict) and isinstance(new, dict):
+            changed.extend(f'{name}.{key}' for key in sorted(set(old) | set(new)) if old.get(key) != new.get(key))
+        elif old != new:
+            changed.append(name)
+    return changed
+
+
+def stale_stages(stages: List[Stage], changed: Iterable[str], edited: Iterable[str] = ()) -> List[str]:
+    """
+    Stages whose output no longer matches their input after ``changed`` fields
+    were edited, plus every stage downstream of them. Stages named in ``edited``
+    were set by hand and are kept as they are.
+    """
+    changed = list(changed)
+    edited = set(edited)
+    stale = set()
+    grew = True
+    while grew:
+        grew = False
+        for stage in stages:
+            if stage.name in stale or stage.name in edited:
+                continue
+            if any(stage.uses(field) for field in changed) or any(dep in stale for dep in stage.inputs):
+                stale.add(stage.name)
+                grew = True
+    return [stage.name for stage in stages if stage.name in stale]
+
+
+# Parts of the SOAP note and demographics each downstream agent puts in its prompt or requisition
+SOAP_SECTIONS = ('subjective', 'objective', 'assessment', 'plan')
+REQUISITION_SOAP_SECTIONS = ('assessment', 'plan')
+REQUISITION_PATIENT_FIELDS = (
+    'personal_info', 'identifiers', 'contact_info', 'medical_context', 'insurance', 'medical_history_summary'
+)
+
+
+def build_consultation_stages(agents: Optional[Dict[str, Any]] = None, use_async: bool = False) -> List[Stage]:
+    """
+    The five-agent consultation graph.
+
+    Patient demographics and the SOAP note only need the transcription; clinical
+    data, lab and pharmacy requisitions can all start once those two exist.
+    With ``use_async`` the stages call the agents' ``a*`` coroutine methods, for
+    use with ``PipelineExecutor.arun``.
+    """
+    from soap_generator_agent import SOAPNoteGenerator
+    from data_extractor_agent import SOAPDataExtractor
+    from patient_agent import PatientDataExtractor
+    from lab_request_agent import LabRequestGenerator
+    from pharmacy_request_agent import PharmacyRequestGenerator
+
+    agents = agents or {}
+    patient_extractor = agents.get('patient_data') or PatientDataExtractor()
+    soap_generator = agents.get('soap_note') or SOAPNoteGenerator()
+    data_extractor = agents.get('clinical_data') or SOAPDataExtractor()
+    lab_generator = agents.get('lab_requisition') or LabRequestGenerator()
+    pharmacy_generator = agents.get('pharmacy_requisition') or PharmacyRequestGenerator()
+
+    # Agent method parameter names match the stage names they consume
+    if use_async:
+        funcs = {
+            'patient_data': patient_extractor.aextract_patient_data,
+            'soap_note': soap_generator.agenerate_soap_note,
+            'clinical_data': data_extractor.aextract_data,
+            'lab_requisition': lab_generator.agenerate_lab_request,
+            'pharmacy_requisition': pharmacy_generator.agenerate_pharmacy_request,
+        }
+    else:
+        funcs = {
+            'patient_data': patient_extractor.extract_patient_data,
+            'soap_note': soap_generator.generate_soap_note,
+            'clinical_data': data_extractor.extract_data,
+            'lab_requisition': lab_generator.generate_lab_request,
+            'pharmacy_requisition': pharmacy_generator.generate_pharmacy_request,
+        }
+
+    requisition_reads = {'soap_note': REQUISITION_SOAP_SECTIONS, 'patient_data': REQUISITION_PATIENT_FIELDS}
+    return [
+        Stage('patient_data', funcs['patient_data'], inputs=['transcription']),
+        Stage('soap_note', funcs['soap_note'], inputs=['transcription']),
+        Stage('clinical_data', funcs['clinical_data'], inputs=['soap_note'], reads={'soap_note': SOAP_SECTIONS}),
+        Stage('lab_requisition', funcs['lab_requisition'], inputs=['soap_note', 'patient_data'],
+              reads=requisition_reads),
+        Stage('pharmacy_requisition', funcs['pharmacy_requisition'], inputs=['soap_note', 'patient_data'],
+              reads=requisition_reads),
+    ]
+
+
+PIPELINE_MODES = ('multi', 'fused')
+CONSULTATION_OUTPUTS = ['patient_data', 'soap_note', 'clinical_data', 'lab_requisition', 'pharmacy_requisition']
+
+
+def _pick(fused: Dict[str, Any], key: str) -> Any:
+    return fused[key]
+
+
+def build_fused_stages(agent: Any = None, use_async: bool = False) -> List[Stage]:
+    """
+    Single-call variant of the consultation graph: one ``fused`` stage asks for
+    all five outputs at once, and each output stage just picks its part, so the
+    result has the same keys as the five-agent graph.
+    """
+    from fused_pipeline_agent import FusedPipelineAgent
+
+    agent = agent or FusedPipelineAgent()
+    stages = [Stage('fused', agent.aprocess if use_async else agent.process, inputs=['transcription'])]
+    for name in CONSULTATION_OUTPUTS:
+        stages.append(Stage(name, functools.partial(_pick, key=name), inputs=['fused']))
+    return stages
+
+
+def pipeline_mode() -> str:
+    """The deployment's pipeline mode, from MEDFLOW_PIPELINE_MODE (multi or fused)"""
+    mode = os.getenv('MEDFLOW_PIPELINE_MODE', 'multi').strip().lower()
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown MEDFLOW_PIPELINE_MODE '{mode}', expected one of {', '.join(PIPELINE_MODES)}")
+    return mode
+
+
+def build_pipeline_stages(mode: str = None, use_async: bool = False) -> List[Stage]:
+    if (mode or pipeline_mode()) == 'fused':
+        return build_fused_stages(use_async=use_async)
+    return build_consultation_stages(use_async=use_async)
+
+
+# Shared by every request in the process
+pipeline_executor = PipelineExecutor()
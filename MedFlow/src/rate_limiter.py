@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+from data_dir import data_path
+from metrics import metrics
+
+# Rough tokens per character of English text for the prompt estimate
+CHARS_PER_TOKEN = 4
+# Framing tokens OpenAI adds around every chat message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class AdmissionTimeout(Exception):
+    """The request would have to wait longer than the caller can afford"""
+
+
+def estimate_tokens(request: Dict[str, Any]) -> int:
+    """
+    Tokens a chat completion counts against the TPM limit: the rendered prompt
+    plus ``max_tokens``, which OpenAI reserves up front whatever the answer's length.
+    """
+    prompt = 0
+    for message in request.get('messages', []):
+        content = message.get('content') or ''
+        if isinstance(content, list):
+            content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+        prompt += len(content) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+    return prompt + (request.get('max_tokens') or request.get('max_completion_tokens') or 0)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets per model, shared by
+    every worker process through a single SQLite file.
+
+    Each budget is a token bucket refilled continuously at limit / 60 per
+    second. A caller takes its cost from the bucket even when that drives it
+    below zero, then sleeps until the refill has covered the debt. Because the
+    debt grows with every caller, callers are admitted in arrival order and
+    sustained throughput settles at the configured rate instead of bursting
+    into 429s.
+
+    Configuration from the environment (no limits configured: no limiting):
+        MEDFLOW_OPENAI_RPM                 requests per minute for every chat model
+        MEDFLOW_OPENAI_TPM                 tokens per minute for every chat model
+        MEDFLOW_WHISPER_RPM                requests per minute for transcription
+        MEDFLOW_OPENAI_LIMITS              per-model JSON, e.g. '{"gpt-4o": {"rpm": 500, "tpm": 30000}}'
+        MEDFLOW_RATE_LIMIT_HEADROOM        fraction of each limit to use (default 0.95)
+        MEDFLOW_RATE_LIMIT_BURST_SECONDS   seconds of budget that may be spent at once (default 6)
+        MEDFLOW_RATE_LIMIT_PATH            SQLite file (default $MEDFLOW_DATA_DIR/rate_limits.sqlite3)
+    """
+
+    def __init__(self, limits: Dict[str, Dict[str, float]] = None, default_limits: Dict[str, float] = None,
+                 transcription_limits: Dict[str, float] = None, path: str = None,
+                 headroom: float = None, burst_seconds: float = None):
+        if limits is None:
+            limits = json.loads(os.getenv('MEDFLOW_OPENAI_LIMITS') or '{}')
+        if default_limits is None:
+            default_limits = {
+                'rpm': float(os.getenv('MEDFLOW_OPENAI_RPM', '0')),
+                'tpm': float(os.getenv('MEDFLOW_OPENAI_TPM', '0')),
+            }
+        if transcription_limits is None:
+            transcription_limits = {'rpm': float(os.getenv('MEDFLOW_WHISPER_RPM', '0'))}
+        if path is None:
+            path = os.getenv('MEDFLOW_RATE_LIMIT_PATH') or data_path('rate_limits.sqlite3')
+        if headroom is None:
+            headroom = float(os.getenv('MEDFLOW_RATE_LIMIT_HEADROOM', '0.95'))
+        if burst_seconds is None:
+            burst_seconds = float(os.getenv('MEDFLOW_RATE_LIMIT_BURST_SECONDS', '6'))
+
+        self.limits = limits
+        self.default_limits = default_limits
+        self.transcription_limits = transcription_limits
+        self.path = Path(path)
+        self.headroom = headroom
+        self.burst_seconds = burst_seconds
+        self._local = threading.local()
+
+    def limits_for(self, model: str, transcription: bool = False) -> Dict[str, float]:
+        configured = self.limits.get(model)
+        if configured is None:
+            configured = self.transcription_limits if transcription else self.default_limits
+        return {kind: float(value) for kind, value in configured.items() if value}
+
+    @property
+    def enabled(self) -> bool:
+        configured = [self.default_limits, self.transcription_limits, *self.limits.values()]
+        return any(value for limits in configured for value in limits.values())
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, and never one inherited across fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    level REAL NOT NULL,
+                    rate REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _reserve(self, model: str, costs: Dict[str, float], limits: Dict[str, float], max_wait: float = None) -> float:
+        """Take ``costs`` from the model's buckets and return how long the caller must wait"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            wait = 0.0
+            levels = {}
+            for kind, cost in costs.items():
+                rate = limits[kind] * self.headroom / 60
+                capacity = rate * self.burst_seconds
+                row = conn.execute('SELECT level, updated_at FROM buckets WHERE key = ?', (f'{model}:{kind}',)).fetchone()
+                level = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                levels[kind] = (level - cost, rate)
+                if level - cost < 0:
+                    wait = max(wait, (cost - level) / rate)
+
+            if max_wait is not None and wait > max_wait:
+                # Leave the buckets as they were; the caller gives up instead of queueing
+                conn.execute('ROLLBACK')
+                return wait
+
+            for kind, (level, rate) in levels.items():
+                conn.execute(
+                    'INSERT OR REPLACE INTO buckets (key, level, rate, updated_at) VALUES (?, ?, ?, ?)',
+                    (f'{model}:{kind}', level, rate, now)
+                )
+            conn.execute('COMMIT')
+            return wait
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+    def _admit(self, model: str, requests: int, tokens: int, transcription: bool, max_wait: Optional[float]) -> float:
+        limits = self.limits_for(model, transcription)
+        costs = {kind: cost for kind, cost in (('rpm', requests), ('tpm', tokens)) if cost and kind in limits}
+        if not costs:
+            return 0.0
+        try:
+            wait = self._reserve(model, costs, limits, max_wait)
+        except sqlite3.Error as e:
+            # A broken limiter must not stop the clinic; OpenAI still enforces the real limit
+            print(f"⚠️  Rate limiter unavailable: {str(e)}")
+            return 0.0
+        if max_wait is not None and wait > max_wait:
+            raise AdmissionTimeout(f"{model} needs {wait:.1f}s of rate limit budget, only {max_wait:.1f}s left")
+        metrics.observe('medflow_rate_limit_wait_seconds', wait, model=model)
+        if wait > 5:
+            print(f"⚠️  {model}: rate limit budget spent, queued for {wait:.1f}s")
+        return wait
+
+    def acquire(self, request: Dict[str, Any], max_wait: float = None) -> float:
+        """Block until a chat completion fits the budgets of its model; returns the seconds waited"""
+        wait = self._admit(request.get('model', ''), 1, estimate_tokens(request), False, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, request: Dict[str, Any], max_wait: float = None) -> float:
+        # SQLite may wait on another worker's write lock, so keep it off the event loop
+        wait = await asyncio.to_thread(
+            self._admit, request.get('model', ''), 1, estimate_tokens(request), False, max_wait
+        )
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def acquire_transcription(self, model: str, max_wait: float = None) -> float:
+        wait = self._admit(model, 1, 0, True, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire_transcription(self, model: str, max_wait: float = None) -> float:
+        wait = await asyncio.to_thread(self._admit, model, 1, 0, True, max_wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {'enabled': False}
+        conn = self._connection()
+        now = time.time()
+        buckets = {}
+        for key, level, rate, updated_at in conn.execute('SELECT key, level, rate, updated_at FROM buckets ORDER BY key'):
+            current = min(rate * self.burst_seconds, level + (now - updated_at) * rate)
+            buckets[key] = {
+                'per_minute': round(rate * 60, 1),
+                'available': round(current, 1),
+                # How long a caller arriving now would be queued
+                'queued_seconds': round(max(0.0, -current / rate), 2),
+            }
+        return {
+            'enabled': True,
+            'headroom': self.headroom,
+            'burst_seconds': self.burst_seconds,
+            'buckets': buckets,
+        }
+
+
+# Singleton instance
+rate_limiter = RateLimiter()
@@ -1,8 +1,76 @@
 import os
-from typing import Dict
-from openai import OpenAI
+from typing import Dict, Any, Iterator, List
+from openai import AsyncOpenAI
+from llm_client import get_client, get_async_client, chat_completion, achat_completion, stream_chat_completion
 from prompt_loader import PromptLoader
 
+SOAP_SECTIONS = ['SUBJECTIVE', 'OBJECTIVE', 'ASSESSMENT', 'PLAN']
+
+
+class SOAPSectionParser:
+    """
+    Incremental version of SOAPNoteGenerator._parse_response.
+
+    Feed it text as it streams in; every complete line is classified with the
+    same rules as the batch parser, and section events are returned as soon as
+    a header or a line of section text is available:
+
+        {"event": "section_start", "section": "subjective"}
+        {"event": "section_text", "section": "subjective", "text": "..."}
+        {"event": "section_end", "section": "subjective", "content": "..."}
+
+    After close(), ``sections`` equals what _parse_response returns for the
+    whole text.
+    """
+    
+    def __init__(self):
+        self.sections = {}
+        self._buffer = ''
+        self._current_section = None
+        self._current_content = []
+    
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        events = []
+        self._buffer += text
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            events.extend(self._handle_line(line))
+        return events
+    
+    def close(self) -> List[Dict[str, Any]]:
+        events = []
+        if self._buffer:
+            events.extend(self._handle_line(self._buffer))
+            self._buffer = ''
+        events.extend(self._end_section())
+        return events
+    
+    def _handle_line(self, line: str) -> List[Dict[str, Any]]:
+        line = line.strip()
+        if line.endswith(':') and line[:-1].upper() in SOAP_SECTIONS:
+            events = self._end_section()
+            self._current_section = line[:-1].lower()
+            self._current_content = []
+            events.append({"event": "section_start", "section": self._current_section})
+            return events
+        
+        if self._current_section:
+            self._current_content.append(line)
+            if line:
+                return [{"event": "section_text", "section": self._current_section, "text": line}]
+        return []
+    
+    def _end_section(self) -> List[Dict[str, Any]]:
+        if not self._current_section:
+            return []
+        content = '\n'.join(self._current_content).strip()
+        self.sections[self._current_section] = content
+        event = {"event": "section_end", "section": self._current_section, "content": content}
+        self._current_section = None
+        self._current_content = []
+        return [event]
+
+
 class SOAPNoteGenerator:
     
     def __init__(self, api_key: str = None, prompts_file: str = None):
@@ -10,54 +78,78 @@ class SOAPNoteGenerator:
         if not self.api_key:
             raise ValueError("OpenAI API key required")
         
-        self.client = OpenAI(api_key=self.api_key)
+        self.client = get_client(self.api_key)
         self.prompt_loader = PromptLoader(prompts_file)
         self.config = self.prompt_loader.get_config('soap_note')
     
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        # Async clients are bound to the running event loop
+        return get_async_client(self.api_key)
+    
     def generate_soap_note(self, transcription: str) -> Dict[str, str]:
-        if not transcription or len(transcription.strip()) < 10:
-            raise ValueError("Transcription too short")
+        request = self._build_request(transcription)
         
         try:
-            user_message = self.config['user_message_template'].format(
-                transcription=transcription
-            )
-            
-            response = self.client.chat.completions.create(
-                model=self.config['model'],
-                messages=[
-                    {"role": "system", "content": self.config['system_prompt']},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=self.config['temperature'],
-                max_tokens=self.config['max_tokens']
-            )
+            content = chat_completion(self.client, 'soap_note', request)
+            return self._parse_response(content)
             
-            content = response.choices[0].message.content
+        except Exception as e:
+            raise Exception(f"Error generating SOAP note: {str(e)}")
+    
+    async def agenerate_soap_note(self, transcription: str) -> Dict[str, str]:
+        request = self._build_request(transcription)
+        
+        try:
+            content = await achat_completion(self.async_client, 'soap_note', request)
             return self._parse_response(content)
             
         except Exception as e:
             raise Exception(f"Error generating SOAP note: {str(e)}")
     
-    def _parse_response(self, response: str) -> Dict[str, str]:
-        sections = {}
-        current_section = None
-        current_content = []
+    def stream_soap_note(self, transcription: str) -> Iterator[Dict[str, Any]]:
+        """
+        Generate the SOAP note with token streaming. Yields ``token`` events
+        with raw text, the SOAPSectionParser section events as they become
+        available, and finally a ``soap_note`` event with the parsed note.
+        """
+        request = self._build_request(transcription)
+        parser = SOAPSectionParser()
         
-        for line in response.split('\n'):
-            line = line.strip()
-            if line.endswith(':') and line[:-1].upper() in ['SUBJECTIVE', 'OBJECTIVE', 'ASSESSMENT', 'PLAN']:
-                if current_section:
-                    sections[current_section] = '\n'.join(current_content).strip()
-                current_section = line[:-1].lower()
-                current_content = []
-            elif current_section:
-                current_content.append(line)
+        try:
+            for text in stream_chat_completion(self.client, 'soap_note', request):
+                yield {"event": "token", "text": text}
+                yield from parser.feed(text)
+            yield from parser.close()
+            
+        except Exception as e:
+            raise Exception(f"Error generating SOAP note: {str(e)}")
+        
+        yield {"event": "soap_note", "soap_note": parser.sections}
+    
+    def _build_request(self, transcription: str) -> Dict[str, Any]:
+        if not transcription or len(transcription.strip()) < 10:
+            raise ValueError("Transcription too short")
         
-        if current_section:
-            sections[current_section] = '\n'.join(current_content).strip()
+        user_message = self.config['user_message_template'].format(
+            transcription=transcription
+        )
         
-        return sections
+        return {
+            "model": self.config['model'],
+            "messages": [
+                {"role": "system", "content": self.config['system_prompt']},
+                {"role": "user", "content": user_message}
+            ],
+            "temperature": self.config['temperature'],
+            "max_tokens": self.config['max_tokens']
+        }
+    
+    def _parse_response(self, response: str) -> Dict[str, str]:
+        parser = SOAPSectionParser()
+        parser.feed(response)
+        parser.close()
+        return parser.sections
     
     def format_soap_note(self, soap_dict: Dict[str, str]) -> str:
         template = self.prompt_loader.get_prompt('templates', 'soap_note_output')
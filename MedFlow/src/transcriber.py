@@ -0,0 +1,333 @@
+import io
+import os
+import re
+import time
+import wave
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+from llm_client import get_client, get_async_client, transcription_timeout
+from metrics import metrics
+from rate_limiter import rate_limiter
+
+
+WHISPER_MODEL = "whisper-1"
+
+
+class AudioSegment:
+    """A slice of the recording, in samples. ``overlap`` is set when the cut before it was forced."""
+
+    def __init__(self, index: int, start: int, end: int, overlap: bool = False):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.overlap = overlap
+
+    def __repr__(self):
+        return f"AudioSegment({self.index}, {self.start}:{self.end}, overlap={self.overlap})"
+
+
+def read_pcm_wav(path) -> Tuple[np.ndarray, int]:
+    """Read a PCM WAV file as mono int16 samples and its sample rate"""
+    with wave.open(str(path), 'rb') as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        rate = wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+
+    if width == 1:
+        # 8-bit WAV is unsigned
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.int16) - 128) << 8
+    elif width == 2:
+        samples = np.frombuffer(raw, dtype='<i2')
+    elif width == 3:
+        # Keep the two most significant bytes of each little-endian 24-bit sample
+        samples = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)[:, 1:].copy().view('<i2').ravel()
+    elif width == 4:
+        samples = (np.frombuffer(raw, dtype='<i4') >> 16).astype(np.int16)
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {width} bytes")
+
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+        samples = samples.mean(axis=1, dtype=np.float32).astype(np.int16)
+    return samples, rate
+
+
+def encode_wav(samples: np.ndarray, rate: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(samples.astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def frame_energy(samples: np.ndarray, frame_length: int) -> np.ndarray:
+    """RMS energy of consecutive non-overlapping frames"""
+    frames = len(samples) // frame_length
+    if frames == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    energy = np.empty(frames, dtype=np.float32)
+    # Work through the recording in blocks so a long file is never copied to float in one go
+    block = 4096
+    for start in range(0, frames, block):
+        stop = min(start + block, frames)
+        chunk = samples[start * frame_length:stop * frame_length].astype(np.float32)
+        chunk = chunk.reshape(stop - start, frame_length)
+        energy[start:stop] = np.sqrt(np.mean(chunk * chunk, axis=1))
+    return energy
+
+
+def find_segments(
+    samples: np.ndarray,
+    rate: int,
+    segment_seconds: float,
+    search_seconds: float,
+    overlap_seconds: float,
+    frame_seconds: float = 0.02,
+    min_silence_seconds: float = 0.3
+) -> List[AudioSegment]:
+    """
+    Split a recording into segments of roughly ``segment_seconds``.
+
+    Each boundary is placed at the quietest ``min_silence_seconds`` stretch
+    within ``search_seconds`` of the target length. When even that stretch is
+    not silent (someone talked straight through), the cut is forced there and
+    the following segment starts ``overlap_seconds`` early so no word is lost.
+    """
+    frame_length = max(1, int(rate * frame_seconds))
+    energy = frame_energy(samples, frame_length)
+    total_frames = len(energy)
+
+    segment_frames = max(1, int(segment_seconds / frame_seconds))
+    search_frames = int(search_seconds / frame_seconds)
+    overlap_samples = int(overlap_seconds * rate)
+
+    if total_frames <= segment_frames + search_frames:
+        return [AudioSegment(0, 0, len(samples))]
+
+    # Mean energy of every min_silence window, via a cumulative sum
+    window = max(1, int(min_silence_seconds / frame_seconds))
+    cumulative = np.concatenate(([0.0], np.cumsum(energy, dtype=np.float64)))
+    smoothed = (cumulative[window:] - cumulative[:-window]) / window
+
+    # Silence is relative to the recording's own noise floor, but never above
+    # a quarter of typical speech level for recordings with few pauses
+    noise_floor = float(np.percentile(energy, 5))
+    threshold = max(min(noise_floor * 2.0, float(np.median(energy)) * 0.25), 100.0)
+
+    cuts = []
+    last = 0
+    while total_frames - last > segment_frames + search_frames:
+        target = last + segment_frames
+        low = max(last + 1, target - search_frames)
+        high = min(len(smoothed), target + search_frames)
+        quietest = low + int(np.argmin(smoothed[low:high]))
+        cut_frame = quietest + window // 2
+        cuts.append((cut_frame * frame_length, bool(smoothed[quietest] > threshold)))
+        last = cut_frame
+
+    segments = []
+    start, overlap = 0, False
+    for cut, forced in cuts:
+        segments.append(AudioSegment(len(segments), max(0, start - (overlap_samples if overlap else 0)), cut, overlap))
+        start, overlap = cut, forced
+    segments.append(AudioSegment(len(segments), max(0, start - (overlap_samples if overlap else 0)), len(samples), overlap))
+    return segments
+
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r'[^\w]', '', word.lower())
+
+
+def stitch_transcripts(texts: List[str], overlaps: List[bool], max_words: int = 25) -> str:
+    """
+    Join segment transcripts in order. Where a segment started early to
+    overlap the previous one, the words both transcripts share are kept once.
+    """
+    words: List[str] = []
+    for text, overlap in zip(texts, overlaps):
+        incoming = text.split()
+        if overlap and words and incoming:
+            tail_start = max(0, len(words) - max_words)
+            tail = [_normalize_word(w) for w in words[tail_start:]]
+            head = [_normalize_word(w) for w in incoming[:max_words]]
+
+            # Longest run of words shared by the end of one and the start of the other;
+            # edge words are often garbled, so the run need not touch either edge
+            best_length, best_i, best_j = 0, 0, 0
+            for i in range(len(tail)):
+                for j in range(len(head)):
+                    length = 0
+                    while (i + length < len(tail) and j + length < len(head)
+                           and tail[i + length] and tail[i + length] == head[j + length]):
+                        length += 1
+                    if length > best_length:
+                        best_length, best_i, best_j = length, i, j
+
+            if best_length >= 2:
+                words = words[:tail_start + best_i + best_length]
+                incoming = incoming[best_j + best_length:]
+        words.extend(incoming)
+    return ' '.join(words)
+
+
+class SegmentedTranscriber:
+    """
+    Transcribes recordings with Whisper, splitting long PCM WAV files at
+    silences and sending the segments concurrently, so wall-clock time
+    follows the segment length instead of the recording length. Other
+    formats, and recordings shorter than one segment, go up in a single call.
+
+    Configuration from the environment:
+        MEDFLOW_TRANSCRIBE_SEGMENT_SECONDS   target segment length (default 120)
+        MEDFLOW_TRANSCRIBE_SEARCH_SECONDS    how far from the target to look for silence (default 15)
+        MEDFLOW_TRANSCRIBE_OVERLAP_SECONDS   overlap added when no silence is found (default 1.5)
+        MEDFLOW_TRANSCRIBE_WORKERS           concurrent Whisper calls per recording (default 4)
+    """
+
+    def __init__(
+        self,
+        segment_seconds: float = None,
+        search_seconds: float = None,
+        overlap_seconds: float = None,
+        max_workers: int = None
+    ):
+        self.segment_seconds = segment_seconds or float(os.getenv('MEDFLOW_TRANSCRIBE_SEGMENT_SECONDS', '120'))
+        self.search_seconds = search_seconds or float(os.getenv('MEDFLOW_TRANSCRIBE_SEARCH_SECONDS', '15'))
+        self.overlap_seconds = overlap_seconds or float(os.getenv('MEDFLOW_TRANSCRIBE_OVERLAP_SECONDS', '1.5'))
+        self.max_workers = max_workers or int(os.getenv('MEDFLOW_TRANSCRIBE_WORKERS', '4'))
+
+    def _plan(self, audio_path: Path, extension: str):
+        """Return (samples, rate, segments) for a segmentable recording, else None"""
+        if extension.lower() != 'wav':
+            return None
+        try:
+            samples, rate = read_pcm_wav(audio_path)
+        except (wave.Error, ValueError, EOFError) as e:
+            # Compressed or float WAV, let Whisper decode it as a whole
+            print(f"  - Not segmenting ({str(e)})")
+            return None
+
+        segments = find_segments(
+            samples, rate,
+            segment_seconds=self.segment_seconds,
+            search_seconds=self.search_seconds,
+            overlap_seconds=self.overlap_seconds
+        )
+        if len(segments) < 2:
+            return None
+
+        forced = sum(1 for s in segments if s.overlap)
+        print(f"  - Split {len(samples) / rate:.0f}s recording into {len(segments)} segments ({forced} forced cuts)")
+        return samples, rate, segments
+
+    def transcribe(self, audio_path: Path, audio_filename: str, extension: str, prompt: str = None) -> Dict[str, Any]:
+        """
+        ``prompt`` is passed to Whisper as preceding context, e.g. the end of the
+        transcript so far when the recording arrives in pieces.
+        """
+        start_time = time.time()
+        plan = self._plan(audio_path, extension)
+
+        if plan is None:
+            with open(audio_path, 'rb') as audio_data:
+                print("  - Sending to OpenAI Whisper API...")
+                # Pass the file with a tuple (filename, file_object) for proper format detection
+                rate_limiter.acquire_transcription(WHISPER_MODEL)
+                with metrics.span('whisper'):
+                    transcription = get_client().audio.transcriptions.create(
+                        model=WHISPER_MODEL,
+                        timeout=transcription_timeout(),
+                        file=(audio_filename, audio_data, f'audio/{extension}'),
+                        **self._prompt_options(prompt)
+                    )
+            return self._result(transcription.text, 1, start_time)
+
+        samples, rate, segments = plan
+        client = get_client()
+
+        def transcribe_segment(segment: AudioSegment) -> str:
+            audio_bytes = encode_wav(samples[segment.start:segment.end], rate)
+            rate_limiter.acquire_transcription(WHISPER_MODEL)
+            with metrics.span('whisper'):
+                response = client.audio.transcriptions.create(
+                    model=WHISPER_MODEL,
+                    timeout=transcription_timeout(),
+                    file=(f"{Path(audio_filename).stem}_part{segment.index:03d}.wav", audio_bytes, 'audio/wav'),
+                    # Later segments start mid-conversation and get no context
+                    **self._prompt_options(prompt if segment.index == 0 else None)
+                )
+            return response.text
+
+        print(f"  - Sending {len(segments)} segments to OpenAI Whisper API...")
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='medflow-transcribe') as pool:
+            texts = list(pool.map(transcribe_segment, segments))
+
+        text = stitch_transcripts(texts, [s.overlap for s in segments])
+        return self._result(text, len(segments), start_time)
+
+    async def atranscribe(self, audio_path: Path, audio_filename: str, extension: str, prompt: str = None) -> Dict[str, Any]:
+        """Async counterpart of ``transcribe``, with the same ``prompt``"""
+        start_time = time.time()
+        plan = await asyncio.to_thread(self._plan, audio_path, extension)
+        client = get_async_client()
+
+        if plan is None:
+            audio_bytes = await asyncio.to_thread(Path(audio_path).read_bytes)
+            print("  - Sending to OpenAI Whisper API...")
+            await rate_limiter.aacquire_transcription(WHISPER_MODEL)
+            with metrics.span('whisper'):
+                transcription = await client.audio.transcriptions.create(
+                    model=WHISPER_MODEL,
+                    timeout=transcription_timeout(),
+                    file=(audio_filename, audio_bytes, f'audio/{extension}'),
+                    **self._prompt_options(prompt)
+                )
+            return self._result(transcription.text, 1, start_time)
+
+        samples, rate, segments = plan
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def transcribe_segment(segment: AudioSegment) -> str:
+            async with semaphore:
+                audio_bytes = await asyncio.to_thread(encode_wav, samples[segment.start:segment.end], rate)
+                await rate_limiter.aacquire_transcription(WHISPER_MODEL)
+                with metrics.span('whisper'):
+                    response = await client.audio.transcriptions.create(
+                        model=WHISPER_MODEL,
+                        timeout=transcription_timeout(),
+                        file=(f"{Path(audio_filename).stem}_part{segment.index:03d}.wav", audio_bytes, 'audio/wav'),
+                        # Later segments start mid-conversation and get no context
+                        **self._prompt_options(prompt if segment.index == 0 else None)
+                    )
+                return response.text
+
+        print(f"  - Sending {len(segments)} segments to OpenAI Whisper API...")
+        texts = await asyncio.gather(*(transcribe_segment(s) for s in segments))
+
+        text = stitch_transcripts(list(texts), [s.overlap for s in segments])
+        return self._result(text, len(segments), start_time)
+
+    def _prompt_options(self, prompt: str = None) -> Dict[str, Any]:
+        if not prompt:
+            return {}
+        # Whisper only considers the last 224 tokens of the prompt
+        return {'prompt': prompt[-800:]}
+
+    def _result(self, text: str, segments: int, start_time: float) -> Dict[str, Any]:
+        return {
+            'text': text,
+            'segments': segments,
+            'seconds': round(time.time() - start_time, 3),
+        }
+
+
+# Singleton instance
+transcriber = SegmentedTranscriber()
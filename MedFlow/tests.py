@@ -1,3 +1,774 @@
-from django.test import TestCase
+import json
+import time
+import asyncio
+import threading
+import multiprocessing
+import tempfile
+from datetime import date
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import httpx
+import numpy as np
+import openai
+from django.core.management import call_command
+from django.db import connections
+from django.test import SimpleTestCase
+
+import llm_client
+from llm_policy import LLMPolicies, DeadlineExceeded
+from rate_limiter import RateLimiter, AdmissionTimeout
+from pipeline import (
+    Stage, PipelineExecutor, PipelineError, CONSULTATION_OUTPUTS,
+    build_consultation_stages, changed_fields, stale_stages
+)
+from order_prefilter import OrderPrefilter
+from demographics_rules import demographics_rules
+from patient_agent import PatientDataExtractor
+from transcriber import find_segments, stitch_transcripts
+
+from .patient_storage import PatientStorage, HEADERS_FILE
+from .patient_db_storage import DatabasePatientStorage
+from .processing import run_consultation_pipeline, PipelineIncomplete
+
+PROCESSES = 8
+VISITS_PER_PROCESS = 25
+PATIENTS = ['Ada Lovelace', 'Alan Turing', 'Grace Hopper']
+
+try:
+    FORK = multiprocessing.get_context('fork')
+except ValueError:
+    FORK = None
+
+
+def _save_visits(storage_dir: str, worker: int, using: str = None):
+    # A storage of its own, like a separate server process
+    storage = DatabasePatientStorage(using) if using else PatientStorage(Path(storage_dir))
+    for i in range(VISITS_PER_PROCESS):
+        name = PATIENTS[(worker + i) % len(PATIENTS)]
+        visit_id = storage.save_patient_visit({
+            'patient_name': name,
+            'patient_mrn': f'MRN-{PATIENTS.index(name)}',
+            'worker': worker,
+            'visit_number': i,
+            'soap_note': {'assessment': f'Visit {i} from worker {worker}'},
+        })
+        # Edits race with the saves of the other processes
+        if i % 5 == 0:
+            storage.update_patient_visit(name, visit_id, {'edited_by': worker})
+
+
+@skipUnless(FORK, 'needs fork')
+class ConcurrentPatientStorageTest(SimpleTestCase):
+    """Many processes saving visits of the same patients into one patient_data directory"""
+
+    def test_concurrent_saves(self):
+        with tempfile.TemporaryDirectory() as storage_dir:
+            workers = [FORK.Process(target=_save_visits, args=(storage_dir, w)) for w in range(PROCESSES)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join(60)
+                self.assertEqual(worker.exitcode, 0)
+
+            storage = PatientStorage(Path(storage_dir))
+            saved = {name: 0 for name in PATIENTS}
+            for worker in range(PROCESSES):
+                for i in range(VISITS_PER_PROCESS):
+                    saved[PATIENTS[(worker + i) % len(PATIENTS)]] += 1
+
+            visit_ids = set()
+            for name in PATIENTS:
+                patient_dir = Path(storage_dir) / storage._sanitize_filename(name)
+                visit_files = sorted(patient_dir.glob('visit_*.json'))
+                # Every visit saved, under its own ID, and every file complete JSON
+                self.assertEqual(len(visit_files), saved[name])
+                visits = [json.loads(f.read_text()) for f in visit_files]
+                visit_ids.update(visit['visit_id'] for visit in visits)
+                for visit in visits:
+                    self.assertEqual('edited_by' in visit, visit['visit_number'] % 5 == 0)
+                self.assertEqual(list(patient_dir.glob('.*.tmp')), [])
+
+                summary = storage.get_patient_summary(name)
+                self.assertEqual(summary['visit_count'], saved[name])
+                self.assertEqual(summary['last_visit'], visits[-1]['timestamp'])
+
+                headers, _ = storage.list_patient_visits(name, headers=True)
+                self.assertEqual([h['visit_id'] for h in headers], [f.stem for f in reversed(visit_files)])
+                self.assertTrue((patient_dir / HEADERS_FILE).exists())
+
+            self.assertEqual(len(visit_ids), PROCESSES * VISITS_PER_PROCESS)
+            # The index holds the last summary written of every patient
+            self.assertEqual(
+                sorted(storage.get_all_patients(), key=lambda s: s['patient_name']),
+                sorted((storage.get_patient_summary(name) for name in PATIENTS), key=lambda s: s['patient_name'])
+            )
+
+
+@skipUnless(FORK, 'needs fork')
+class ConcurrentDatabasePatientStorageTest(SimpleTestCase):
+    """The same saves and edits, by many processes sharing one SQLite database"""
+
+    def test_concurrent_saves(self):
+        with tempfile.TemporaryDirectory() as storage_dir:
+            using = 'concurrent_saves'
+            connections.databases[using] = {
+                **connections.databases['default'],
+                'NAME': str(Path(storage_dir) / 'patients.sqlite3'),
+            }
+            try:
+                call_command('migrate', 'MedFlow', database=using, verbosity=0)
+                # Each process opens connections of its own
+                connections[using].close()
+                workers = [FORK.Process(target=_save_visits, args=(storage_dir, w, using)) for w in range(PROCESSES)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join(60)
+                    self.assertEqual(worker.exitcode, 0)
+
+                storage = DatabasePatientStorage(using)
+                saved = {name: 0 for name in PATIENTS}
+                for worker in range(PROCESSES):
+                    for i in range(VISITS_PER_PROCESS):
+                        saved[PATIENTS[(worker + i) % len(PATIENTS)]] += 1
+
+                visit_ids = set()
+                for name in PATIENTS:
+                    visits = storage.get_patient_visits(name)
+                    self.assertEqual(len(visits), saved[name])
+                    visit_ids.update(visit['visit_id'] for visit in visits)
+                    for visit in visits:
+                        self.assertEqual('edited_by' in visit, visit['visit_number'] % 5 == 0)
+
+                    # No save lost from the count, and the latest visit wins whatever order they committed in
+                    summary = storage.get_patient_summary(name)
+                    self.assertEqual(summary['visit_count'], saved[name])
+                    self.assertEqual(summary['last_visit'], max(visit['timestamp'] for visit in visits))
+
+                    headers, _ = storage.list_patient_visits(name, headers=True)
+                    self.assertEqual([h['visit_id'] for h in headers], [visit['visit_id'] for visit in visits])
+
+                self.assertEqual(len(visit_ids), PROCESSES * VISITS_PER_PROCESS)
+            finally:
+                connections[using].close()
+                del connections.databases[using]
+
+
+def _policies(**settings) -> LLMPolicies:
+    """Policies with ``settings`` for the 'test' category, and no waiting between retries"""
+    policies = LLMPolicies()
+    policies.overrides = {'test': {'retries': 0, 'backoff': 0, 'hedge': False, 'fallback_model': '', **settings}}
+    return policies
+
+
+def _response(name: str, tokens: int = 10):
+    return SimpleNamespace(
+        name=name,
+        choices=[SimpleNamespace(message=SimpleNamespace(content=name))],
+        usage=SimpleNamespace(prompt_tokens=tokens, completion_tokens=0),
+    )
+
+
+def _connection_error():
+    return openai.APIConnectionError(request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+
+
+class FakeChatClient:
+    """Stands in for OpenAI/AsyncOpenAI: the nth completion created sleeps ``delays[n]`` and answers 'attempt n'"""
+
+    def __init__(self, delays, asynchronous: bool = False):
+        self.delays = delays
+        self.asynchronous = asynchronous
+        self.requests = []
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._acreate if asynchronous else self._create))
+
+    def with_options(self, **options):
+        return self
+
+    def _next(self, request):
+        with self._lock:
+            self.requests.append(request)
+            n = len(self.requests) - 1
+        return n, self.delays[n]
+
+    def _create(self, **request):
+        n, delay = self._next(request)
+        time.sleep(delay)
+        return _response(f'attempt {n}', tokens=10 * (n + 1))
+
+    async def _acreate(self, **request):
+        n, delay = self._next(request)
+        await asyncio.sleep(delay)
+        return _response(f'attempt {n}', tokens=10 * (n + 1))
+
+
+class LLMPolicyTest(SimpleTestCase):
+    """Hedging, retries, fallback and deadlines of LLMPolicies, on fake clients"""
+
+    request = {'model': 'primary', 'messages': [{'role': 'user', 'content': 'hello'}]}
+
+    def _hedging(self) -> LLMPolicies:
+        # Hedged once an attempt runs longer than the one latency observed, 50 ms
+        policies = _policies(hedge=True, hedge_min_samples=1, deadline=5)
+        policies.latencies.add('test', 'primary', 0.05)
+        return policies
+
+    def _complete(self, policies, client):
+        """chat_completion under ``policies`` without the response cache; returns the content and the usage calls"""
+        with mock.patch.object(llm_client, 'llm_policies', policies), \
+                mock.patch.object(llm_client.llm_cache, 'get', return_value=None), \
+                mock.patch.object(llm_client.llm_cache, 'set'):
+            with llm_client.record_usage() as usage:
+                if client.asynchronous:
+                    async def complete():
+                        content = await llm_client.achat_completion(client, 'test', self.request)
+                        # The losing attempt reports its tokens once it finishes
+                        await asyncio.sleep(0.5)
+                        return content
+                    content = asyncio.run(complete())
+                else:
+                    content = llm_client.chat_completion(client, 'test', self.request)
+                    time.sleep(0.5)
+        return content, usage.calls
+
+    def test_hedge_wins(self):
+        for asynchronous in (False, True):
+            with self.subTest(asynchronous=asynchronous):
+                client = FakeChatClient([1.0, 0.0], asynchronous)
+                started = time.monotonic()
+                content, calls = self._complete(self._hedging(), client)
+                self.assertEqual(content, 'attempt 1')
+                self.assertLess(time.monotonic() - started, 1.0)
+                self.assertEqual(len(client.requests), 2)
+
+    def test_losing_hedge_tokens_reported(self):
+        for asynchronous in (False, True):
+            with self.subTest(asynchronous=asynchronous):
+                client = FakeChatClient([0.15, 0.3], asynchronous)
+                content, calls = self._complete(self._hedging(), client)
+                self.assertEqual(content, 'attempt 0')
+                self.assertEqual(sorted(call['prompt_tokens'] for call in calls), [10, 20])
+
+    def test_retry_then_fallback(self):
+        # The first attempt fails after eating into the deadline, so the retry is sent to the faster model
+        policies = _policies(deadline=1, retries=1, fallback_model='fast', fallback_remaining=0.8)
+        sent = []
+
+        def send(request, timeout):
+            sent.append(request['model'])
+            if len(sent) == 1:
+                time.sleep(0.3)
+                raise _connection_error()
+            return 'answer'
+
+        response, request = policies.call('test', self.request, send)
+        self.assertEqual(response, 'answer')
+        self.assertEqual(sent, ['primary', 'fast'])
+        self.assertEqual(request['model'], 'fast')
+
+    def test_retries_exhausted(self):
+        policies = _policies(deadline=5, retries=2)
+        sent = []
+
+        def send(request, timeout):
+            sent.append(request)
+            raise _connection_error()
+
+        with self.assertRaises(openai.APIConnectionError):
+            policies.call('test', self.request, send)
+        self.assertEqual(len(sent), 3)
+
+    def test_deadline_exceeded(self):
+        policies = _policies(deadline=0.2, retries=5)
+
+        def send(request, timeout):
+            # The SDK times out at the deadline it was given
+            time.sleep(timeout)
+            raise openai.APITimeoutError(request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            policies.call('test', self.request, send)
+        self.assertLess(time.monotonic() - started, 1.0)
+
+        async def asend(request, timeout):
+            # An attempt ignoring its timeout is still cut off at the deadline
+            await asyncio.sleep(5)
+
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            asyncio.run(policies.acall('test', self.request, asend))
+        self.assertLess(time.monotonic() - started, 1.0)
+
+
+REQUEST = {'model': 'gpt-test', 'messages': []}
+
+
+def _limiter(path: str) -> RateLimiter:
+    # 10 requests a second, two of which may be spent at once
+    return RateLimiter(limits={'gpt-test': {'rpm': 600}}, default_limits={}, transcription_limits={},
+                       path=path, headroom=1.0, burst_seconds=0.2)
+
+
+def _acquire_requests(path: str, count: int, admitted):
+    limiter = _limiter(path)
+    for _ in range(count):
+        limiter.acquire(REQUEST)
+        admitted.put(time.time())
+
+
+class RateLimiterTest(SimpleTestCase):
+    """The cross-process token bucket on a temporary SQLite file"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = str(Path(self.directory.name) / 'rate_limits.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_admits_burst_then_waits(self):
+        limiter = _limiter(self.path)
+        started = time.monotonic()
+        waits = [limiter.acquire(REQUEST) for _ in range(4)]
+        # The burst goes straight through, then each request waits for a tenth of a second of refill
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertAlmostEqual(waits[2], 0.1, delta=0.03)
+        self.assertAlmostEqual(waits[3], 0.1, delta=0.03)
+        self.assertAlmostEqual(time.monotonic() - started, 0.2, delta=0.08)
+
+    def test_timeout_when_wait_exceeds_deadline(self):
+        limiter = _limiter(self.path)
+        limiter.acquire(REQUEST)
+        limiter.acquire(REQUEST)
+        started = time.monotonic()
+        with self.assertRaises(AdmissionTimeout):
+            limiter.acquire(REQUEST, max_wait=0.05)
+        self.assertLess(time.monotonic() - started, 0.05)
+        # Giving up took nothing from the bucket: the next caller waits as long as the refused one would have
+        self.assertAlmostEqual(limiter.acquire(REQUEST), 0.1, delta=0.03)
+
+    def test_fails_open_when_database_unavailable(self):
+        # A directory cannot be opened as the SQLite file
+        limiter = _limiter(self.directory.name)
+        self.assertEqual([limiter.acquire(REQUEST) for _ in range(5)], [0.0] * 5)
+
+    def test_unlimited_model_not_counted(self):
+        limiter = _limiter(self.path)
+        self.assertEqual([limiter.acquire({'model': 'other', 'messages': []}) for _ in range(5)], [0.0] * 5)
+        self.assertFalse(Path(self.path).exists())
+
+    @skipUnless(FORK, 'needs fork')
+    def test_processes_share_bucket(self):
+        admitted = FORK.Queue()
+        started = time.time()
+        workers = [FORK.Process(target=_acquire_requests, args=(self.path, 5, admitted)) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        times = sorted(admitted.get(timeout=10) for _ in range(10))
+        for worker in workers:
+            worker.join(10)
+            self.assertEqual(worker.exitcode, 0)
+        # Ten requests at ten a second, after a burst of two; separate buckets would be done after 0.3s
+        self.assertGreater(times[-1] - started, 0.7)
+        self.assertLess(times[-1] - started, 1.5)
+
+
+class StubStage:
+    """Stage function that sleeps, records when it ran and returns its name (or raises)"""
+
+    def __init__(self, name: str, log: list, delay: float = 0.0, error: Exception = None):
+        self.name = name
+        self.log = log
+        self.delay = delay
+        self.error = error
+
+    def __call__(self, **inputs):
+        started = time.monotonic()
+        time.sleep(self.delay)
+        self.log.append((self.name, started, time.monotonic(), sorted(inputs)))
+        if self.error is not None:
+            raise self.error
+        return f'{self.name} output'
+
+
+def _diamond(log: list, **overrides) -> list:
+    # a feeds b and c, which both feed d
+    graph = {'a': ['transcription'], 'b': ['a'], 'c': ['a'], 'd': ['b', 'c']}
+    return [
+        Stage(name, overrides.get(name) or StubStage(name, log, delay=0.05), inputs=inputs)
+        for name, inputs in graph.items()
+    ]
+
+
+class PipelineExecutorTest(SimpleTestCase):
+    """Scheduling, partial results and resuming of the stage graph, with stub stages"""
+
+    def setUp(self):
+        self.executor = PipelineExecutor(max_workers=4)
+        self.log = []
+
+    def run_pipeline(self, stages, use_async=False, **kwargs):
+        if use_async:
+            return asyncio.run(self.executor.arun(stages, {'transcription': 'text'}, **kwargs))
+        return self.executor.run(stages, {'transcription': 'text'}, **kwargs)
+
+    def assert_dependency_order(self, stages):
+        runs = {name: (started, finished) for name, started, finished, _ in self.log}
+        for stage in stages:
+            for dep in stage.inputs:
+                if dep in runs:
+                    self.assertGreaterEqual(runs[stage.name][0], runs[dep][1], f'{stage.name} started before {dep}')
+        # Stages that only share an input run side by side
+        self.assertLess(runs['c'][0], runs['b'][1])
+
+    def test_dependency_order(self):
+        for use_async in (False, True):
+            with self.subTest(use_async=use_async):
+                self.log.clear()
+                notified = []
+                stages = _diamond(self.log)
+                result = self.run_pipeline(stages, use_async, on_stage_complete=lambda *args: notified.append(args))
+                self.assert_dependency_order(stages)
+                self.assertEqual(result.outputs, {name: f'{name} output' for name in 'abcd'})
+                self.assertEqual([name for name, _ in notified][0], 'a')
+                self.assertEqual(notified[-1], ('d', 'd output'))
+                self.assertEqual(next(inputs for name, _, _, inputs in self.log if name == 'd'), ['b', 'c'])
+
+    def test_failing_stage_keeps_partial_outputs(self):
+        for use_async in (False, True):
+            with self.subTest(use_async=use_async):
+                self.log.clear()
+                failure = RuntimeError('model unavailable')
+                stages = _diamond(self.log, b=StubStage('b', self.log, delay=0.01, error=failure),
+                                  c=StubStage('c', self.log, delay=0.1))
+                with self.assertRaises(PipelineError) as raised:
+                    self.run_pipeline(stages, use_async)
+                # c was in flight when b failed, so its work is kept; d never started
+                self.assertEqual(raised.exception.stage, 'b')
+                self.assertIs(raised.exception.error, failure)
+                self.assertEqual(raised.exception.outputs, {'a': 'a output', 'c': 'c output'})
+                self.assertNotIn('d', [name for name, *_ in self.log])
+
+    def test_resume_from_completed(self):
+        for use_async in (False, True):
+            with self.subTest(use_async=use_async):
+                self.log.clear()
+                result = self.run_pipeline(_diamond(self.log), use_async,
+                                           completed={'a': 'saved a', 'b': 'saved b'})
+                self.assertEqual(sorted(name for name, *_ in self.log), ['c', 'd'])
+                self.assertEqual(result.outputs, {'a': 'saved a', 'b': 'saved b', 'c': 'c output', 'd': 'd output'})
+
+    def test_unsatisfiable_inputs(self):
+        with self.assertRaises(ValueError):
+            self.run_pipeline([Stage('a', StubStage('a', self.log), inputs=['missing'])])
+        self.assertEqual(self.log, [])
+
+    def test_consultation_failure_is_pipeline_incomplete(self):
+        run = SimpleNamespace(run_id='run-1', status='running', mode='multi',
+                              transcription='text', audio_file='visit.wav')
+        stages = [
+            Stage('patient_data', StubStage('patient_data', self.log), inputs=['transcription']),
+            Stage('soap_note', StubStage('soap_note', self.log), inputs=['transcription']),
+            Stage('lab_requisition', StubStage('lab_requisition', self.log, error=RuntimeError('timeout')),
+                  inputs=['soap_note', 'patient_data']),
+        ]
+        with mock.patch('MedFlow.processing.pipeline_runs') as runs, \
+                mock.patch('MedFlow.processing.usage_ledger'), \
+                mock.patch('pipeline.build_pipeline_stages', return_value=stages), \
+                mock.patch('pipeline.pipeline_executor', self.executor):
+            runs.open.return_value = (run, {})
+            with self.assertRaises(PipelineIncomplete) as raised:
+                run_consultation_pipeline('text', 'visit.wav')
+        payload = raised.exception.payload
+        self.assertEqual(payload['run_id'], 'run-1')
+        self.assertEqual(payload['failed_stage'], 'lab_requisition')
+        self.assertEqual(payload['completed_stages'], ['patient_data', 'soap_note'])
+        self.assertEqual(payload['missing_stages'], ['lab_requisition'])
+        self.assertEqual(payload['patient_data'], 'patient_data output')
+        self.assertEqual(payload['soap_note'], 'soap_note output')
+        # The outputs are checkpointed so a retry with run_id skips them
+        self.assertEqual(runs.fail.call_args.args[3], {'patient_data': 'patient_data output',
+                                                       'soap_note': 'soap_note output'})
+
+
+class StaleStagesTest(SimpleTestCase):
+    """Which agents a visit edit makes stale, as recompute_visit relies on"""
+
+    stages = build_consultation_stages({name: mock.Mock() for name in CONSULTATION_OUTPUTS})
+
+    def test_each_edited_field(self):
+        cases = [
+            (['transcription'], [], CONSULTATION_OUTPUTS),
+            (['soap_note.subjective'], [], ['clinical_data']),
+            (['soap_note.objective'], [], ['clinical_data']),
+            (['soap_note.assessment'], [], ['clinical_data', 'lab_requisition', 'pharmacy_requisition']),
+            (['soap_note.plan'], [], ['clinical_data', 'lab_requisition', 'pharmacy_requisition']),
+            (['patient_data.personal_info'], [], ['lab_requisition', 'pharmacy_requisition']),
+            (['patient_data.insurance'], [], ['lab_requisition', 'pharmacy_requisition']),
+            (['patient_data.emergency_contact'], [], []),
+            (['clinical_data'], [], []),
+            (['lab_requisition'], [], []),
+            (['pharmacy_requisition'], [], []),
+            # Hand-edited outputs are kept, and stages downstream of them only follow their other inputs
+            (['soap_note.plan'], ['lab_requisition'], ['clinical_data', 'pharmacy_requisition']),
+            (['transcription'], ['soap_note'], ['patient_data', 'lab_requisition', 'pharmacy_requisition']),
+        ]
+        for changed, edited, expected in cases:
+            with self.subTest(changed=changed, edited=edited):
+                self.assertEqual(stale_stages(self.stages, changed, edited), expected)
+
+    def test_changed_fields(self):
+        visit = {'transcription': 'text', 'soap_note': {'plan': 'rest', 'assessment': 'flu'}, 'clinical_data': {}}
+        edit = {'soap_note': {'plan': 'amoxicillin 500 mg', 'assessment': 'flu'}, 'clinical_data': {}}
+        self.assertEqual(changed_fields(visit, edit, ['transcription'] + CONSULTATION_OUTPUTS), ['soap_note.plan'])
+        self.assertEqual(changed_fields(visit, {'transcription': 'new'}, ['transcription']), ['transcription'])
+
+
+def _plan(plan: str, assessment: str = 'Upper respiratory infection') -> dict:
+    return {'subjective': 'Cough for three days', 'objective': 'Afebrile', 'assessment': assessment, 'plan': plan}
+
+
+class OrderPrefilterTest(SimpleTestCase):
+    """The lexicon screen that decides whether the lab and pharmacy agents call the LLM"""
+
+    # (plan, lab orders expected, pharmacy orders expected)
+    PLANS = [
+        ('Rest, fluids and return if symptoms worsen.', False, False),
+        ('', False, False),
+        ('No labs needed. No medications at this time.', False, False),
+        ('Reassurance; follow up in two weeks.', False, False),
+        ('Amoxicillin 500 mg three times a day for 10 days.', False, True),
+        ('Increase lisinopril to 20 mg daily.', False, True),
+        ('Continue losartan as before.', False, True),
+        ('Albuterol 2 puffs q4h prn wheeze.', False, True),
+        ('Order CBC and CMP.', True, False),
+        ('Check TSH and hemoglobin A1c before next visit.', True, False),
+        ('Urinalysis with culture.', True, False),
+        ('Lipid panel; start atorvastatin 20 mg nightly.', True, True),
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_path = Path(self.directory.name) / 'misses.jsonl'
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def prefilter(self, mode: str = 'on', sample_rate: float = 0.0) -> OrderPrefilter:
+        return OrderPrefilter(mode=mode, sample_rate=sample_rate, log_path=str(self.log_path))
+
+    def test_plans(self):
+        prefilter = self.prefilter()
+        for plan, lab, pharmacy in self.PLANS:
+            for agent, has_orders in (('lab', lab), ('pharmacy', pharmacy)):
+                with self.subTest(plan=plan, agent=agent):
+                    screening = prefilter.screen(agent, _plan(plan))
+                    self.assertEqual(screening.has_orders, has_orders, screening.matches)
+                    self.assertEqual(screening.skip, not has_orders)
+
+    def test_orders_in_assessment_count(self):
+        screening = self.prefilter().screen('lab', _plan('Follow up.', assessment='Anemia; repeat ferritin'))
+        self.assertEqual(screening.matches, ['repeat', 'ferritin'])
+
+    def test_skipped_plan_answers_like_the_llm(self):
+        for agent in ('lab', 'pharmacy'):
+            screening = self.prefilter().screen(agent, _plan('Rest and fluids.'))
+            self.assertEqual(screening.no_orders_response()['request_type'], 'none')
+
+    def test_shadow_mode_always_calls(self):
+        prefilter = self.prefilter(mode='shadow')
+        for plan, lab, pharmacy in self.PLANS:
+            for agent, has_orders in (('lab', lab), ('pharmacy', pharmacy)):
+                with self.subTest(plan=plan, agent=agent):
+                    screening = prefilter.screen(agent, _plan(plan))
+                    self.assertFalse(screening.skip)
+                    self.assertEqual(screening.has_orders, has_orders)
+                    self.assertEqual(screening.sampled, not has_orders)
+
+    def test_shadow_mode_logs_misses(self):
+        prefilter = self.prefilter(mode='shadow')
+        screening = prefilter.screen('lab', _plan('Rest and fluids.'))
+        prefilter.review(screening, {'request_type': 'none'})
+        self.assertFalse(self.log_path.exists())
+        prefilter.review(screening, {'request_type': 'lab', 'test_details': [{'test_name': 'CBC'}]})
+        entry = json.loads(self.log_path.read_text())
+        self.assertEqual(entry['agent'], 'lab')
+        self.assertEqual(entry['llm_result'], [{'test_name': 'CBC'}])
+
+    def test_sampled_plans_still_call(self):
+        screening = self.prefilter(sample_rate=1.0).screen('pharmacy', _plan('Rest and fluids.'))
+        self.assertTrue(screening.sampled)
+        self.assertFalse(screening.skip)
+
+    def test_off_mode_never_skips(self):
+        screening = self.prefilter(mode='off').screen('lab', _plan('Rest and fluids.'))
+        self.assertFalse(screening.skip)
+        self.assertEqual(screening.matches, [])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.prefilter(mode='sometimes')
+
+
+INTAKE = (
+    "Doctor: Good morning. What is your full name? Patient: Maria Lopez. "
+    "Doctor: And your date of birth? Patient: April 8th, 1985. "
+    "Doctor: Any allergies? Patient: Penicillin and sulfa. "
+    "Doctor: What medications are you taking? Patient: Lisinopril 10 mg daily. "
+    "Doctor: Best phone number to reach you? Patient: 555-123-4567."
+)
+AGE_ONLY = (
+    "Doctor: Hi, can I get your name? Patient: John Smith. "
+    "Doctor: How old are you? Patient: I'm 62. "
+    "Doctor: Any allergies? Patient: No. "
+    "Doctor: Are you taking any medications? Patient: Not that I know of."
+)
+UNREADABLE_BIRTH = (
+    "Doctor: Your name please? Patient: John Smith. "
+    "Doctor: How old are you? Patient: I'm 62. "
+    "Doctor: And your date of birth? Patient: Sometime in the spring, I never remember."
+)
+
+
+def _years_since(day: str) -> int:
+    born, today = date.fromisoformat(day), date.today()
+    return today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+
+
+class DemographicsRulesTest(SimpleTestCase):
+    """The pattern extractor that lets the patient agent skip or shorten its LLM call"""
+
+    def test_fields(self):
+        # (transcription, fields expected from the rules, fields left for the LLM)
+        cases = [
+            (INTAKE, {
+                'full_name': 'Maria Lopez', 'date_of_birth': '1985-04-08', 'phone': '555-123-4567',
+                'allergies': ['Penicillin', 'sulfa'], 'current_medications': ['Lisinopril 10 mg daily'],
+                'age': _years_since('1985-04-08'),
+            }, []),
+            ("Doctor: Hello. Patient: Hi, my name is Ana Ruiz and I have a cough. "
+             "Doctor: Any allergies? Patient: Sulfa drugs, I believe.", {'full_name': 'Ana Ruiz'}, ['allergies']),
+            ("Doctor: Hello. Patient: My name is Ana Ruiz. Doctor: Your MRN? Patient: MRN 12345. "
+             "Doctor: What brings you in? Patient: I live at 12 Oak Street and the stairs hurt my knee.",
+             {'full_name': 'Ana Ruiz', 'patient_id': '12345'}, ['address']),
+            ("Doctor: Hello there. Patient: I have had a cough for three days.", {}, ['full_name']),
+        ]
+        for transcription, expected, unresolved in cases:
+            with self.subTest(transcription=transcription[:40]):
+                found, missing = demographics_rules.extract(transcription)
+                self.assertEqual(found, expected)
+                self.assertEqual(missing, unresolved)
+
+    def test_stated_age_and_gender(self):
+        found, unresolved = demographics_rules.extract(
+            "Doctor: This is a 45-year-old woman, my name is Dr. Lee. Patient: My name is Ana Ruiz."
+        )
+        self.assertEqual(unresolved, [])
+        self.assertEqual((found['full_name'], found['age'], found['gender']), ('Ana Ruiz', 45, 'female'))
+        self.assertEqual(_years_since(found['date_of_birth']), 45)
+
+    def test_birth_date_approximated_from_age(self):
+        found, unresolved = demographics_rules.extract(AGE_ONLY)
+        self.assertEqual(unresolved, [])
+        self.assertEqual(found['age'], 62)
+        self.assertEqual(_years_since(found['date_of_birth']), 62)
+        self.assertEqual(found['allergies'], [])
+        self.assertEqual(found['current_medications'], [])
+
+    def test_unreadable_birth_date_left_to_llm(self):
+        found, unresolved = demographics_rules.extract(UNREADABLE_BIRTH)
+        self.assertEqual(found, {'full_name': 'John Smith', 'age': 62})
+        self.assertEqual(unresolved, ['date_of_birth'])
+
+
+class PatientDataExtractorTest(SimpleTestCase):
+    """When the patient agent calls the LLM, and how the answer is merged with the rules"""
+
+    def extract(self, transcription: str, answer: dict = None):
+        extractor = PatientDataExtractor(api_key='sk-test', use_rules=True)
+        with mock.patch('patient_agent.chat_completion', return_value=json.dumps(answer or {})) as completion:
+            return extractor.extract_patient_data(transcription), completion
+
+    def test_age_only_needs_no_call(self):
+        data, completion = self.extract(AGE_ONLY)
+        completion.assert_not_called()
+        self.assertEqual(data['personal_info']['age'], 62)
+        self.assertEqual(_years_since(data['personal_info']['date_of_birth']), 62)
+
+    def test_unreadable_birth_date_asks_llm(self):
+        data, completion = self.extract(UNREADABLE_BIRTH, {'date_of_birth': '1964-04-01', 'age': 99})
+        self.assertEqual(completion.call_args.args[1], 'patient_data_fields')
+        self.assertEqual(data['personal_info'], {'full_name': 'John Smith', 'age': 62, 'date_of_birth': '1964-04-01'})
+
+
+RATE = 8000
+
+
+def _speech(seconds: float, seed: int = 0) -> np.ndarray:
+    # Steady noise at conversational level stands in for talking
+    return np.random.default_rng(seed).integers(-3000, 3000, int(seconds * RATE)).astype(np.int16)
+
+
+def _silence(seconds: float) -> np.ndarray:
+    return np.zeros(int(seconds * RATE), dtype=np.int16)
+
+
+class SegmentationTest(SimpleTestCase):
+    """Where long recordings are cut, and how the segment transcripts are joined again"""
+
+    def segments(self, samples: np.ndarray):
+        return find_segments(samples, RATE, segment_seconds=10, search_seconds=2, overlap_seconds=1)
+
+    def test_short_recording_is_one_segment(self):
+        segments = self.segments(_speech(11))
+        self.assertEqual([(s.start, s.end, s.overlap) for s in segments], [(0, 11 * RATE, False)])
+
+    def test_cut_at_silence(self):
+        samples = np.concatenate([_speech(9.2), _silence(1), _speech(10, seed=1)])
+        first, second = self.segments(samples)
+        self.assertGreaterEqual(first.end, 9.2 * RATE)
+        self.assertLessEqual(first.end, 10.2 * RATE)
+        self.assertEqual((second.start, second.end, second.overlap), (first.end, len(samples), False))
+
+    def test_forced_cut_overlaps(self):
+        samples = _speech(30)
+        segments = self.segments(samples)
+        self.assertEqual(len(segments), 3)
+        self.assertEqual((segments[0].start, segments[0].overlap), (0, False))
+        self.assertEqual(segments[-1].end, len(samples))
+        for previous, segment in zip(segments, segments[1:]):
+            # With no silence near the target the cut is forced and the next segment starts a second early
+            self.assertTrue(segment.overlap)
+            self.assertEqual(segment.start, previous.end - RATE)
+            self.assertAlmostEqual((previous.end - previous.start) / RATE, 10, delta=2.5)
+
+    def test_stitch_drops_duplicated_overlap(self):
+        cases = [
+            (['the patient reports chest pain since', 'pain since Tuesday morning'],
+             'the patient reports chest pain since Tuesday morning'),
+            # Words cut off at either edge are garbled, and case and punctuation differ
+            (['reports chest pain since tues', 'hest Pain, since Tuesday morning'],
+             'reports chest pain since Tuesday morning'),
+            (['one two three', 'two three four five six', 'five six seven'],
+             'one two three four five six seven'),
+        ]
+        for texts, expected in cases:
+            with self.subTest(texts=texts):
+                self.assertEqual(stitch_transcripts(texts, [False] + [True] * (len(texts) - 1)), expected)
+
+    def test_stitch_without_shared_text(self):
+        cases = [
+            (['so we will start', 'metformin next week'], [False, True], 'so we will start metformin next week'),
+            # A single repeated word may be said twice
+            (['I said yes', 'yes we can'], [False, True], 'I said yes yes we can'),
+            # Without a forced cut there is no overlap to remove
+            (['a b c', 'b c d'], [False, False], 'a b c b c d'),
+            (['', 'hello there'], [False, True], 'hello there'),
+        ]
+        for texts, overlaps, expected in cases:
+            with self.subTest(texts=texts):
+                self.assertEqual(stitch_transcripts(texts, overlaps), expected)
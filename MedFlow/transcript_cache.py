@@ -0,0 +1,100 @@
+"""
+Transcripts of uploaded recordings, keyed by the SHA-256 of the audio bytes
+
+The upload path hashes the file while it is written to disk. A recording
+that was already transcribed is answered from here without calling Whisper,
+and the duplicate upload is dropped in favour of the stored file. Lookups
+are counted as hits and misses in the shared metrics (every worker, across
+restarts), so a failed transcription, an evicted entry or a re-upload after
+eviction is counted like any other miss.
+"""
+import os
+import json
+from typing import Dict, Any, Optional
+
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import AudioTranscript
+
+from metrics import metrics
+from transcriber import WHISPER_MODEL
+
+LOOKUPS = 'medflow_transcript_cache_lookups_total'
+
+
+class TranscriptCache:
+
+    def __init__(self, enabled: bool = None):
+        if enabled is None:
+            enabled = os.getenv('MEDFLOW_TRANSCRIPT_CACHE', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+        self.enabled = enabled
+
+    def find(self, content_hash: str) -> Optional[AudioTranscript]:
+        """The stored entry for this audio, without counting a hit"""
+        if not self.enabled:
+            return None
+        return AudioTranscript.objects.filter(content_hash=content_hash, model=WHISPER_MODEL).first()
+
+    def lookup(self, content_hash: str) -> Optional[AudioTranscript]:
+        """The stored entry for this audio, counted as a hit, or None counted as a miss"""
+        entry = self.find(content_hash)
+        if self.enabled:
+            metrics.inc(LOOKUPS, outcome='hit' if entry is not None else 'miss')
+        if entry is not None:
+            AudioTranscript.objects.filter(content_hash=content_hash).update(
+                hits=F('hits') + 1,
+                last_used_at=timezone.now()
+            )
+            print(f"✓ Transcript cache hit: {content_hash[:12]} ({entry.audio_file})")
+        return entry
+
+    def relink(self, content_hash: str, audio_file: str):
+        """Point the entry at a new copy of its audio, after the stored file was deleted"""
+        if not self.enabled:
+            return
+        AudioTranscript.objects.filter(content_hash=content_hash).update(audio_file=audio_file)
+
+    def store(self, content_hash: str, audio_file: str, transcription: Dict[str, Any], size: int = 0):
+        if not self.enabled:
+            return
+        AudioTranscript.objects.update_or_create(
+            content_hash=content_hash,
+            defaults={
+                'audio_file': audio_file,
+                'model': WHISPER_MODEL,
+                'transcription': transcription['text'],
+                'segments': transcription.get('segments', 1),
+                'size': size,
+            }
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {'enabled': False}
+
+        lookups = {'hit': 0, 'miss': 0}
+        counters = metrics.collect()['counters'] if metrics.enabled else {}
+        for series, value in counters.items():
+            name, labels = json.loads(series)
+            if name == LOOKUPS:
+                lookups[dict(labels)['outcome']] += value
+        hits, misses = int(lookups['hit']), int(lookups['miss'])
+        total = hits + misses
+
+        totals = AudioTranscript.objects.aggregate(size=Sum('size'))
+        return {
+            'enabled': True,
+            'entries': AudioTranscript.objects.count(),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 3) if total else 0.0,
+            'audio_bytes': totals['size'] or 0,
+            'saved_uploads_bytes': sum(
+                entry.size * entry.hits for entry in AudioTranscript.objects.filter(hits__gt=0).only('size', 'hits')
+            ),
+        }
+
+
+# Singleton instance
+transcript_cache = TranscriptCache()
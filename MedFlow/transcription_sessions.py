@@ -0,0 +1,208 @@
+"""
+Live transcription sessions for recordings that are still in progress
+
+The client opens a session and posts self-contained audio chunks while the
+consultation goes on. Each chunk is transcribed as it arrives (with the end of
+the previous chunk's text as Whisper context) and the running transcript is
+kept on the session row, so any worker process can serve the next chunk.
+Finalizing only has to transcribe the last chunk, plus any earlier chunk that
+failed or was lost with a crashed worker. It does not wait for chunks other
+requests are still transcribing: the session is left finalizing, and the last
+of those requests (or finalize posted again) finalizes it.
+
+A chunk is transcribed by whichever request claimed it last (a compare-and-set
+on ``claimed_at``), and only that request saves the result: a chunk still in
+flight is never sent to Whisper a second time by finalize, and a request whose
+claim was taken over drops its result instead of racing the new one.
+"""
+from datetime import timedelta
+from pathlib import Path
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import TranscriptionSession, TranscriptionChunk
+
+from transcriber import transcriber
+
+
+class SessionClosed(Exception):
+    """Raised when audio is posted to a session that was already finalized"""
+
+
+class TranscriptionSessionManager:
+    # How long a claimed chunk may stay pending before finalize takes it to be lost with its worker
+    CLAIM_SECONDS = 60
+
+    def __init__(self, audio_dir: Path = None):
+        self.audio_dir = audio_dir or Path(__file__).parent / 'audio_recordings' / 'sessions'
+
+    def open(self) -> TranscriptionSession:
+        session = TranscriptionSession.objects.create()
+        print(f"✓ Transcription session opened: {session.session_id}")
+        return session
+
+    def get(self, session_id: str):
+        return TranscriptionSession.objects.filter(session_id=session_id).first()
+
+    def add_chunk(self, session: TranscriptionSession, audio_file, sequence: int = None) -> TranscriptionChunk:
+        """Store an uploaded chunk and transcribe it straight away"""
+        if session.status != TranscriptionSession.STATUS_OPEN:
+            raise SessionClosed(f"Session {session.session_id} is already finalized")
+
+        chunk = self._store_chunk(session, audio_file, sequence)
+        self._transcribe_chunk(chunk)
+        self._refresh_transcript(session)
+
+        # Finalize was posted while this chunk was in flight; the last such chunk finishes it
+        sessions = TranscriptionSession.objects.filter(session_id=session.session_id)
+        if sessions.filter(status=TranscriptionSession.STATUS_FINALIZING).exists():
+            self._finish(session)
+        return chunk
+
+    def finalize(self, session: TranscriptionSession, audio_file=None, sequence: int = None) -> TranscriptionSession:
+        """
+        Close ``session``, optionally with its last chunk. Returns it finalized,
+        or finalizing while other requests are still transcribing chunks: the
+        last of them finalizes it, and so does finalize called again.
+        """
+        if session.status == TranscriptionSession.STATUS_FINALIZED:
+            return session
+
+        # Posted again while finalizing, the last chunk is already stored
+        if audio_file is not None and session.status == TranscriptionSession.STATUS_OPEN:
+            self.add_chunk(session, audio_file, sequence)
+
+        TranscriptionSession.objects.filter(
+            session_id=session.session_id,
+            status=TranscriptionSession.STATUS_OPEN
+        ).update(status=TranscriptionSession.STATUS_FINALIZING, updated_at=timezone.now())
+        self._finish(session)
+        return session
+
+    def pending_sequences(self, session: TranscriptionSession) -> list:
+        """Chunks requests in flight are still transcribing, within their claim"""
+        return list(session.chunks.filter(
+            status=TranscriptionChunk.STATUS_PENDING,
+            claimed_at__gt=timezone.now() - timedelta(seconds=self.CLAIM_SECONDS)
+        ).order_by('sequence').values_list('sequence', flat=True))
+
+    def _finish(self, session: TranscriptionSession):
+        """Finalize a finalizing ``session``, unless chunks are still in flight; ``session`` is reloaded"""
+        if not self.pending_sequences(session):
+            # Anything left failed, or its worker died; take it over, unless another request got there first
+            for chunk in session.chunks.exclude(status=TranscriptionChunk.STATUS_DONE).order_by('sequence'):
+                if self._claim(chunk):
+                    self._transcribe_chunk(chunk)
+
+        # Checked again: a chunk taken over by another request is in flight now
+        if not self.pending_sequences(session):
+            self._refresh_transcript(session)
+            finalized = TranscriptionSession.objects.filter(
+                session_id=session.session_id,
+                status=TranscriptionSession.STATUS_FINALIZING
+            ).update(status=TranscriptionSession.STATUS_FINALIZED, finalized_at=timezone.now(), updated_at=timezone.now())
+            if finalized:
+                print(f"✓ Transcription session finalized: {session.session_id} ({session.chunks.count()} chunks)")
+        session.refresh_from_db()
+
+    def _store_chunk(self, session: TranscriptionSession, audio_file, sequence: int = None) -> TranscriptionChunk:
+        original_filename = audio_file.name
+        if '.' in original_filename:
+            extension = original_filename.rsplit('.', 1)[1].lower()
+        else:
+            extension = 'webm'  # default for recordings
+
+        session_dir = self.audio_dir / session.session_id
+        session_dir.mkdir(parents=True, exist_ok=True)
+
+        with transaction.atomic():
+            if sequence is None:
+                last = session.chunks.aggregate(last=Max('sequence'))['last']
+                sequence = 0 if last is None else last + 1
+            chunk, created = TranscriptionChunk.objects.get_or_create(
+                session=session,
+                sequence=sequence,
+                defaults={'audio_file': f'{session.session_id}/chunk_{sequence:04d}.{extension}'}
+            )
+
+        if not created and chunk.status == TranscriptionChunk.STATUS_DONE:
+            # A retried upload of a chunk we already have
+            return chunk
+
+        chunk.audio_file = f'{session.session_id}/chunk_{sequence:04d}.{extension}'
+        with open(self.audio_dir / chunk.audio_file, 'wb') as f:
+            for data in audio_file.chunks():
+                f.write(data)
+        # A new upload of the chunk takes it over from any request still transcribing the old one
+        chunk.status = TranscriptionChunk.STATUS_PENDING
+        chunk.claimed_at = timezone.now()
+        chunk.save(update_fields=['audio_file', 'status', 'claimed_at'])
+        return chunk
+
+    def _claim(self, chunk: TranscriptionChunk) -> bool:
+        """Take ``chunk`` over, if nobody claimed it since it was read; it is pending again until transcribed"""
+        claimed_at = timezone.now()
+        claimed = TranscriptionChunk.objects.filter(
+            pk=chunk.pk,
+            claimed_at=chunk.claimed_at
+        ).exclude(status=TranscriptionChunk.STATUS_DONE).update(
+            claimed_at=claimed_at,
+            status=TranscriptionChunk.STATUS_PENDING
+        )
+        if claimed:
+            chunk.claimed_at = claimed_at
+            chunk.status = TranscriptionChunk.STATUS_PENDING
+        return bool(claimed)
+
+    def _transcribe_chunk(self, chunk: TranscriptionChunk):
+        audio_path = self.audio_dir / chunk.audio_file
+        extension = audio_path.suffix.lstrip('.')
+
+        try:
+            transcription = transcriber.transcribe(
+                audio_path,
+                audio_path.name,
+                extension,
+                prompt=self._previous_text(chunk)
+            )
+            chunk.text = transcription['text'].strip()
+            chunk.seconds = transcription['seconds']
+            chunk.error = ''
+            chunk.status = TranscriptionChunk.STATUS_DONE
+            print(f"✓ Chunk {chunk.sequence} of session {chunk.session_id} transcribed in {chunk.seconds}s")
+        except Exception as e:
+            chunk.error = str(e)
+            chunk.status = TranscriptionChunk.STATUS_FAILED
+            print(f"❌ Chunk {chunk.sequence} of session {chunk.session_id} failed: {str(e)}")
+
+        # Saved only while this request still holds the claim
+        saved = TranscriptionChunk.objects.filter(pk=chunk.pk, claimed_at=chunk.claimed_at).update(
+            text=chunk.text, seconds=chunk.seconds, error=chunk.error, status=chunk.status
+        )
+        if not saved:
+            print(f"↺ Chunk {chunk.sequence} of session {chunk.session_id} was taken over, dropping this result")
+
+    def _previous_text(self, chunk: TranscriptionChunk) -> str:
+        previous = TranscriptionChunk.objects.filter(
+            session_id=chunk.session_id,
+            sequence__lt=chunk.sequence,
+            status=TranscriptionChunk.STATUS_DONE
+        ).order_by('-sequence').values_list('text', flat=True).first()
+        return previous or ''
+
+    def _refresh_transcript(self, session: TranscriptionSession):
+        # Rebuilt from the chunk rows, so chunks finishing out of order still land in place
+        texts = session.chunks.filter(
+            status=TranscriptionChunk.STATUS_DONE
+        ).order_by('sequence').values_list('text', flat=True)
+        session.transcript = ' '.join(text for text in texts if text)
+        TranscriptionSession.objects.filter(session_id=session.session_id).update(
+            transcript=session.transcript,
+            updated_at=timezone.now()
+        )
+
+
+# Singleton instance
+transcription_sessions = TranscriptionSessionManager()
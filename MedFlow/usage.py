@@ -0,0 +1,164 @@
+"""
+Token usage and cost of the agents' chat completions
+
+A consultation runs inside ``record_usage()``; its calls are then summarised
+into the ``usage`` block saved with the visit and written to the LLMUsage
+table, which the report endpoint aggregates by category, model and day.
+
+Prices are USD per million tokens. Override or extend them with
+MEDFLOW_MODEL_PRICES, e.g. '{"gpt-4o": {"prompt": 2.5, "completion": 10}}'.
+"""
+import os
+import json
+from datetime import date
+from typing import Dict, Any, List, Iterable, Optional
+
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+
+from .models import LLMUsage
+
+DEFAULT_PRICES = {
+    'gpt-4o': {'prompt': 2.50, 'completion': 10.00},
+    'gpt-4o-mini': {'prompt': 0.15, 'completion': 0.60},
+    'gpt-4.1': {'prompt': 2.00, 'completion': 8.00},
+    'gpt-4.1-mini': {'prompt': 0.40, 'completion': 1.60},
+    'gpt-4.1-nano': {'prompt': 0.10, 'completion': 0.40},
+}
+
+# Report dimensions and the LLMUsage column behind each
+GROUP_FIELDS = {
+    'category': 'category',
+    'model': 'model',
+    'day': 'day',
+    'patient': 'patient_name',
+    'visit': 'visit_id',
+}
+
+TOKEN_FIELDS = ('prompt_tokens', 'completion_tokens', 'total_tokens')
+
+
+class UsageLedger:
+
+    def __init__(self, prices: Dict[str, Dict[str, float]] = None):
+        if prices is None:
+            prices = dict(DEFAULT_PRICES)
+            prices.update(json.loads(os.getenv('MEDFLOW_MODEL_PRICES') or '{}'))
+        self.prices = prices
+
+    def price(self, model: str) -> Optional[Dict[str, float]]:
+        """Prices of ``model``; dated snapshots such as gpt-4o-2024-08-06 use their base model's"""
+        if not model:
+            return None
+        matches = [name for name in self.prices if model == name or model.startswith(name + '-')]
+        return self.prices[max(matches, key=len)] if matches else None
+
+    def cost(self, call: Dict[str, Any]) -> float:
+        price = self.price(call.get('model'))
+        if price is None:
+            return 0.0
+        return (call['prompt_tokens'] * price['prompt'] + call['completion_tokens'] * price['completion']) / 1_000_000
+
+    def summarize(self, calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """The usage block saved with a visit: totals plus one entry per agent prompt category"""
+        summary = self._totals(calls)
+        by_agent = {}
+        for call in calls:
+            by_agent.setdefault(call['category'], []).append(call)
+        summary['by_agent'] = {
+            category: {'model': agent_calls[-1]['model'], **self._totals(agent_calls)}
+            for category, agent_calls in by_agent.items()
+        }
+        unpriced = sorted({c['model'] for c in calls if not c['cached'] and self.price(c['model']) is None})
+        if unpriced:
+            summary['unpriced_models'] = unpriced
+        return summary
+
+    def record(self, calls: List[Dict[str, Any]], visit_id: str = '', patient_name: str = ''):
+        if not calls:
+            return
+        try:
+            LLMUsage.objects.bulk_create([
+                LLMUsage(
+                    category=call['category'],
+                    model=call['model'] or '',
+                    cached=call['cached'],
+                    prompt_tokens=call['prompt_tokens'],
+                    completion_tokens=call['completion_tokens'],
+                    total_tokens=call['total_tokens'],
+                    seconds=call.get('seconds', 0.0),
+                    cost_usd=self.cost(call),
+                    visit_id=visit_id or '',
+                    patient_name=patient_name or '',
+                )
+                for call in calls
+            ])
+        except Exception as e:
+            # Accounting must never cost the clinician their visit
+            print(f"⚠️  Could not record LLM usage: {str(e)}")
+
+    def report(self, start: date = None, end: date = None,
+               group_by: Iterable[str] = ('category', 'model', 'day')) -> Dict[str, Any]:
+        """Totals per combination of ``group_by`` dimensions between two days (inclusive)"""
+        group_by = list(group_by)
+        for dimension in group_by:
+            if dimension not in GROUP_FIELDS:
+                raise ValueError(f"Unknown group_by '{dimension}', expected any of {', '.join(GROUP_FIELDS)}")
+
+        queryset = LLMUsage.objects.annotate(day=TruncDate('created_at'))
+        if start is not None:
+            queryset = queryset.filter(day__gte=start)
+        if end is not None:
+            queryset = queryset.filter(day__lte=end)
+
+        aggregates = {
+            'calls': Count('id'),
+            'cached_calls': Count('id', filter=Q(cached=True)),
+            **{field: Sum(field) for field in TOKEN_FIELDS},
+            'seconds': Sum('seconds'),
+            'cost_usd': Sum('cost_usd'),
+        }
+        columns = [GROUP_FIELDS[d] for d in group_by]
+
+        rows = []
+        if columns:
+            for row in queryset.values(*columns).annotate(**aggregates).order_by(*columns):
+                entry = {d: row[GROUP_FIELDS[d]] for d in group_by}
+                if 'day' in entry and entry['day'] is not None:
+                    entry['day'] = entry['day'].isoformat()
+                entry.update(self._clean(row))
+                rows.append(entry)
+
+        return {
+            'group_by': group_by,
+            'start': start.isoformat() if start else None,
+            'end': end.isoformat() if end else None,
+            'rows': rows,
+            'totals': self._clean(queryset.aggregate(**aggregates)),
+        }
+
+    def _totals(self, calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+        totals = {
+            'calls': len(calls),
+            'cached_calls': sum(1 for c in calls if c['cached']),
+            **{field: sum(c[field] for c in calls) for field in TOKEN_FIELDS},
+            'seconds': sum(c.get('seconds', 0.0) for c in calls),
+            'cost_usd': sum(self.cost(c) for c in calls),
+        }
+        return self._clean(totals)
+
+    def _clean(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        cleaned = {
+            'calls': row['calls'] or 0,
+            'cached_calls': row['cached_calls'] or 0,
+            **{field: row[field] or 0 for field in TOKEN_FIELDS},
+            'seconds': round(row['seconds'] or 0.0, 3),
+            'cost_usd': round(row['cost_usd'] or 0.0, 6),
+        }
+        uncached = cleaned['calls'] - cleaned['cached_calls']
+        cleaned['avg_seconds'] = round(cleaned['seconds'] / uncached, 3) if uncached else 0.0
+        return cleaned
+
+
+# Singleton instance
+usage_ledger = UsageLedger()
@@ -0,0 +1,14 @@
+"""
+Visit IDs
+
+``visit_<YYYYmmdd_HHMMSS>_<microseconds>_<random hex>``: IDs sort by the time
+of the visit, including the older second-resolution ``visit_<YYYYmmdd_HHMMSS>``
+IDs, which sort before any newer ID of the same second. The microseconds and
+random suffix keep two saves in the same second, by different workers, apart.
+"""
+import secrets
+from datetime import datetime
+
+
+def new_visit_id(now: datetime) -> str:
+    return f"visit_{now.strftime('%Y%m%d_%H%M%S_%f')}_{secrets.token_hex(3)}"
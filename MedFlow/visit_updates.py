@@ -0,0 +1,34 @@
+"""
+Conditional visit updates
+
+A caller that computed an update from an earlier read of a visit (a
+recompute runs the agents for a minute) names the fields it was based on;
+the storage backend checks them against the visit as stored, with the visit
+locked, and writes nothing if any changed since.
+"""
+from datetime import datetime
+from typing import Dict, List
+
+
+class VisitChanged(Exception):
+    """The stored visit no longer holds the values an update was based on"""
+
+    def __init__(self, fields: List[str]):
+        super().__init__(f"Visit changed meanwhile: {', '.join(fields)}")
+        self.fields = fields
+
+
+def apply_visit_update(visit_record: Dict, updated_data: Dict, expected: Dict = None, append: Dict = None):
+    """
+    Update ``visit_record`` in place, as both backends do with the visit
+    locked: ``expected`` maps fields to the values the record must still hold
+    (VisitChanged otherwise, before anything changes) and ``append`` maps
+    list fields to an item appended to the stored list.
+    """
+    changed = [name for name, value in (expected or {}).items() if visit_record.get(name) != value]
+    if changed:
+        raise VisitChanged(changed)
+    visit_record.update(updated_data)
+    for name, item in (append or {}).items():
+        visit_record[name] = list(visit_record.get(name) or []) + [item]
+    visit_record['last_modified'] = datetime.now().isoformat()
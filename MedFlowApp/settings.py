@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'MedFlow.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -86,6 +87,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Several worker processes and job threads share this file
+            'timeout': 20,
+        },
     }
 }
 
@@ -160,3 +165,10 @@ REST_FRAMEWORK = {
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Background processing jobs (/api/process/jobs/)
+MEDFLOW_JOB_WORKERS = int(os.getenv('MEDFLOW_JOB_WORKERS', '2'))
+MEDFLOW_JOB_QUEUE_DEPTH = int(os.getenv('MEDFLOW_JOB_QUEUE_DEPTH', '100'))
+MEDFLOW_JOB_POLL_INTERVAL = float(os.getenv('MEDFLOW_JOB_POLL_INTERVAL', '1.0'))
+# Start each server process's worker pool at startup; off when `manage.py process_jobs` does the work
+MEDFLOW_JOB_AUTOSTART = os.getenv('MEDFLOW_JOB_AUTOSTART', '1').strip().lower() in ('1', 'true', 'yes', 'on')
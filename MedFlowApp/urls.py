@@ -30,15 +30,32 @@ urlpatterns = [
     
     # API endpoints for React frontend
     path('api/health/', api_views.api_health_check, name='api_health'),
+    path('api/llm-cache/stats/', api_views.api_llm_cache_stats, name='api_llm_cache_stats'),
+    path('api/llm-policy/stats/', api_views.api_llm_policy_stats, name='api_llm_policy_stats'),
+    path('api/order-prefilter/stats/', api_views.api_order_prefilter_stats, name='api_order_prefilter_stats'),
+    path('api/transcript-cache/stats/', api_views.api_transcript_cache_stats, name='api_transcript_cache_stats'),
+    path('api/metrics/', api_views.api_metrics, name='api_metrics'),
+    path('api/usage/report/', api_views.api_usage_report, name='api_usage_report'),
     path('api/auth/login/', api_views.api_login, name='api_login'),
     path('api/auth/logout/', api_views.api_logout, name='api_logout'),
     path('api/auth/me/', api_views.api_current_user, name='api_current_user'),
     path('api/transcribe/', api_views.api_transcribe_audio, name='api_transcribe'),
+    path('api/transcribe/sessions/', api_views.api_open_transcription_session, name='api_open_transcription_session'),
+    path('api/transcribe/sessions/<str:session_id>/', api_views.api_get_transcription_session, name='api_get_transcription_session'),
+    path('api/transcribe/sessions/<str:session_id>/chunks/', api_views.api_add_transcription_chunk, name='api_add_transcription_chunk'),
+    path('api/transcribe/sessions/<str:session_id>/finalize/', api_views.api_finalize_transcription_session, name='api_finalize_transcription_session'),
     path('api/process/', api_views.api_process_transcription, name='api_process'),
+    path('api/process/soap-stream/', api_views.api_stream_soap_note, name='api_stream_soap_note'),
+    path('api/process/jobs/', api_views.api_submit_processing_job, name='api_submit_processing_job'),
+    path('api/process/jobs/<str:job_id>/', api_views.api_get_processing_job, name='api_get_processing_job'),
+    
+    # Async variants, for deployments served through MedFlowApp/asgi.py
+    path('api/async/transcribe/', api_views.api_transcribe_audio_async, name='api_transcribe_async'),
+    path('api/async/process/', api_views.api_process_transcription_async, name='api_process_async'),
     
     # Patient management endpoints
     path('api/patients/', api_views.api_get_all_patients, name='api_get_all_patients'),
     path('api/patients/<str:patient_name>/', api_views.api_get_patient, name='api_get_patient'),
     path('api/patients/<str:patient_name>/visits/', api_views.api_get_patient_visits, name='api_get_patient_visits'),
-    path('api/patients/<str:patient_name>/visits/<str:visit_id>/', api_views.api_update_patient_visit, name='api_update_patient_visit'),
+    path('api/patients/<str:patient_name>/visits/<str:visit_id>/', api_views.api_patient_visit, name='api_patient_visit'),
 ]
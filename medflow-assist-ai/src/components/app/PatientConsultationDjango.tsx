@@ -23,6 +23,9 @@ import {
 import { toast } from "sonner";
 import { apiService } from "@/services/api";
 
+// Length of each audio chunk posted to the live transcription session
+const CHUNK_INTERVAL_MS = 20000;
+
 const PatientConsultationDjango = () => {
   const [patientName, setPatientName] = useState("");
   const [currentPatient, setCurrentPatient] = useState<any | null>(null);
@@ -35,8 +38,12 @@ const PatientConsultationDjango = () => {
   
   // Web Audio API for recording
   const mediaRecorderRef = useRef<MediaRecorder | null>(null);
-  const audioChunksRef = useRef<Blob[]>([]);
   const streamRef = useRef<MediaStream | null>(null);
+  const sessionIdRef = useRef<string | null>(null);
+  const sequenceRef = useRef(0);
+  const pendingUploadsRef = useRef<Promise<void>[]>([]);
+  const rotateTimerRef = useRef<number | null>(null);
+  const stoppingRef = useRef(false);
   const fileInputRef = useRef<HTMLInputElement>(null);
 
   const handleStartConsultation = () => {
@@ -63,25 +70,27 @@ const PatientConsultationDjango = () => {
       const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
       streamRef.current = stream;
 
-      const mediaRecorder = new MediaRecorder(stream, {
-        mimeType: 'audio/webm',
-      });
-      
-      audioChunksRef.current = [];
-
-      mediaRecorder.ondataavailable = (event) => {
-        if (event.data.size > 0) {
-          audioChunksRef.current.push(event.data);
-        }
-      };
-
-      mediaRecorder.onstop = async () => {
-        const audioBlob = new Blob(audioChunksRef.current, { type: 'audio/webm' });
-        await transcribeAudio(audioBlob);
-      };
+      // Live session: chunks are transcribed while the consultation goes on
+      try {
+        const session = await apiService.openTranscriptionSession();
+        sessionIdRef.current = session.session_id;
+      } catch (error) {
+        console.warn("Live transcription unavailable, uploading after recording:", error);
+        sessionIdRef.current = null;
+      }
+      sequenceRef.current = 0;
+      pendingUploadsRef.current = [];
+      stoppingRef.current = false;
+      setTranscript("");
+
+      startSegment(stream);
+      if (sessionIdRef.current) {
+        rotateTimerRef.current = window.setInterval(() => {
+          // Each chunk is its own complete webm file, so the recorder is restarted
+          mediaRecorderRef.current?.stop();
+        }, CHUNK_INTERVAL_MS);
+      }
 
-      mediaRecorder.start();
-      mediaRecorderRef.current = mediaRecorder;
       setIsRecording(true);
       toast.success("Recording started");
     } catch (error) {
@@ -90,8 +99,52 @@ const PatientConsultationDjango = () => {
     }
   };
 
+  const startSegment = (stream: MediaStream) => {
+    const mediaRecorder = new MediaRecorder(stream, {
+      mimeType: 'audio/webm',
+    });
+    
+    const segmentChunks: Blob[] = [];
+
+    mediaRecorder.ondataavailable = (event) => {
+      if (event.data.size > 0) {
+        segmentChunks.push(event.data);
+      }
+    };
+
+    mediaRecorder.onstop = async () => {
+      const audioBlob = new Blob(segmentChunks, { type: 'audio/webm' });
+      const sessionId = sessionIdRef.current;
+
+      if (!sessionId) {
+        await transcribeAudio(audioBlob);
+        return;
+      }
+
+      const sequence = sequenceRef.current++;
+      if (stoppingRef.current) {
+        await finalizeSession(sessionId, audioBlob, sequence);
+        return;
+      }
+
+      startSegment(stream);
+      const upload = apiService.addTranscriptionChunk(sessionId, audioBlob, sequence)
+        .then((response) => setTranscript(response.transcript))
+        .catch((error) => console.error(`Chunk ${sequence} failed, retried on finalize:`, error));
+      pendingUploadsRef.current.push(upload);
+    };
+
+    mediaRecorder.start();
+    mediaRecorderRef.current = mediaRecorder;
+  };
+
   const handleStopRecording = () => {
     if (mediaRecorderRef.current && isRecording) {
+      stoppingRef.current = true;
+      if (rotateTimerRef.current) {
+        window.clearInterval(rotateTimerRef.current);
+        rotateTimerRef.current = null;
+      }
       mediaRecorderRef.current.stop();
       setIsRecording(false);
       
@@ -104,6 +157,29 @@ const PatientConsultationDjango = () => {
     }
   };
 
+  const finalizeSession = async (sessionId: string, lastChunk: Blob, sequence: number) => {
+    setIsProcessing(true);
+    try {
+      // Earlier chunks must be in before the session is closed
+      await Promise.all(pendingUploadsRef.current);
+      const response = await apiService.finalizeTranscriptionSession(sessionId, lastChunk, sequence);
+      
+      if (response.success) {
+        setTranscript(response.transcription);
+        toast.success("Transcription complete!");
+        
+        // Automatically process through AI agents
+        await processTranscription(response.transcription, response.audio_file);
+      }
+    } catch (error: any) {
+      console.error("Transcription error:", error);
+      toast.error(error.message || "Transcription failed");
+    } finally {
+      sessionIdRef.current = null;
+      setIsProcessing(false);
+    }
+  };
+
   const transcribeAudio = async (audioBlob: Blob) => {
     setIsProcessing(true);
     try {
@@ -10,6 +10,36 @@ interface ApiResponse<T = any> {
   [key: string]: any;
 }
 
+interface ListParams {
+  limit?: number;
+  cursor?: string;
+  order?: 'asc' | 'desc';
+  since?: string;
+  until?: string;
+}
+
+export interface PatientListParams extends ListParams {
+  sort?: 'last_visit' | 'name' | 'visit_count';
+}
+
+export interface VisitListParams extends ListParams {
+  has_lab_orders?: boolean;
+  has_prescriptions?: boolean;
+  // 'headers': visit_id, timestamp, patient_mrn, assessment_snippet and order flags only
+  view?: 'full' | 'headers';
+  // Comma-separated, dotted for nested fields, e.g. 'timestamp,soap_note.assessment'
+  fields?: string;
+}
+
+function queryString(params: Record<string, any>): string {
+  const query = new URLSearchParams();
+  for (const [key, value] of Object.entries(params)) {
+    if (value !== undefined && value !== null) query.set(key, String(value));
+  }
+  const text = query.toString();
+  return text ? `?${text}` : '';
+}
+
 class ApiService {
   private async request<T = any>(
     endpoint: string,
@@ -104,8 +134,65 @@ class ApiService {
     }
   }
 
-  // Process transcription through AI agents
-  async processTranscription(transcription: string, audioFile?: string): Promise<{
+  // Live transcription sessions: chunks are transcribed while recording continues
+  async openTranscriptionSession(): Promise<{
+    success: boolean;
+    session_id: string;
+    chunks_url: string;
+    finalize_url: string;
+  }> {
+    return this.request('/transcribe/sessions/', { method: 'POST' });
+  }
+
+  private async postAudio(endpoint: string, audio?: Blob, sequence?: number): Promise<any> {
+    const formData = new FormData();
+    if (audio) {
+      formData.append('audio', audio, `chunk_${sequence ?? 0}.webm`);
+    }
+    if (sequence !== undefined) {
+      formData.append('sequence', String(sequence));
+    }
+
+    const response = await fetch(`${API_BASE_URL}${endpoint}`, {
+      method: 'POST',
+      body: formData,
+      credentials: 'include',
+    });
+
+    if (!response.ok) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+    }
+    return response.json();
+  }
+
+  async addTranscriptionChunk(sessionId: string, audio: Blob, sequence: number): Promise<{
+    success: boolean;
+    text: string;
+    transcript: string;
+    chunk: any;
+  }> {
+    return this.postAudio(`/transcribe/sessions/${encodeURIComponent(sessionId)}/chunks/`, audio, sequence);
+  }
+
+  // While earlier chunks are still being transcribed the session is 'finalizing'; finalize is posted again until done
+  async finalizeTranscriptionSession(sessionId: string, lastChunk?: Blob, sequence?: number): Promise<{
+    success: boolean;
+    transcription: string;
+    audio_file: string;
+    failed_chunks: number[];
+  }> {
+    const endpoint = `/transcribe/sessions/${encodeURIComponent(sessionId)}/finalize/`;
+    let response = await this.postAudio(endpoint, lastChunk, sequence);
+    while (response.status === 'finalizing') {
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+      response = await this.postAudio(endpoint);
+    }
+    return response;
+  }
+
+  // Process transcription through AI agents; pass the run_id of a failed run to retry only its missing stages
+  async processTranscription(transcription: string, audioFile?: string, runId?: string): Promise<{
     success: boolean;
     transcription: string;
     patient_data: any;
@@ -120,31 +207,119 @@ class ApiService {
       body: JSON.stringify({
         transcription,
         audio_file: audioFile || '',
+        ...(runId ? { run_id: runId } : {}),
       }),
     });
   }
 
+  // Background processing: submit returns a job ID immediately, poll for the result
+  async submitProcessingJob(transcription: string, audioFile?: string): Promise<{
+    success: boolean;
+    job_id: string;
+    status: string;
+    status_url: string;
+  }> {
+    return this.request('/process/jobs/', {
+      method: 'POST',
+      body: JSON.stringify({
+        transcription,
+        audio_file: audioFile || '',
+      }),
+    });
+  }
+
+  async getProcessingJob(jobId: string): Promise<{
+    success: boolean;
+    job: {
+      job_id: string;
+      status: 'queued' | 'running' | 'succeeded' | 'failed';
+      result?: any;
+      error?: string;
+      [key: string]: any;
+    };
+  }> {
+    return this.request(`/process/jobs/${encodeURIComponent(jobId)}/`);
+  }
+
+  // Stream the SOAP note section by section as Server-Sent Events
+  async streamSoapNote(
+    transcription: string,
+    onEvent: (event: string, data: any) => void
+  ): Promise<Record<string, string>> {
+    const response = await fetch(`${API_BASE_URL}/process/soap-stream/`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      credentials: 'include',
+      body: JSON.stringify({ transcription }),
+    });
+
+    if (!response.ok || !response.body) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let soapNote: Record<string, string> = {};
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      // Messages are separated by a blank line
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const message = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let event = 'message';
+        let data = '';
+        for (const line of message.split('\n')) {
+          if (line.startsWith('event: ')) event = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        }
+        if (!data) continue;
+
+        const payload = JSON.parse(data);
+        if (event === 'error') throw new Error(payload.error);
+        if (event === 'soap_note') soapNote = payload.soap_note;
+        onEvent(event, payload);
+      }
+    }
+
+    return soapNote;
+  }
+
   // Health check
   async healthCheck() {
     return this.request('/health/');
   }
 
-  // Patient management
-  async getAllPatients() {
-    return this.request('/patients/');
+  // Patient management; with a limit, pass the returned next_cursor back as cursor for the next page
+  async getAllPatients(params: PatientListParams = {}) {
+    return this.request(`/patients/${queryString(params)}`);
   }
 
   async getPatient(patientName: string) {
     return this.request(`/patients/${encodeURIComponent(patientName)}/`);
   }
 
-  async getPatientVisits(patientName: string) {
-    return this.request(`/patients/${encodeURIComponent(patientName)}/visits/`);
+  async getPatientVisits(patientName: string, params: VisitListParams = {}) {
+    return this.request(`/patients/${encodeURIComponent(patientName)}/visits/${queryString(params)}`);
+  }
+
+  async getPatientVisit(patientName: string, visitId: string, fields?: string) {
+    return this.request(
+      `/patients/${encodeURIComponent(patientName)}/visits/${encodeURIComponent(visitId)}/${queryString({ fields })}`
+    );
   }
 
-  async updatePatientVisit(patientName: string, visitId: string, data: any) {
+  // With recompute, the agents that depend on the edited fields are rerun and their outputs saved too
+  async updatePatientVisit(patientName: string, visitId: string, data: any, recompute = false) {
     return this.request(
-      `/patients/${encodeURIComponent(patientName)}/visits/${encodeURIComponent(visitId)}/`,
+      `/patients/${encodeURIComponent(patientName)}/visits/${encodeURIComponent(visitId)}/${recompute ? '?recompute=true' : ''}`,
       {
         method: 'PUT',
         headers: {